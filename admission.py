@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+上游准入控制
+呼叫 OpenAI / Replicate 前先向權杖桶（token bucket）取得額度，速率依帳號的 RPM / TPM 設定，
+尖峰時在本機排隊，而不是一起打到上游換回一堆 429。
+
+- 依優先順序排隊：VIP（0）> 一般使用者（1）> 背景工作（2，預先解讀、每日預熱）
+- 優先順序 p 的請求必須在桶內留下 reserve × p 的容量，其他 worker 的 VIP 也排得進去
+- 預估等待已超過可等的時間就立即拒絕，使用者馬上收到「忙碌中」而不是等到逾時
+
+權杖桶儲存：
+- memory: 單一行程內（預設，每個 worker 各自計算）
+- sqlite: 同一台機器的多個 worker 共用
+- redis:  多台機器共用（需安裝 redis 套件）
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_VIP = 0
+PRIORITY_FREE = 1
+PRIORITY_BACKGROUND = 2
+
+PRIORITY_NAMES = {PRIORITY_VIP: "vip", PRIORITY_FREE: "free", PRIORITY_BACKGROUND: "background"}
+
+# rate 為每秒補充量，capacity 為桶的容量（可瞬間用掉的量）
+Bucket = namedtuple("Bucket", "name rate capacity")
+
+
+def _refill(bucket: Bucket, tokens: float, updated: float, now: float) -> float:
+    return min(bucket.capacity, tokens + max(0.0, now - updated) * bucket.rate)
+
+
+def _wait(costs: list, levels: dict, reserve: float) -> float:
+    """
+    costs 為 [(Bucket, 數量)]，回傳還要等幾秒桶內才夠（含保留的容量），足夠時回傳 0
+    """
+    wait = 0.0
+    for bucket, amount in costs:
+        # 單次用量超過容量時以容量計，否則永遠等不到
+        need = min(amount + bucket.capacity * reserve, bucket.capacity) - levels[bucket.name]
+        if need > 0:
+            wait = max(wait, need / bucket.rate)
+    return wait
+
+
+class MemoryBucketStore:
+    """
+    行程內的權杖桶 {名稱: (剩餘量, 更新時間)}
+    """
+
+    def __init__(self):
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def _level(self, bucket: Bucket, now: float) -> float:
+        tokens, updated = self._levels.get(bucket.name, (bucket.capacity, now))
+        return _refill(bucket, tokens, updated, now)
+
+    def take(self, costs: list, reserve: float = 0.0) -> float:
+        """
+        所有桶都足夠時一起扣除並回傳 0，否則不扣除，回傳還要等幾秒
+        """
+        now = time.time()
+        with self._lock:
+            levels = {bucket.name: self._level(bucket, now) for bucket, _ in costs}
+            wait = _wait(costs, levels, reserve)
+            if wait == 0:
+                for bucket, amount in costs:
+                    self._levels[bucket.name] = (levels[bucket.name] - amount, now)
+            return wait
+
+    def levels(self, buckets: list) -> dict:
+        now = time.time()
+        with self._lock:
+            return {bucket.name: self._level(bucket, now) for bucket in buckets}
+
+
+class SQLiteBucketStore:
+    """
+    SQLite（WAL）權杖桶，同一台機器的多個 worker 共用；讀取、判斷與扣除在同一個交易內完成
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS token_buckets ("
+            " name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _read(self, conn: sqlite3.Connection, buckets: list, now: float) -> dict:
+        rows = dict(
+            (name, (tokens, updated)) for name, tokens, updated in conn.execute(
+                f"SELECT name, tokens, updated FROM token_buckets WHERE name IN ({','.join('?' * len(buckets))})",
+                [bucket.name for bucket in buckets],
+            )
+        )
+        return {
+            bucket.name: _refill(bucket, *rows.get(bucket.name, (bucket.capacity, now)), now)
+            for bucket in buckets
+        }
+
+    def take(self, costs: list, reserve: float = 0.0) -> float:
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels = self._read(conn, [bucket for bucket, _ in costs], now)
+            wait = _wait(costs, levels, reserve)
+            if wait == 0:
+                conn.executemany(
+                    "INSERT INTO token_buckets (name, tokens, updated) VALUES (?, ?, ?)"
+                    " ON CONFLICT (name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                    [(bucket.name, levels[bucket.name] - amount, now) for bucket, amount in costs],
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def levels(self, buckets: list) -> dict:
+        return self._read(self._conn(), buckets, time.time())
+
+
+# 在 Redis 端以 Lua 原子執行，時間以 Redis 伺服器為準（各機器時鐘不一致也沒關係）
+# KEYS 為各桶的鍵，ARGV 為 reserve 之後每個桶依序 rate、capacity、amount
+_TAKE_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local reserve = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[i * 3 - 1])
+  local capacity = tonumber(ARGV[i * 3])
+  local amount = tonumber(ARGV[i * 3 + 1])
+  local state = redis.call('HMGET', key, 'tokens', 'updated')
+  local tokens = capacity
+  if state[1] then
+    tokens = math.min(capacity, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate)
+  end
+  levels[i] = tokens
+  local need = math.min(amount + capacity * reserve, capacity) - tokens
+  if need > 0 then
+    wait = math.max(wait, need / rate)
+  end
+end
+if wait == 0 then
+  for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local capacity = tonumber(ARGV[i * 3])
+    redis.call('HSET', key, 'tokens', levels[i] - tonumber(ARGV[i * 3 + 1]), 'updated', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 60)
+  end
+end
+return tostring(wait)
+"""
+
+
+class RedisBucketStore:
+    """
+    Redis 權杖桶，鍵為 token_bucket:{名稱}，桶補滿之後自動刪除
+    """
+
+    def __init__(self, url: str = None, client=None, prefix: str = "token_bucket"):
+        if client is None:
+            import redis  # 選用套件，只有使用 redis 時才需要
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(_TAKE_SCRIPT)
+
+    def take(self, costs: list, reserve: float = 0.0) -> float:
+        args = [reserve]
+        for bucket, amount in costs:
+            args += [bucket.rate, bucket.capacity, amount]
+        wait = self._take(keys=[f"{self.prefix}:{bucket.name}" for bucket, _ in costs], args=args)
+        return float(wait)
+
+    def levels(self, buckets: list) -> dict:
+        pipe = self.client.pipeline(transaction=False)
+        for bucket in buckets:
+            pipe.hmget(f"{self.prefix}:{bucket.name}", "tokens", "updated")
+        now = time.time()
+        levels = {}
+        for bucket, (tokens, updated) in zip(buckets, pipe.execute()):
+            if tokens is None:
+                levels[bucket.name] = bucket.capacity
+            else:
+                levels[bucket.name] = _refill(bucket, float(tokens), float(updated), now)
+        return levels
+
+
+def make_bucket_store(backend: str, sqlite_path: str = None, redis_url: str = None):
+    """
+    依設定建立權杖桶儲存
+    """
+    if backend == "sqlite":
+        return SQLiteBucketStore(sqlite_path)
+    if backend == "redis":
+        return RedisBucketStore(redis_url)
+    if backend == "memory":
+        return MemoryBucketStore()
+    raise ValueError(f"未知的 ADMISSION_BACKEND: {backend}")
+
+
+class AdmissionController:
+    """
+    一個上游的准入控制，limits 為 {項目: 每分鐘額度}，例如 {"requests": 500, "tokens": 200000}（0 表示不限制）
+    桶的容量為 burst 秒的額度；同步（acquire）與 asyncio（acquire_async）的請求排在同一個佇列
+
+    observer(name, priority, outcome, waited) 在每次准入結束時被呼叫，outcome 為
+    admitted / shed（預估來不及，直接拒絕）/ timeout（排隊到時間用完）
+    """
+
+    def __init__(self, name: str, store, limits: dict, burst: float = 10.0, reserve: float = 0.1,
+                 max_wait: float = 5.0, observer=None):
+        self.name = name
+        self.store = store
+        self.buckets = {
+            key: Bucket(f"{name}:{key}", per_minute / 60, per_minute / 60 * burst)
+            for key, per_minute in limits.items() if per_minute > 0
+        }
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.observer = observer
+        self.admitted = 0
+        self.shed = 0
+        self.timeouts = 0
+        self._queue = []  # 本行程排隊中的請求 [(priority, 序號, 用量)]
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._async_waiters = set()  # {(事件迴圈, asyncio.Event)}
+        # SQLite / Redis 桶在 asyncio 版本中移到執行緒讀寫
+        self._inline = isinstance(store, MemoryBucketStore)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.buckets)
+
+    def _costs(self, cost: dict) -> list:
+        return [(bucket, cost.get(key, 0)) for key, bucket in self.buckets.items()]
+
+    def _floor(self, priority: int) -> float:
+        return self.reserve * priority
+
+    def _limit(self, timeout: float) -> float:
+        return self.max_wait if timeout is None else max(0.0, min(timeout, self.max_wait))
+
+    def _ahead(self, priority: int) -> dict:
+        """
+        本行程中排在 priority 前面（含同等級）的用量
+        """
+        with self._cond:
+            queued = [cost for p, _, cost in self._queue if p <= priority]
+        return {key: sum(cost.get(key, 0) for cost in queued) for key in self.buckets}
+
+    def _estimate(self, cost: dict, priority: int, levels: dict) -> float:
+        ahead = self._ahead(priority)
+        return _wait(
+            [(bucket, ahead[key] + cost.get(key, 0)) for key, bucket in self.buckets.items()],
+            levels,
+            self._floor(priority)
+        )
+
+    def estimated_wait(self, cost: dict, priority: int) -> float:
+        """
+        排在前面的請求用完之後，這個請求還要等幾秒才有額度
+        """
+        if not self.buckets:
+            return 0.0
+        return self._estimate(cost, priority, self.store.levels(list(self.buckets.values())))
+
+    def overloaded(self, cost: dict, priority: int) -> bool:
+        """
+        預估等待已超過 max_wait，新的請求應直接回覆忙碌中
+        """
+        return self.estimated_wait(cost, priority) > self.max_wait
+
+    def _enter(self, cost: dict, priority: int) -> tuple:
+        entry = (priority, next(self._counter), cost)
+        with self._cond:
+            heapq.heappush(self._queue, entry)
+            self._notify()
+        return entry
+
+    def _leave(self, entry: tuple):
+        with self._cond:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            self._notify()
+
+    def _notify(self):
+        # 佇列有變動：喚醒所有等待者重新確認自己是否排在最前面
+        self._cond.notify_all()
+        for loop, event in list(self._async_waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def _done(self, priority: int, outcome: str, started: float) -> bool:
+        waited = time.monotonic() - started
+        if outcome == "admitted":
+            self.admitted += 1
+        elif outcome == "shed":
+            self.shed += 1
+        else:
+            self.timeouts += 1
+        if outcome != "admitted":
+            logger.warning("%s 額度不足，放棄呼叫（%s，等待 %.2f 秒）", self.name, PRIORITY_NAMES.get(priority), waited)
+        if self.observer is not None:
+            try:
+                self.observer(self.name, priority, outcome, waited)
+            except Exception:
+                logger.exception("准入統計失敗")
+        return outcome == "admitted"
+
+    def acquire(self, cost: dict, priority: int = PRIORITY_FREE, timeout: float = None) -> bool:
+        """
+        取得額度，最多等待 min(timeout, max_wait) 秒；來不及時回傳 False
+        """
+        if not self.buckets:
+            return True
+        started = time.monotonic()
+        deadline = started + self._limit(timeout)
+        if self.estimated_wait(cost, priority) > deadline - started:
+            return self._done(priority, "shed", started)
+
+        costs = self._costs(cost)
+        entry = self._enter(cost, priority)
+        try:
+            while True:
+                with self._cond:
+                    # 只有排在最前面的請求向桶取額度
+                    while self._queue[0] is not entry:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return self._done(priority, "timeout", started)
+                        self._cond.wait(remaining)
+                wait = self.store.take(costs, self._floor(priority))
+                if wait == 0:
+                    return self._done(priority, "admitted", started)
+                if time.monotonic() + wait > deadline:
+                    return self._done(priority, "shed", started)
+                with self._cond:
+                    # 有更優先的請求加入時提早醒來讓位
+                    self._cond.wait(wait)
+        finally:
+            self._leave(entry)
+
+    async def _call(self, func, *args):
+        if self._inline:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def acquire_async(self, cost: dict, priority: int = PRIORITY_FREE, timeout: float = None) -> bool:
+        """
+        asyncio 版本的 acquire，等待時不佔用執行緒
+        """
+        if not self.buckets:
+            return True
+        started = time.monotonic()
+        deadline = started + self._limit(timeout)
+        levels = await self._call(self.store.levels, list(self.buckets.values()))
+        if self._estimate(cost, priority, levels) > deadline - started:
+            return self._done(priority, "shed", started)
+
+        costs = self._costs(cost)
+        changed = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), changed)
+        with self._cond:
+            self._async_waiters.add(waiter)
+        entry = self._enter(cost, priority)
+        try:
+            while True:
+                changed.clear()
+                with self._cond:
+                    head = self._queue[0] is entry
+                if head:
+                    wait = await self._call(self.store.take, costs, self._floor(priority))
+                    if wait == 0:
+                        return self._done(priority, "admitted", started)
+                    if time.monotonic() + wait > deadline:
+                        return self._done(priority, "shed", started)
+                else:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        return self._done(priority, "timeout", started)
+                try:
+                    await asyncio.wait_for(changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+            self._leave(entry)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "timeouts": self.timeouts,
+        }
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+最近一次純文字回答的短期快取
+使用者點「🖼️ 附圖回覆」時沿用剛才的回答與繪圖提示詞，不必再問一次 AI，也不再扣次數。
+每個回答只沿用一次，重複點選時照一般流程扣次數，不會免費重新生成圖片。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class RecentAnswer:
+    """
+    reply / image_prompt 為 AI 回答；image_prediction 為預先生成圖片的 prediction id（可為 None）
+    """
+
+    __slots__ = ("reply", "image_prompt", "image_prediction", "expires")
+
+    def __init__(self, reply: str, image_prompt: str, image_prediction=None):
+        self.reply = reply
+        self.image_prompt = image_prompt
+        self.image_prediction = image_prediction
+        self.expires = 0.0
+
+
+class RecentAnswerCache:
+    """
+    以 (user_id, 問題) 為鍵，保留 ttl 秒，最多 max_entries 筆
+    """
+
+    def __init__(self, ttl: float = 600.0, max_entries: int = 5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, user_id: str, question: str, answer: RecentAnswer):
+        answer.expires = time.monotonic() + self.ttl
+        key = (user_id, question.strip())
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = answer
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, user_id: str, question: str) -> RecentAnswer:
+        """
+        取出並移除回答，沒有或已過期時回傳 None
+        """
+        key = (user_id, question.strip())
+        with self._lock:
+            answer = self._entries.pop(key, None)
+            if answer is not None and answer.expires <= time.monotonic():
+                answer = None
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return answer
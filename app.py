@@ -6,10 +6,14 @@ AI 命理大師 Line Bot
 """
 
 import os
-import json
 import re
+import time
+import atexit
 import random
-from flask import Flask, request, abort
+import contextlib
+import contextvars
+from urllib.parse import urlencode
+from flask import Flask, request, abort, send_from_directory, Response
 from dotenv import load_dotenv
 
 # Line Bot SDK
@@ -19,6 +23,8 @@ from linebot.v3.messaging import (
     ApiClient,
     MessagingApi,
     ReplyMessageRequest,
+    PushMessageRequest,
+    ApiException,
     TextMessage,
     ImageMessage,
     QuickReply,
@@ -33,11 +39,86 @@ from linebot.v3.webhooks import (
 from linebot.v3.exceptions import InvalidSignatureError
 
 # OpenAI
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 
 # Replicate (圖片生成)
 import replicate
 
+# 背景工作佇列
+from job_queue import JobQueue
+
+# 執行統計
+from metrics import Metrics
+
+# 結構化日誌
+from structured_logging import EventLogger, event_id, parse_sample_rates, request_id, setup_logging
+
+# 每日共用快取
+from daily_cache import DailyCache, DailyWarmer, taipei_now, taipei_today
+
+# 每日內容包（python content_pack.py build 產生）
+from content_pack import ContentPacks
+
+# 相同請求合併
+from singleflight import SingleFlight, flight_key
+
+# 星座配對結果表
+from match_store import MatchStore
+
+# LLM 呼叫閘道
+from llm_gateway import LLMGateway, CircuitBreaker
+
+# 上游准入控制（RPM / TPM 與 VIP 優先）
+from admission import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_FREE,
+    PRIORITY_NAMES,
+    PRIORITY_VIP,
+    AdmissionController,
+    make_bucket_store,
+)
+
+# 每日使用次數儲存
+from quota_store import make_quota_store
+
+# 塔羅選牌狀態儲存
+from session_store import TarotSession, make_session_store
+
+# 已處理的 Webhook 事件
+from idempotency_store import make_idempotency_store
+
+# Reply Token 期限（來不及時先回「解讀中」）
+from reply_deadline import InterimScheduler, ReplyWindow
+
+# 訊息意圖判斷
+from intent_router import Intent, IntentRouter
+
+# 塔羅牌圖庫
+from card_images import CardImageLibrary
+
+# 塔羅解讀預先計算
+from tarot_speculation import TarotSpeculator
+
+# 最近回答快取
+from answer_cache import RecentAnswer, RecentAnswerCache
+
+# 圖片快取
+from image_store import ImageStore, image_key
+
+# 圖片生成設定檔
+from image_profiles import ImageProfile, ProfileSelector, RenderStats
+
+# 非同步圖片生成追蹤
+from image_predictions import (
+    PredictionSweeper,
+    PredictionTracker,
+    prediction_image_url,
+    prediction_seconds,
+    verify_webhook_token,
+    webhook_token,
+)
+
 # ===== 載入環境變數 =====
 load_dotenv()
 
@@ -45,16 +126,258 @@ LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")  # 使用 redis 後端時的共用連線
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "")  # 對外 HTTPS 網址，例如 https://xxx.onrender.com
+
+# ===== 日誌（需在第一次使用 app.logger 之前設定）=====
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json / text
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "webhook=0.1,message=0.1,reply=0.1")  # 各事件類型的抽樣比例
+LOG_TEXT_LIMIT = int(os.getenv("LOG_TEXT_LIMIT", 200))  # 每個欄位最多輸出的字數
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))  # 待輸出紀錄上限，超過時丟棄
+LOG_MESSAGE_TEXT = os.getenv("LOG_MESSAGE_TEXT", "0") == "1"  # 是否記錄使用者訊息內容
+
+log_handler = setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_TEXT_LIMIT, LOG_QUEUE_SIZE)
 
 # ===== 初始化 Flask 應用程式 =====
 app = Flask(__name__)
 
+# 熱路徑上的事件紀錄（依類型抽樣）；警告與錯誤仍用 app.logger
+event_log = EventLogger(app.logger, parse_sample_rates(LOG_SAMPLE))
+
+# ===== 執行統計（/metrics）=====
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # 設定後 /metrics 需帶 Authorization: Bearer <token>
+ROUTE_TIMING_SAMPLE = float(os.getenv("ROUTE_TIMING_SAMPLE", 0.01))  # 意圖判斷耗時的抽樣比例（判斷本身只要幾微秒）
+
+metrics = Metrics(prefix="fortune_")
+metrics.describe("stage_seconds", "各階段耗時（秒），依 stage 與 mode 區分")
+metrics.describe("image_render_seconds", "圖片從建立預測到完成的耗時（秒）")
+metrics.describe("llm_calls_total", "LLM 呼叫次數，依 mode 與結果區分")
+metrics.describe("llm_tokens_total", "LLM token 用量")
+metrics.describe("line_send_errors_total", "Messaging API 送出失敗次數")
+metrics.describe("webhook_redeliveries_total", "LINE 重送的事件數")
+metrics.describe("webhook_duplicates_total", "已處理過而略過的重複事件數")
+metrics.describe(
+    "reply_path_total",
+    "正式回覆的送達方式：reply、interim_push（先回解讀中再 Push）、push（Reply Token 已過期）、"
+    "fallback_push（Reply 失敗改 Push）、failed"
+)
+metrics.describe("admission_total", "取得上游額度的結果，outcome 為 admitted / shed / timeout / busy（收到訊息時就回覆忙碌中）")
+metrics.describe("admission_wait_seconds", "排隊取得上游額度的秒數")
+metrics.describe("quota_refunds_total", "讀取沒有成功而退還的次數")
+metrics.describe("reply_interim_total", "先回「解讀中」的次數，reason 為 timer（等太久）或 budget（下一個階段來不及）")
+
+# 目前事件的統計標籤，判斷出回覆模式後補上 mode
+event_labels = contextvars.ContextVar("event_labels", default=None)
+
+# 目前事件的 Reply Token 期限
+reply_window = contextvars.ContextVar("reply_window", default=None)
+
+# 目前事件取得上游額度的優先順序（不在事件中的背景工作最後）
+event_priority = contextvars.ContextVar("event_priority", default=PRIORITY_BACKGROUND)
+
+# 目前事件已扣的次數 [(user_id, 日期)]，讀取沒有成功時退還
+quota_charges = contextvars.ContextVar("quota_charges", default=None)
+
 # ===== 初始化 Line Bot =====
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", 10))  # 保持連線的 HTTP 連線數
+LINE_TIMEOUT = float(os.getenv("LINE_TIMEOUT", 10))  # 每次呼叫 Messaging API 的逾時秒數
+LINE_API_BASE_URL = os.getenv("LINE_API_BASE_URL", "https://api.line.me")  # 測試時可指向假伺服器
+
+configuration = Configuration(host=LINE_API_BASE_URL, access_token=LINE_CHANNEL_ACCESS_TOKEN)
+configuration.connection_pool_maxsize = LINE_POOL_SIZE
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+# 整個行程共用一個 ApiClient（urllib3 連線池可跨執行緒使用並保持連線）
+line_api_client = ApiClient(configuration)
+messaging_api = MessagingApi(line_api_client)
+atexit.register(line_api_client.close)
+
+# Reply Token 有效期限（秒），超過後改用 Push 訊息
+REPLY_TOKEN_TTL = int(os.getenv("REPLY_TOKEN_TTL", 50))
+REPLY_INTERIM_AFTER = float(os.getenv("REPLY_INTERIM_AFTER", 0))  # 超過幾秒仍未回覆就先回「解讀中」（0：只在快過期時）
+REPLY_INTERIM_MARGIN = float(os.getenv("REPLY_INTERIM_MARGIN", 3))  # Reply Token 過期前幾秒一定先回「解讀中」
+
+interim_scheduler = InterimScheduler()
+
+# ===== 上游准入控制（依帳號的 RPM / TPM 排隊，VIP 優先）=====
+ADMISSION_BACKEND = os.getenv("ADMISSION_BACKEND", "memory")  # memory / sqlite / redis（多個 worker 共用額度）
+ADMISSION_SQLITE_PATH = os.getenv("ADMISSION_SQLITE_PATH", "admission.db")
+ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", 10))  # 桶的容量（可瞬間用掉幾秒的額度）
+ADMISSION_RESERVE = float(os.getenv("ADMISSION_RESERVE", 0.1))  # 每低一個優先順序須留給前面的容量比例
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", 5))  # 最多排隊秒數，預估超過時直接回覆忙碌中
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", 500))  # OpenAI 帳號每分鐘請求數（0 不限制）
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", 200000))  # OpenAI 帳號每分鐘 token 數（0 不限制）
+REPLICATE_RPM = int(os.getenv("REPLICATE_RPM", 600))  # Replicate 每分鐘建立預測數（0 不限制）
+
+
+def record_admission(name: str, priority: int, outcome: str, waited: float):
+    """
+    記錄每次取得上游額度的結果與等待時間
+    """
+    priority_name = PRIORITY_NAMES.get(priority, str(priority))
+    metrics.inc("admission_total", upstream=name, priority=priority_name, outcome=outcome)
+    metrics.observe("admission_wait_seconds", waited, upstream=name, priority=priority_name)
+
+
+bucket_store = make_bucket_store(ADMISSION_BACKEND, sqlite_path=ADMISSION_SQLITE_PATH, redis_url=REDIS_URL)
+llm_admission = AdmissionController(
+    "openai",
+    bucket_store,
+    {"requests": OPENAI_RPM, "tokens": OPENAI_TPM},
+    burst=ADMISSION_BURST,
+    reserve=ADMISSION_RESERVE,
+    max_wait=ADMISSION_MAX_WAIT,
+    observer=record_admission
+)
+image_admission = AdmissionController(
+    "replicate",
+    bucket_store,
+    {"requests": REPLICATE_RPM},
+    burst=ADMISSION_BURST,
+    reserve=ADMISSION_RESERVE,
+    max_wait=ADMISSION_MAX_WAIT,
+    observer=record_admission
+)
+
+# 一定會呼叫 OpenAI 的模式，額度排不進去時直接回覆忙碌中（其他模式多半有共用快取）
+UPSTREAM_MODES = {"text_only", "full", "dream", "number"}
+
 # ===== 初始化 OpenAI =====
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # 未設定時使用官方 API；測試時可指向假伺服器
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 20))  # 預設每次請求的時間預算（秒，含重試）
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", 3))  # 可重試錯誤的最多嘗試次數
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 16))  # 每個行程同時呼叫上限
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))  # 連續失敗幾次後斷路
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", 30))  # 斷路後幾秒再試探
+
+# 各模式的時間預算（秒），使用者等待中的模式較短
+LLM_MODE_TIMEOUTS = {
+    "text_only": 12.0,
+    "full": 15.0,
+    "tarot": 15.0,
+    "dream": 15.0,
+    "number": 15.0,
+    "content_pack": 120.0,  # 離線建立內容包，一次生成多個對象
+}
+
+def record_llm_call(mode: str, outcome: str, usage):
+    """
+    記錄每次 LLM 呼叫的結果與 token 用量
+    """
+    metrics.inc("llm_calls_total", mode=mode, outcome=outcome)
+    if usage is not None:
+        metrics.inc("llm_tokens_total", usage.prompt_tokens or 0, mode=mode, kind="prompt")
+        metrics.inc("llm_tokens_total", usage.completion_tokens or 0, mode=mode, kind="completion")
+
+
+# 重複使用連線，並由閘道自行處理重試
+openai_client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    base_url=OPENAI_BASE_URL,
+    max_retries=0,
+    http_client=DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONCURRENCY,
+            max_keepalive_connections=LLM_MAX_CONCURRENCY
+        )
+    )
+)
+
+llm_gateway = LLMGateway(
+    openai_client,
+    model=LLM_MODEL,
+    timeouts=LLM_MODE_TIMEOUTS,
+    default_timeout=LLM_TIMEOUT,
+    max_attempts=LLM_MAX_ATTEMPTS,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    breaker=CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET),
+    observer=record_llm_call,
+    admission=llm_admission
+)
+
+# 同時間相同的提示詞只呼叫一次 OpenAI
+llm_flight = SingleFlight()
+
+# ===== 初始化 Replicate =====
+REPLICATE_BASE_URL = os.getenv("REPLICATE_BASE_URL", "https://api.replicate.com")
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", 120))  # 圖片預測逾時秒數，逾時取消並通知使用者
+IMAGE_SWEEP_INTERVAL = float(os.getenv("IMAGE_SWEEP_INTERVAL", 5))  # 檢查逾時（無 Webhook 時輪詢）的間隔秒數
+IMAGE_WEBHOOK_SECRET = os.getenv("IMAGE_WEBHOOK_SECRET") or LINE_CHANNEL_SECRET or ""
+
+SDXL_VERSION = "39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b"
+
+# 圖片生成設定檔：quality 為完整畫質，fast 降低解析度與步數（約快 3 倍）
+IMAGE_PROFILES = {
+    "quality": ImageProfile("quality", SDXL_VERSION, {
+        "width": 1024,
+        "height": 1024,
+        "num_outputs": 1,
+        "scheduler": "K_EULER",
+        "num_inference_steps": 25,
+        "guidance_scale": 7.5,
+        "negative_prompt": "ugly, blurry, low quality, distorted"
+    }),
+    "fast": ImageProfile("fast", SDXL_VERSION, {
+        "width": 768,
+        "height": 768,
+        "num_outputs": 1,
+        "scheduler": "K_EULER",
+        "num_inference_steps": 15,
+        "guidance_scale": 7.5,
+        "negative_prompt": "ugly, blurry, low quality, distorted"
+    }),
+}
+
+# 一般使用者各模式使用的設定檔，VIP 一律使用 IMAGE_PROFILE_VIP
+IMAGE_MODE_PROFILES = {
+    "full": os.getenv("IMAGE_PROFILE_FULL", "quality"),
+    "tarot": os.getenv("IMAGE_PROFILE_TAROT", "fast"),  # 圖庫中沒有的牌
+}
+IMAGE_PROFILE_VIP = os.getenv("IMAGE_PROFILE_VIP", "quality")
+IMAGE_P95_BUDGET = float(os.getenv("IMAGE_P95_BUDGET", 30))  # 最近生成耗時 p95 超過此秒數時降級為 fast（0 不降級）
+
+image_render_stats = RenderStats()
+image_profiles = ProfileSelector(
+    IMAGE_PROFILES,
+    IMAGE_MODE_PROFILES,
+    default="quality",
+    vip_profile=IMAGE_PROFILE_VIP,
+    fallback="fast",
+    budget=IMAGE_P95_BUDGET,
+    stats=image_render_stats
+)
+
+replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN, base_url=REPLICATE_BASE_URL)
+
+# 建立預測後立即返回，完成時由 /replicate/webhook 推播圖片
+image_tracker = PredictionTracker(timeout=IMAGE_TIMEOUT)
+
+# 生成結果以內容定址快取在本機，由 /images 提供原圖與預覽
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_cache")
+IMAGE_STORE_MAX_MB = float(os.getenv("IMAGE_STORE_MAX_MB", 500))  # 磁碟用量上限，超過時淘汰最久沒用到的
+IMAGE_PREVIEW_SIZE = int(os.getenv("IMAGE_PREVIEW_SIZE", 240))  # 預覽圖最長邊像素
+
+image_store = ImageStore(IMAGE_STORE_DIR, PUBLIC_BASE_URL, int(IMAGE_STORE_MAX_MB * 1024 * 1024), IMAGE_PREVIEW_SIZE)
+image_store.load()
+
+# ===== 初始化背景工作佇列 =====
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 8))  # 同時處理的事件數
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 200))  # 等待中事件上限，超過回 503
+JOB_DRAIN_TIMEOUT = float(os.getenv("JOB_DRAIN_TIMEOUT", 25))  # 關閉時等待清空的秒數
+
+job_queue = JobQueue(workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE, name="webhook")
+atexit.register(job_queue.shutdown, JOB_DRAIN_TIMEOUT)
+
+# ===== 初始化每日共用快取 =====
+DAILY_WARMUP = os.getenv("DAILY_WARMUP", "0") == "1"  # 是否在午夜後預先生成當日內容
+DAILY_WARMUP_DELAY = float(os.getenv("DAILY_WARMUP_DELAY", 60))  # 午夜後延遲幾秒開始預熱
+CONTENT_PACK_DIR = os.getenv("CONTENT_PACK_DIR", "content_packs")  # 事先建好的每日內容包，有當天的檔案時不呼叫 LLM
+CONTENT_PACK_MAX_TOKENS = int(os.getenv("CONTENT_PACK_MAX_TOKENS", 4000))  # 建立內容包時一次生成多個對象的回覆上限
+
+content_packs = ContentPacks(CONTENT_PACK_DIR)
+daily_cache = DailyCache(content_packs)
 
 # ===== 歡迎訊息 =====
 WELCOME_MESSAGE = """🔮 歡迎來到【玄天上師】命理殿堂
@@ -101,7 +424,7 @@ HELP_MESSAGE = """📖 【玄天上師】完整功能說明
 ━━━━ 一般問答 ━━━━
 🌟 直接提問 → 直接輸入問題
 🖼️ 附圖回覆 → 「要圖 問題」
-   ⚠️ 需等待 15-20 秒
+   ⚠️ 圖片約 15-20 秒後送達
 
 ━━━━━━━━━━━━━━━━
 🆓 每日免費 3 次，明日重置
@@ -116,6 +439,13 @@ TAROT_CARDS = [
     "高塔", "星星", "月亮", "太陽", "審判", "世界"
 ]
 
+# ===== 塔羅牌圖庫（python card_images.py build 產生）=====
+CARD_IMAGE_DIR = os.getenv("CARD_IMAGE_DIR", "static/cards")
+CARD_IMAGE_STRATEGY = os.getenv("CARD_IMAGE_STRATEGY", "rotate")  # rotate 輪流 / random 隨機
+
+card_library = CardImageLibrary(CARD_IMAGE_DIR, PUBLIC_BASE_URL, CARD_IMAGE_STRATEGY)
+card_library.load()
+
 # ===== 星座定義 =====
 ZODIAC_SIGNS = [
     "牡羊座", "金牛座", "雙子座", "巨蟹座", "獅子座", "處女座",
@@ -295,15 +625,84 @@ NUMBER_PROMPT = """你是一位精通數字命理的大師「玄天上師」。
 
 請務必只回傳 JSON 格式。"""
 
+# ===== 星座配對結果表 =====
+MATCH_TABLE_PATH = os.getenv("MATCH_TABLE_PATH", "data/match_table.json")  # 預先生成的配對表
+MATCH_CACHE_TTL = float(os.getenv("MATCH_CACHE_TTL", 30 * 24 * 3600))  # 配對結果保留秒數
+
+match_store = MatchStore(ZODIAC_SIGNS, MATCH_CACHE_TTL)
+match_store.load(MATCH_TABLE_PATH)
+
+# ===== 最近回答快取（附圖回覆沿用純文字回答）=====
+IMAGE_FOLLOW_UP_PREFIX = "要圖 "  # 「🖼️ 附圖回覆」按鈕送出的前綴
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 600))  # 純文字回答保留秒數
+IMAGE_PRERENDER = os.getenv("IMAGE_PRERENDER", "off")  # 回覆文字時先開始生成圖片：off / vip / all
+
+recent_answers = RecentAnswerCache(ANSWER_CACHE_TTL)
+
 # ===== 錯誤回覆訊息 =====
 ERROR_MESSAGE = "🔮 天機訊號干擾中，請稍後再試。"
+IMAGE_PENDING_NOTE = "\n\n🖼️ 圖片生成中，完成後會另外傳送給你"
+IMAGE_FAILED_MESSAGE = "🖼️ 圖片生成失敗，請稍後再試。"
+BUSY_MESSAGE = "🙏 目前問卜的人太多，上師應接不暇，請過一兩分鐘再試（本次不扣次數）。"
+INTERIM_MESSAGE = "🔮 上師正在為你推演天機，解讀完成後會立即傳送給你，請稍候片刻…"
+
+# ===== 使用者狀態儲存（塔羅選牌中）=====
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory / sqlite / redis
+SESSION_TTL = float(os.getenv("SESSION_TTL", 600))  # 選牌狀態保留秒數
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 10000))  # 狀態數量上限
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.db")
+
+tarot_sessions = make_session_store(
+    SESSION_BACKEND,
+    ttl=SESSION_TTL,
+    max_entries=SESSION_MAX_ENTRIES,
+    sqlite_path=SESSION_SQLITE_PATH,
+    redis_url=REDIS_URL
+)
+
+# ===== 已處理的 Webhook 事件（LINE 重送時不重複處理）=====
+EVENT_DEDUP_BACKEND = os.getenv("EVENT_DEDUP_BACKEND", "memory")  # memory / sqlite / redis
+EVENT_DEDUP_TTL = float(os.getenv("EVENT_DEDUP_TTL", 86400))  # 事件 ID 保留秒數
+EVENT_DEDUP_MAX_ENTRIES = int(os.getenv("EVENT_DEDUP_MAX_ENTRIES", 100000))  # memory / sqlite 的筆數上限
+EVENT_DEDUP_SQLITE_PATH = os.getenv("EVENT_DEDUP_SQLITE_PATH", "events.db")
+
+processed_events = make_idempotency_store(
+    EVENT_DEDUP_BACKEND,
+    ttl=EVENT_DEDUP_TTL,
+    max_entries=EVENT_DEDUP_MAX_ENTRIES,
+    sqlite_path=EVENT_DEDUP_SQLITE_PATH,
+    redis_url=REDIS_URL
+)
 
-# ===== 使用者狀態儲存 =====
-user_states = {}
+# 圖片結果只推播一次的紀錄：有 Webhook 時完成通知可能由任一 worker 收到，memory 無法跨 worker，預設改用 sqlite
+IMAGE_PUSH_DEDUP_BACKEND = os.getenv(
+    "IMAGE_PUSH_DEDUP_BACKEND",
+    "sqlite" if PUBLIC_BASE_URL and EVENT_DEDUP_BACKEND == "memory" else EVENT_DEDUP_BACKEND
+)
+
+if IMAGE_PUSH_DEDUP_BACKEND == EVENT_DEDUP_BACKEND:
+    pushed_predictions = processed_events
+else:
+    pushed_predictions = make_idempotency_store(
+        IMAGE_PUSH_DEDUP_BACKEND,
+        ttl=EVENT_DEDUP_TTL,
+        max_entries=EVENT_DEDUP_MAX_ENTRIES,
+        sqlite_path=EVENT_DEDUP_SQLITE_PATH,
+        redis_url=REDIS_URL
+    )
+
+# 抽牌後在背景先算好三張牌的解讀：off / vip / all
+TAROT_SPECULATION = os.getenv("TAROT_SPECULATION", "off")
+TAROT_SPECULATION_MAX = int(os.getenv("TAROT_SPECULATION_MAX", 20))  # 同時預先計算的抽牌數上限
+
+tarot_speculator = TarotSpeculator(TAROT_SPECULATION, TAROT_SPECULATION_MAX, ttl=SESSION_TTL)
 
 # ===== 每日使用次數限制 =====
 DAILY_FREE_LIMIT = 3  # 每日免費次數
-user_usage = {}  # {user_id: {"date": "2024-02-01", "count": 3}}
+QUOTA_BACKEND = os.getenv("QUOTA_BACKEND", "memory")  # memory / sqlite / redis
+QUOTA_SQLITE_PATH = os.getenv("QUOTA_SQLITE_PATH", "quota.db")
+
+quota_store = make_quota_store(QUOTA_BACKEND, sqlite_path=QUOTA_SQLITE_PATH, redis_url=REDIS_URL)
 
 # ===== VIP 白名單（無限使用）=====
 VIP_USERS = [
@@ -312,43 +711,70 @@ VIP_USERS = [
 
 def check_usage_limit(user_id: str) -> tuple:
     """
-    檢查使用者是否超過每日限制
-    Returns: (是否可用, 剩餘次數, 是否VIP)
+    檢查並扣除使用者今日次數（原子操作，多個 worker 共用計數）
+    Returns: (是否可用, 扣除後剩餘次數, 是否VIP)
     """
     # VIP 用戶無限使用
     if user_id in VIP_USERS:
         return (True, 999, True)
     
-    from datetime import datetime
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    if user_id not in user_usage:
-        user_usage[user_id] = {"date": today, "count": 0}
-    
-    user_data = user_usage[user_id]
-    
-    # 如果是新的一天，重置次數
-    if user_data["date"] != today:
-        user_usage[user_id] = {"date": today, "count": 0}
-        user_data = user_usage[user_id]
-    
-    remaining = DAILY_FREE_LIMIT - user_data["count"]
-    return (remaining > 0, remaining, False)
+    today = taipei_today().isoformat()
+    can_use, remaining = quota_store.try_consume(user_id, today, DAILY_FREE_LIMIT)
+    charges = quota_charges.get()
+    if can_use and charges is not None:
+        charges.append((user_id, today))
+    return (can_use, remaining, False)
+
 
-def increment_usage(user_id: str):
+def refund_usage(user_id: str, day: str = None):
     """
-    增加使用者的使用次數
+    退還一次（讀取沒有成功時不算使用者的次數）
     """
-    from datetime import datetime
-    today = datetime.now().strftime("%Y-%m-%d")
-    
-    if user_id not in user_usage:
-        user_usage[user_id] = {"date": today, "count": 0}
-    
-    if user_usage[user_id]["date"] != today:
-        user_usage[user_id] = {"date": today, "count": 0}
+    if user_id in VIP_USERS:
+        return
+    try:
+        quota_store.refund(user_id, day or taipei_today().isoformat())
+    except Exception as e:
+        app.logger.error(f"退還次數失敗: {e}")
+        return
+    metrics.inc("quota_refunds_total")
+
+
+def charged_day(user_id: str) -> str:
+    """
+    目前事件替使用者扣次數的日期，沒有扣時回傳 None
+    """
+    for charged_user, day in quota_charges.get() or ():
+        if charged_user == user_id:
+            return day
+    return None
+
+
+def refund_event_usage():
+    """
+    退還目前事件扣的次數
+    """
+    charges = quota_charges.get()
+    while charges:
+        refund_usage(*charges.pop())
+
+
+def user_priority(user_id: str) -> int:
+    """
+    取得上游額度的優先順序：VIP 優先
+    """
+    return PRIORITY_VIP if user_id in VIP_USERS else PRIORITY_FREE
+
+def get_remaining_usage(user_id: str) -> tuple:
+    """
+    查詢剩餘次數（不扣除）
+    Returns: (剩餘次數, 是否VIP)
+    """
+    if user_id in VIP_USERS:
+        return (999, True)
     
-    user_usage[user_id]["count"] += 1
+    used = quota_store.used(user_id, taipei_today().isoformat())
+    return (max(0, DAILY_FREE_LIMIT - used), False)
 
 # 超過限制的提示訊息
 LIMIT_MESSAGE = """⚠️ 今日免費次數已用完
@@ -377,153 +803,294 @@ LIMIT_MESSAGE = """⚠️ 今日免費次數已用完
 """
 
 
-def ask_openai(user_message: str, system_prompt: str = MASTER_SYSTEM_PROMPT) -> dict:
+def ask_openai(user_message: str, system_prompt: str = MASTER_SYSTEM_PROMPT, mode: str = "text_only") -> dict:
     """
-    呼叫 OpenAI GPT 生成回覆
+    呼叫 OpenAI GPT 生成回覆（相同問題同時只送出一次）
     """
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0.8,
-            max_tokens=500
+    check_reply_budget(mode)
+    with metrics.span("llm", mode=mode):
+        return llm_flight.do(
+            flight_key(system_prompt, user_message),
+            lambda: llm_gateway.complete_json(system_prompt, user_message, mode=mode, priority=event_priority.get())
         )
-        
-        response_text = response.choices[0].message.content.strip()
-        
-        # 解析 JSON
-        cleaned_text = re.sub(r'^```json\s*', '', response_text)
-        cleaned_text = re.sub(r'\s*```$', '', cleaned_text)
-        
-        result = json.loads(cleaned_text)
-        return result
+
+
+def profile_image_key(profile: ImageProfile, prompt: str) -> str:
+    """
+    圖片快取的鍵
+    """
+    return image_key(profile.version, prompt, profile.params)
+
+
+def cached_image(prompt: str) -> tuple:
+    """
+    相同提示詞已生成過的圖片（任何設定檔皆可，畫質高的優先）
+    Returns: (原圖網址, 預覽網址)，沒有時回傳 None
+    """
+    for profile in IMAGE_PROFILES.values():
+        urls = image_store.urls(profile_image_key(profile, prompt))
+        if urls is not None:
+            return urls
+    return None
+
+
+def generate_image(prompt: str) -> str:
+    """
+    使用 Replicate 呼叫 SDXL 模型生成圖片並等待結果（僅供離線工具使用，例如建立塔羅牌圖庫）
+    """
+    profile = IMAGE_PROFILES["quality"]
+    try:
+        with metrics.span("image_generate", mode=profile.name):
+            output = replicate_client.run(
+                f"stability-ai/sdxl:{profile.version}",
+                input={"prompt": prompt, **profile.params}
+            )
+        return prediction_image_url(output)
     
     except Exception as e:
-        print(f"OpenAI 錯誤: {e}")
+        app.logger.error(f"Replicate 錯誤: {e}")
         return None
 
 
-def generate_image(prompt: str) -> str:
+def image_webhook_url(user_id: str, push: bool, key: str) -> str:
     """
-    使用 Replicate 呼叫 SDXL 模型生成圖片
+    預測完成時 Replicate 呼叫的網址，未設定 PUBLIC_BASE_URL 時回傳 None（改由背景輪詢）
     """
-    try:
-        os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
-        
-        output = replicate.run(
-            "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
-            input={
-                "prompt": prompt,
-                "width": 1024,
-                "height": 1024,
-                "num_outputs": 1,
-                "scheduler": "K_EULER",
-                "num_inference_steps": 25,
-                "guidance_scale": 7.5,
-                "negative_prompt": "ugly, blurry, low quality, distorted"
-            }
-        )
-        
-        if output and len(output) > 0:
-            return str(output[0])
+    if not PUBLIC_BASE_URL:
+        return None
+    query = urlencode({
+        "user": user_id,
+        "push": int(push),
+        "key": key,
+        "token": webhook_token(IMAGE_WEBHOOK_SECRET, user_id, push, key)
+    })
+    return f"{PUBLIC_BASE_URL.rstrip('/')}/replicate/webhook?{query}"
+
+
+def image_request(user_id: str, prompt: str, push: bool, mode: str, is_vip: bool) -> tuple:
+    """
+    依模式與 VIP 選擇生成設定檔（最近生成太慢時自動降級），組出建立預測的參數
+    Returns: (設定檔, 圖片快取的鍵, predictions.create 的參數)
+    """
+    profile = image_profiles.choose(mode, is_vip)
+    key = profile_image_key(profile, prompt)
+    params = {"version": profile.version, "input": {"prompt": prompt, **profile.params}}
+    webhook = image_webhook_url(user_id, push, key)
+    if webhook:
+        params.update(webhook=webhook, webhook_events_filter=["completed"])
+    return (profile, key, params)
+
+
+def request_image(user_id: str, prompt: str, push: bool = True, mode: str = "full", is_vip: bool = False) -> str:
+    """
+    建立圖片生成預測後立即返回，不等待生成；push 為 True 時完成後推播給使用者
+    Returns: prediction id，建立失敗時回傳 None
+    """
+    profile, key, params = image_request(user_id, prompt, push, mode, is_vip)
+    
+    if not image_admission.acquire({"requests": 1}, user_priority(user_id)):
         return None
     
+    try:
+        with metrics.span("image_create", mode=mode, profile=profile.name):
+            prediction = replicate_client.predictions.create(**params)
     except Exception as e:
-        print(f"Replicate 錯誤: {e}")
+        app.logger.error(f"Replicate 錯誤: {e}")
         return None
+    
+    image_tracker.add(prediction.id, user_id, push, key, profile.name)
+    return prediction.id
 
 
-def get_reply_mode(message: str) -> tuple:
+def claim_prediction_push(prediction_id: str) -> bool:
     """
-    判斷使用者要的回覆模式
-    Returns: (mode, extra_data)
+    登記推播一個預測的結果，已登記過（Replicate 重送通知、或已由其他 worker 推播）時回傳 False
     """
-    # 說明/幫助
-    if any(keyword in message for keyword in ["說明", "幫助", "help", "指令", "怎麼用"]):
-        return ("help", None)
+    return pushed_predictions.claim(f"prediction:{prediction_id}")
+
+
+def finish_prediction(prediction_id: str, status: str, output, user_id: str = None, push: bool = False,
+                      key: str = None, elapsed: float = None):
+    """
+    預測完成：存入圖片快取，推播圖片或失敗訊息。
+    不在本行程追蹤中的預測（例如由其他 worker 建立）依 Webhook 網址帶的 user_id / push / key 處理；
+    elapsed 為 Replicate 回報的生成耗時，未提供時以本行程建立預測的時間計算
+    """
+    image_url = prediction_image_url(output) if status == "succeeded" else None
+    record = image_tracker.complete(prediction_id, image_url)
+    if record is not None:
+        user_id, push, key = record.user_id, record.push, record.image_key
+        if image_url:
+            if elapsed is None:
+                elapsed = time.monotonic() - record.started
+            image_render_stats.record(record.profile, elapsed)
+            metrics.observe("image_render_seconds", elapsed, profile=record.profile)
+    elif image_tracker.is_expired(prediction_id):
+        return
     
-    # 每日幸運指數
-    if any(keyword in message for keyword in ["今日運勢", "今天運勢", "每日運勢", "今天運氣", "幸運指數"]):
-        return ("daily_fortune", None)
+    # 只下載一次，之後相同提示詞直接使用，並由本服務提供原圖與小尺寸預覽
+    urls = None
+    if image_url and key:
+        urls = image_store.fetch(key, image_url)
     
-    # 抽籤詩
-    if any(keyword in message for keyword in ["抽籤", "求籤", "籤詩", "抽個籤"]):
-        return ("fortune_stick", None)
+    if not push or not user_id or not claim_prediction_push(prediction_id):
+        return
     
-    # 黃曆
-    if any(keyword in message for keyword in ["黃曆", "黃歷", "宜忌", "今日宜"]):
-        return ("almanac", None)
+    if image_url:
+        original_url, preview_url = urls or (image_url, image_url)
+        messages = [ImageMessage(original_content_url=original_url, preview_image_url=preview_url)]
+    else:
+        messages = [TextMessage(text=IMAGE_FAILED_MESSAGE)]
+    push_messages(user_id, messages)
+
+
+def sweep_predictions():
+    """
+    向 Replicate 查詢預測狀態，取消逾時的預測並通知使用者
+    沒有 Webhook 時輪詢所有進行中的預測；有 Webhook 時完成通知可能由其他 worker 收到，
+    只查詢已逾時、以及建立時不推播但之後被使用者要求的預測（Webhook 網址帶的是不推播）。
+    只有 Replicate 確認仍在生成或已失敗的預測才計入逾時
+    """
+    now = time.monotonic()
+    running = set()
+    for record in image_tracker.pending():
+        if PUBLIC_BASE_URL and record.deadline > now and record.push == record.webhook_push:
+            continue
+        try:
+            prediction = replicate_client.predictions.get(record.prediction_id)
+        except Exception as e:
+            app.logger.error(f"查詢預測失敗: {e}")
+            continue
+        if prediction.status not in ("succeeded", "failed", "canceled"):
+            running.add(record.prediction_id)
+            continue
+        if prediction.status != "succeeded" and record.deadline <= now:
+            image_render_stats.record(record.profile, IMAGE_TIMEOUT)
+        elapsed = prediction_seconds(
+            getattr(prediction, "created_at", None), getattr(prediction, "completed_at", None)
+        )
+        finish_prediction(prediction.id, prediction.status, prediction.output, elapsed=elapsed)
     
+    for record in image_tracker.expire():
+        if record.done:
+            continue
+        if record.prediction_id in running:
+            image_render_stats.record(record.profile, IMAGE_TIMEOUT)
+        try:
+            replicate_client.predictions.cancel(record.prediction_id)
+        except Exception as e:
+            app.logger.error(f"取消預測失敗: {e}")
+        if record.push and claim_prediction_push(record.prediction_id):
+            push_messages(record.user_id, [TextMessage(text=IMAGE_FAILED_MESSAGE)])
+
+
+def extract_dream(message: str, keyword: str):
+    dream_content = message.replace("解夢", "").strip()
+    return dream_content if dream_content else None
+
+
+def extract_number(message: str, keyword: str):
+    # 嘗試提取數字
+    numbers = re.findall(r'\d+', message)
+    return numbers[0] if numbers else None
+
+
+def extract_message(message: str, keyword: str):
+    return message
+
+
+def extract_keyword(message: str, keyword: str):
+    return keyword
+
+
+def extract_chinese_zodiac(message: str, keyword: str):
+    # 「屬龍」取最後一字，單獨輸入「龍」時即為本身
+    return keyword[-1]
+
+
+# ===== 意圖表（priority 越小越優先，新增意圖不會拖慢判斷）=====
+REPLY_INTENTS = [
+    # 說明/幫助
+    Intent("help", ("說明", "幫助", "help", "指令", "怎麼用"), 0),
+    # 每日幸運指數
+    Intent("daily_fortune", ("今日運勢", "今天運勢", "每日運勢", "今天運氣", "幸運指數"), 1),
+    # 抽籤詩
+    Intent("fortune_stick", ("抽籤", "求籤", "籤詩", "抽個籤"), 2),
+    # 黃曆
+    Intent("almanac", ("黃曆", "黃歷", "宜忌", "今日宜"), 3),
     # 解夢
-    if "解夢" in message:
-        dream_content = message.replace("解夢", "").strip()
-        return ("dream", dream_content if dream_content else None)
-    
+    Intent("dream", ("解夢",), 4, extract_dream),
     # 配對測試
-    if any(keyword in message for keyword in ["配對", "速配", "合不合"]):
-        return ("match", message)
-    
+    Intent("match", ("配對", "速配", "合不合"), 5, extract_message),
     # 數字占卜
-    if "數字" in message:
-        # 嘗試提取數字
-        numbers = re.findall(r'\d+', message)
-        return ("number", numbers[0] if numbers else None)
-    
-    # 星座運勢
-    for sign in ZODIAC_SIGNS:
-        if sign in message:
-            return ("zodiac", sign)
-    
+    Intent("number", ("數字",), 6, extract_number),
+    # 星座運勢（多個星座時取 ZODIAC_SIGNS 中排在前面的）
+    Intent("zodiac", tuple(ZODIAC_SIGNS), 7, extract_keyword),
     # 生肖運勢
-    for zodiac in CHINESE_ZODIAC:
-        if f"屬{zodiac}" in message or zodiac == message:
-            return ("chinese_zodiac", zodiac)
-    
+    Intent(
+        "chinese_zodiac",
+        tuple(f"屬{zodiac}" for zodiac in CHINESE_ZODIAC),
+        8,
+        extract_chinese_zodiac,
+        exact=tuple(CHINESE_ZODIAC)
+    ),
     # 塔羅牌模式
-    if any(keyword in message for keyword in ["抽牌", "塔羅", "占卜", "抽卡"]):
-        return ("tarot", message)
-    
+    Intent("tarot", ("抽牌", "塔羅", "占卜", "抽卡"), 9, extract_message),
     # 圖文模式
-    if any(keyword in message for keyword in ["要圖", "圖文", "完整", "附圖"]):
-        return ("full", message)
-    
-    # 預設：純文字（較快）
-    return ("text_only", message)
+    Intent("full", ("要圖", "圖文", "完整", "附圖"), 10, extract_message),
+]
+
+# 預設：純文字（較快）
+reply_router = IntentRouter(REPLY_INTENTS, default_mode="text_only")
+
 
+def get_reply_mode(message: str) -> tuple:
+    """
+    判斷使用者要的回覆模式
+    Returns: (mode, extra_data)
+    """
+    # 只抽樣量測：span 的成本比判斷本身還高
+    if random.random() >= ROUTE_TIMING_SAMPLE:
+        mode, extra_data = reply_router.classify(message)
+    else:
+        started = time.perf_counter()
+        mode, extra_data = reply_router.classify(message)
+        metrics.observe("stage_seconds", time.perf_counter() - started, stage="route", mode=mode)
+    tag_event(mode)
+    return (mode, extra_data)
 
-def get_daily_fortune() -> dict:
+
+def get_daily_fortune(day=None, user_id: str = "") -> dict:
+    """
+    取得每日幸運指數：內容包中有多個版本時依使用者固定挑一個，否則同一天所有使用者共用
+    """
+    day = day or taipei_today()
+    fortune = content_packs.pick("daily_fortune", user_id, day)
+    if fortune is not None:
+        return fortune
+    return daily_cache.get_or_compute(
+        "daily_fortune", None,
+        lambda: llm_flight.do(
+            flight_key(DAILY_FORTUNE_PROMPT, day.isoformat()),
+            lambda: generate_daily_fortune(day)
+        ),
+        day
+    )
+
+
+def generate_daily_fortune(day) -> dict:
     """
     呼叫 OpenAI 生成每日幸運指數
     """
-    try:
-        from datetime import datetime
-        today = datetime.now().strftime("%Y年%m月%d日")
-        
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": DAILY_FORTUNE_PROMPT},
-                {"role": "user", "content": f"請為今天（{today}）生成運勢"}
-            ],
-            temperature=0.9,
-            max_tokens=400
-        )
-        
-        response_text = response.choices[0].message.content.strip()
-        
-        # 解析 JSON
-        cleaned_text = re.sub(r'^```json\s*', '', response_text)
-        cleaned_text = re.sub(r'\s*```$', '', cleaned_text)
-        
-        result = json.loads(cleaned_text)
-        return result
-    
-    except Exception as e:
-        print(f"每日運勢錯誤: {e}")
-        return None
+    today = day.strftime("%Y年%m月%d日")
+    return llm_gateway.complete_json(
+        DAILY_FORTUNE_PROMPT,
+        f"請為今天（{today}）生成運勢",
+        mode="daily_fortune",
+        temperature=0.9,
+        max_tokens=400,
+        priority=event_priority.get()
+    )
 
 
 def format_stars(count: int) -> str:
@@ -535,153 +1102,170 @@ def format_stars(count: int) -> str:
 
 def draw_three_cards() -> list:
     """
-    抽三張不重複的塔羅牌
+    抽三張不重複的塔羅牌（回傳 TAROT_CARDS 的索引）
     """
-    return random.sample(TAROT_CARDS, 3)
+    return random.sample(range(len(TAROT_CARDS)), 3)
 
 
-def ask_ai_simple(prompt: str, system_prompt: str) -> dict:
+def ask_ai_simple(prompt: str, system_prompt: str, mode: str = "default") -> dict:
     """
-    通用 AI 呼叫函數
+    通用 AI 呼叫函數（相同提示詞同時只送出一次）
     """
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.8,
-            max_tokens=500
+    check_reply_budget(mode)
+    with metrics.span("llm", mode=mode):
+        return llm_flight.do(
+            flight_key(system_prompt, prompt),
+            lambda: llm_gateway.complete_json(system_prompt, prompt, mode=mode, priority=event_priority.get())
         )
-        
-        response_text = response.choices[0].message.content.strip()
-        cleaned_text = re.sub(r'^```json\s*', '', response_text)
-        cleaned_text = re.sub(r'\s*```$', '', cleaned_text)
-        
-        return json.loads(cleaned_text)
-    except Exception as e:
-        print(f"AI 錯誤: {e}")
-        return None
 
 
-def get_remaining_text(remaining: int, is_vip: bool) -> str:
+def get_almanac(day=None) -> dict:
     """
-    取得剩餘次數文字
+    取得今日黃曆（同一天所有使用者共用）
     """
-    if is_vip:
-        return "\n\n━━━━━━━━━━━━━━━━\n👑 VIP 無限使用中"
-    else:
-        return f"\n\n━━━━━━━━━━━━━━━━\n📊 今日剩餘免費次數：{remaining} 次"
+    day = day or taipei_today()
+    today = day.strftime("%m月%d日")
+    return daily_cache.get_or_compute(
+        "almanac", None,
+        lambda: ask_ai_simple(f"請提供今天（{today}）的黃曆", ALMANAC_PROMPT, mode="almanac"),
+        day
+    )
 
 
-# ===== Line Webhook 端點 =====
-@app.route("/callback", methods=["POST"])
-def callback():
-    signature = request.headers.get("X-Line-Signature", "")
-    body = request.get_data(as_text=True)
-    app.logger.info(f"收到請求: {body}")
-    
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        app.logger.error("簽章驗證失敗")
-        abort(400)
-    
-    return "OK"
+def get_zodiac_fortune(sign: str, day=None) -> dict:
+    """
+    取得星座今日運勢（同一天所有使用者共用）
+    """
+    day = day or taipei_today()
+    return daily_cache.get_or_compute(
+        "zodiac", sign,
+        lambda: ask_ai_simple(f"請提供{sign}今日運勢", ZODIAC_PROMPT, mode="zodiac"),
+        day
+    )
 
 
-# ===== 歡迎訊息（加入好友時觸發）=====
-@handler.add(FollowEvent)
-def handle_follow(event: FollowEvent):
+def get_chinese_zodiac_fortune(zodiac: str, day=None) -> dict:
     """
-    當使用者加入好友時，發送歡迎訊息
+    取得生肖今日運勢（同一天所有使用者共用）
     """
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=WELCOME_MESSAGE)]
-            )
-        )
+    day = day or taipei_today()
+    return daily_cache.get_or_compute(
+        "chinese_zodiac", zodiac,
+        lambda: ask_ai_simple(f"請提供生肖{zodiac}今日運勢", CHINESE_ZODIAC_PROMPT, mode="chinese_zodiac"),
+        day
+    )
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_text_message(event: MessageEvent):
+BATCH_PROMPT_SUFFIX = """
+
+這次請一次提供以下每一項：{entities}
+回傳一個 JSON 物件，鍵為上列每一項的名稱，值為上述格式的 JSON，各項內容要彼此不同。
+請務必只回傳 JSON 格式。"""
+
+
+def ask_ai_batch(system_prompt: str, prompt: str, entities: list) -> dict:
     """
-    處理文字訊息事件
+    一次呼叫取得多個對象的回覆（建立內容包用），回傳 {對象: 回覆}，缺少或格式不對的對象不列入
     """
-    user_id = event.source.user_id
-    user_message = event.message.text.strip()
-    app.logger.info(f"使用者 {user_id} 訊息: {user_message}")
-    
-    # 檢查是否在選牌階段
-    if user_id in user_states and user_states[user_id].get("mode") == "selecting":
-        handle_card_selection(event, user_id, user_message)
-        return
-    
-    # 判斷回覆模式
-    mode, extra_data = get_reply_mode(user_message)
-    
-    # 免費功能（不計次數）
-    if mode == "help":
-        reply_with_quick_actions(event, HELP_MESSAGE)
-        return
-    
-    # 付費功能（檢查次數限制）
-    can_use, remaining, is_vip = check_usage_limit(user_id)
-    
-    if not can_use:
-        # 超過限制，顯示提示
-        reply_with_quick_actions(event, LIMIT_MESSAGE)
-        return
-    
-    # VIP 用戶不計次數，一般用戶增加次數
-    if not is_vip:
-        increment_usage(user_id)
-        remaining = remaining - 1
-    
-    # 執行功能
-    if mode == "daily_fortune":
-        handle_daily_fortune(event, remaining, is_vip)
-    elif mode == "fortune_stick":
-        handle_fortune_stick(event, remaining, is_vip)
-    elif mode == "almanac":
-        handle_almanac(event, remaining, is_vip)
-    elif mode == "dream":
-        handle_dream(event, extra_data, remaining, is_vip)
-    elif mode == "zodiac":
-        handle_zodiac(event, extra_data, remaining, is_vip)
-    elif mode == "chinese_zodiac":
-        handle_chinese_zodiac(event, extra_data, remaining, is_vip)
-    elif mode == "match":
-        handle_match(event, extra_data, remaining, is_vip)
-    elif mode == "number":
-        handle_number(event, extra_data, remaining, is_vip)
-    elif mode == "tarot":
-        start_tarot_reading(event, user_id, user_message, remaining, is_vip)
-    elif mode == "full":
-        handle_full_mode(event, user_message, remaining, is_vip)
+    result = llm_gateway.complete_json(
+        system_prompt + BATCH_PROMPT_SUFFIX.format(entities="、".join(entities)),
+        prompt,
+        mode="content_pack",
+        max_tokens=CONTENT_PACK_MAX_TOKENS,
+        priority=PRIORITY_BACKGROUND
+    )
+    if not isinstance(result, dict):
+        return {}
+    return {entity: result[entity] for entity in entities if isinstance(result.get(entity), dict)}
+
+
+def generate_daily_content(day, variants: int = 8) -> tuple:
+    """
+    生成一天的內容包：黃曆、12 星座、12 生肖各一份，每日運勢 variants 個版本
+    星座、生肖與每日運勢各以一次呼叫生成，缺少的項目再逐一補齊（仍失敗的略過，上線後照常即時生成）
+    Returns: ({(模式, 對象): 內容}, {模式: 版本數})
+    """
+    today = day.strftime("%Y年%m月%d日")
+    entries = {}
+
+    almanac = get_almanac(day)
+    if almanac is not None:
+        entries[("almanac", None)] = almanac
+
+    batches = [
+        ("zodiac", ZODIAC_PROMPT, ZODIAC_SIGNS, lambda sign: get_zodiac_fortune(sign, day)),
+        ("chinese_zodiac", CHINESE_ZODIAC_PROMPT, CHINESE_ZODIAC,
+         lambda zodiac: get_chinese_zodiac_fortune(zodiac, day)),
+    ]
+    for mode, system_prompt, names, single in batches:
+        results = ask_ai_batch(system_prompt, f"請提供今天（{today}）以下每一項的今日運勢", names)
+        for name in names:
+            value = results.get(name) or single(name)
+            if value is not None:
+                entries[(mode, name)] = value
+
+    labels = [str(i + 1) for i in range(variants)]
+    results = ask_ai_batch(DAILY_FORTUNE_PROMPT, f"請為今天（{today}）生成 {variants} 份不同的運勢", labels)
+    fortunes = [results[label] for label in labels if label in results]
+    while len(fortunes) < variants:
+        fortune = generate_daily_fortune(day)
+        if fortune is None:
+            break
+        fortunes.append(fortune)
+    for i, fortune in enumerate(fortunes):
+        entries[("daily_fortune", str(i))] = fortune
+    pools = {"daily_fortune": len(fortunes)} if fortunes else {}
+
+    return entries, pools
+
+
+def warm_daily_cache(day) -> int:
+    """
+    預先生成當日所有共用內容，回傳成功筆數
+    """
+    results = [get_daily_fortune(day), get_almanac(day)]
+    results += [get_zodiac_fortune(sign, day) for sign in ZODIAC_SIGNS]
+    results += [get_chinese_zodiac_fortune(zodiac, day) for zodiac in CHINESE_ZODIAC]
+    return sum(1 for result in results if result is not None)
+
+
+def ask_match(sign1: str, sign2: str) -> dict:
+    """
+    呼叫 AI 分析兩個星座的速配指數
+    """
+    return ask_ai_simple(f"請分析{sign1}和{sign2}的速配指數", MATCH_PROMPT, mode="match")
+
+
+def dream_prompt(dream_content: str) -> str:
+    """
+    解夢的提示詞
+    """
+    return f"夢境內容：{dream_content}"
+
+
+def number_prompt(number: str) -> str:
+    """
+    數字占卜的提示詞
+    """
+    return f"請分析數字 {number} 的命理含義"
+
+
+def get_remaining_text(remaining: int, is_vip: bool) -> str:
+    """
+    取得剩餘次數文字
+    """
+    if is_vip:
+        return "\n\n━━━━━━━━━━━━━━━━\n👑 VIP 無限使用中"
     else:
-        handle_text_only(event, user_message, remaining, is_vip)
+        return f"\n\n━━━━━━━━━━━━━━━━\n📊 今日剩餘免費次數：{remaining} 次"
 
 
-def handle_daily_fortune(event, remaining: int = 0, is_vip: bool = False):
+# ===== 回覆文字（只依輸入組字，不呼叫外部服務）=====
+def render_daily_fortune(fortune: dict, today: str) -> str:
     """
-    處理每日幸運指數
+    每日幸運指數
     """
-    from datetime import datetime
-    today = datetime.now().strftime("%m/%d")
-    
-    fortune = get_daily_fortune()
-    
-    if fortune is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
-        return
-    
-    # 格式化回覆
-    reply_text = f"""🌅 【{today} 今日運勢】
+    return f"""🌅 【{today} 今日運勢】
 
 ━━━━ 運勢指數 ━━━━
 ✨ 整體運勢：{format_stars(fortune.get('overall_stars', 3))}
@@ -698,35 +1282,13 @@ def handle_daily_fortune(event, remaining: int = 0, is_vip: bool = False):
 💡 {fortune.get('advice', '今日宜靜心養氣，待機而動。')}
 
 ⚠️ {fortune.get('warning', '避免衝動行事')}"""
-    
-    reply_text += get_remaining_text(remaining, is_vip)
-    
-    # 加上快速操作按鈕
-    quick_reply = QuickReply(items=[
-        QuickReplyItem(action=MessageAction(label="🎰 抽籤", text="抽籤")),
-        QuickReplyItem(action=MessageAction(label="🎴 塔羅", text="占卜")),
-        QuickReplyItem(action=MessageAction(label="📅 黃曆", text="黃曆")),
-        QuickReplyItem(action=MessageAction(label="🌙 解夢", text="解夢 ")),
-    ])
-    
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
-            )
-        )
 
 
-def handle_fortune_stick(event, remaining: int = 0, is_vip: bool = False):
+def render_fortune_stick(stick: dict) -> str:
     """
-    抽籤詩功能
+    籤詩
     """
-    # 隨機抽一支籤
-    stick = random.choice(FORTUNE_STICKS)
-    
-    reply_text = f"""🎰 【籤詩結果】
+    return f"""🎰 【籤詩結果】
 
 ━━━━━━━━━━━━━━━━
 📜 {stick['level']}
@@ -738,28 +1300,16 @@ def handle_fortune_stick(event, remaining: int = 0, is_vip: bool = False):
 
 💡 此籤主{stick['meaning']}，
 施主宜順應天時，把握當下。"""
-    
-    reply_text += get_remaining_text(remaining, is_vip)
-    reply_with_quick_actions(event, reply_text)
 
 
-def handle_almanac(event, remaining: int = 0, is_vip: bool = False):
+def render_almanac(result: dict, today: str) -> str:
     """
     今日黃曆
     """
-    from datetime import datetime
-    today = datetime.now().strftime("%m月%d日")
-    
-    result = ask_ai_simple(f"請提供今天（{today}）的黃曆", ALMANAC_PROMPT)
-    
-    if result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
-        return
-    
     suitable = "、".join(result.get('suitable', ['諸事皆宜']))
     avoid = "、".join(result.get('avoid', ['無']))
     
-    reply_text = f"""📅 【{today} 黃曆】
+    return f"""📅 【{today} 黃曆】
 
 ━━━━ 今日宜 ━━━━
 ✅ {suitable}
@@ -773,26 +1323,13 @@ def handle_almanac(event, remaining: int = 0, is_vip: bool = False):
 
 ━━━━ 黃曆總評 ━━━━
 📝 {result.get('advice', '今日平順，諸事可為。')}"""
-    
-    reply_text += get_remaining_text(remaining, is_vip)
-    reply_with_quick_actions(event, reply_text)
 
 
-def handle_dream(event, dream_content: str, remaining: int = 0, is_vip: bool = False):
+def render_dream(result: dict) -> str:
     """
-    解夢功能
+    解夢結果
     """
-    if not dream_content:
-        reply_with_quick_actions(event, "🌙 請告訴我你的夢境內容\n\n例如：解夢 我夢到在飛")
-        return
-    
-    result = ask_ai_simple(f"夢境內容：{dream_content}", DREAM_PROMPT)
-    
-    if result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
-        return
-    
-    reply_text = f"""🌙 【周公解夢】
+    return f"""🌙 【周公解夢】
 
 ━━━━ 夢境類型 ━━━━
 🏷️ {result.get('dream_type', '預兆夢')}
@@ -804,25 +1341,13 @@ def handle_dream(event, dream_content: str, remaining: int = 0, is_vip: bool = F
 💡 {result.get('advice', '順其自然，靜觀其變。')}
 
 ✨ 開運行動：{result.get('lucky_action', '多行善事')}"""
-    
-    reply_text += get_remaining_text(remaining, is_vip)
-    reply_with_quick_actions(event, reply_text)
 
 
-def handle_zodiac(event, sign: str, remaining: int = 0, is_vip: bool = False):
+def render_zodiac(result: dict, sign: str, today: str) -> str:
     """
     星座運勢
     """
-    from datetime import datetime
-    today = datetime.now().strftime("%m/%d")
-    
-    result = ask_ai_simple(f"請提供{sign}今日運勢", ZODIAC_PROMPT)
-    
-    if result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
-        return
-    
-    reply_text = f"""♈ 【{sign} {today} 運勢】
+    return f"""♈ 【{sign} {today} 運勢】
 
 ━━━━ 運勢指數 ━━━━
 ✨ 整體運勢：{format_stars(result.get('overall', 3))}
@@ -836,25 +1361,13 @@ def handle_zodiac(event, sign: str, remaining: int = 0, is_vip: bool = False):
 
 ━━━━ 今日提醒 ━━━━
 💡 {result.get('advice', '今日運勢平穩。')}"""
-    
-    reply_text += get_remaining_text(remaining, is_vip)
-    reply_with_quick_actions(event, reply_text)
 
 
-def handle_chinese_zodiac(event, zodiac: str, remaining: int = 0, is_vip: bool = False):
+def render_chinese_zodiac(result: dict, zodiac: str, today: str) -> str:
     """
     生肖運勢
     """
-    from datetime import datetime
-    today = datetime.now().strftime("%m/%d")
-    
-    result = ask_ai_simple(f"請提供生肖{zodiac}今日運勢", CHINESE_ZODIAC_PROMPT)
-    
-    if result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
-        return
-    
-    reply_text = f"""🐉 【生肖{zodiac} {today} 運勢】
+    return f"""🐉 【生肖{zodiac} {today} 運勢】
 
 ━━━━ 運勢指數 ━━━━
 ✨ 整體運勢：{format_stars(result.get('overall', 3))}
@@ -868,38 +1381,12 @@ def handle_chinese_zodiac(event, zodiac: str, remaining: int = 0, is_vip: bool =
 
 ━━━━ 今日提醒 ━━━━
 💡 {result.get('advice', '今日運勢平穩。')}"""
-    
-    reply_text += get_remaining_text(remaining, is_vip)
-    reply_with_quick_actions(event, reply_text)
 
 
-def handle_match(event, message: str, remaining: int = 0, is_vip: bool = False):
+def render_match(result: dict, sign1: str, sign2: str) -> str:
     """
-    配對測試
+    星座配對分析
     """
-    # 嘗試從訊息中提取兩個星座
-    found_signs = []
-    for sign in ZODIAC_SIGNS:
-        if sign in message:
-            found_signs.append(sign)
-    
-    if len(found_signs) < 2:
-        reply_text = """💑 【星座配對測試】
-
-請輸入兩個星座，例如：
-• 配對 牡羊座 天秤座
-• 獅子座配雙子座"""
-        reply_with_quick_actions(event, reply_text)
-        return
-    
-    sign1, sign2 = found_signs[0], found_signs[1]
-    
-    result = ask_ai_simple(f"請分析{sign1}和{sign2}的速配指數", MATCH_PROMPT)
-    
-    if result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
-        return
-    
     match_score = result.get('match_score', 75)
     
     # 根據分數給予評價
@@ -914,7 +1401,7 @@ def handle_match(event, message: str, remaining: int = 0, is_vip: bool = False):
     else:
         rating = "挑戰重重 🖤"
     
-    reply_text = f"""💑 【{sign1} ✕ {sign2} 配對分析】
+    return f"""💑 【{sign1} ✕ {sign2} 配對分析】
 
 ━━━━ 速配指數 ━━━━
 💘 總體速配：{match_score}分 {rating}
@@ -927,32 +1414,13 @@ def handle_match(event, message: str, remaining: int = 0, is_vip: bool = False):
 
 ━━━━ 相處建議 ━━━━
 💡 {result.get('advice', '互相尊重是關鍵。')}"""
-    
-    reply_text += get_remaining_text(remaining, is_vip)
-    reply_with_quick_actions(event, reply_text)
 
 
-def handle_number(event, number: str, remaining: int = 0, is_vip: bool = False):
+def render_number(result: dict, number: str) -> str:
     """
     數字占卜
     """
-    if not number:
-        reply_text = """🔢 【數字占卜】
-
-請提供一個數字，例如：
-• 數字 7
-• 數字 88
-• 數字 168"""
-        reply_with_quick_actions(event, reply_text)
-        return
-    
-    result = ask_ai_simple(f"請分析數字 {number} 的命理含義", NUMBER_PROMPT)
-    
-    if result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
-        return
-    
-    reply_text = f"""🔢 【數字 {number} 命理解析】
+    return f"""🔢 【數字 {number} 命理解析】
 
 ━━━━ 數字含義 ━━━━
 📖 {result.get('number_meaning', '這個數字...')}
@@ -966,53 +1434,26 @@ def handle_number(event, number: str, remaining: int = 0, is_vip: bool = False):
 ━━━━ 使用建議 ━━━━
 💡 {result.get('advice', '可多使用此數字。')}
 📅 適用日：{result.get('lucky_day', '每日皆可')}"""
-    
-    reply_text += get_remaining_text(remaining, is_vip)
-    reply_with_quick_actions(event, reply_text)
 
 
-def reply_with_quick_actions(event, text: str):
+def render_tarot_reading(choice: int, card: str, text_reply: str) -> str:
     """
-    回覆訊息並附上快速操作按鈕
+    塔羅牌解讀（choice 從 0 起算）
     """
-    quick_reply = QuickReply(items=[
-        QuickReplyItem(action=MessageAction(label="⭐ 今日運勢", text="今日運勢")),
-        QuickReplyItem(action=MessageAction(label="🎰 抽籤", text="抽籤")),
-        QuickReplyItem(action=MessageAction(label="🎴 塔羅", text="占卜")),
-        QuickReplyItem(action=MessageAction(label="📅 黃曆", text="黃曆")),
-    ])
-    
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=text, quick_reply=quick_reply)]
-            )
-        )
+    return f"""🎴 你選擇了第 {choice + 1} 張牌
 
+✨ 【{card}】✨
 
-def start_tarot_reading(event, user_id: str, question: str, remaining: int = 0, is_vip: bool = False):
+{text_reply}
+
+━━━━━━━━━━━━━━━━
+🔮 想再次占卜請輸入「占卜」"""
+
+
+def render_tarot_draw(remaining: int, is_vip: bool) -> str:
     """
-    開始塔羅牌占卜：抽三張牌讓使用者選
+    抽牌後請使用者選牌的文字
     """
-    cards = draw_three_cards()
-    
-    # 清理問題
-    clean_question = question
-    for keyword in ["抽牌", "塔羅", "占卜", "抽籤", "抽卡"]:
-        clean_question = clean_question.replace(keyword, "").strip()
-    if not clean_question:
-        clean_question = "我的運勢"
-    
-    user_states[user_id] = {
-        "mode": "selecting",
-        "question": clean_question,
-        "cards": cards,
-        "remaining": remaining,
-        "is_vip": is_vip
-    }
-    
     reply_text = """🔮 塔羅牌占卜開始...
 
 吾已為汝抽出三張命運之牌，
@@ -1027,171 +1468,897 @@ def start_tarot_reading(event, user_id: str, question: str, remaining: int = 0,
         reply_text += "\n\n👑 VIP 無限使用中"
     else:
         reply_text += f"\n\n📊 今日剩餘免費次數：{remaining} 次"
-    
+    return reply_text
+
+
+# ===== 回覆訊息（同步與 asyncio 版本共用）=====
+DREAM_HELP_MESSAGE = "🌙 請告訴我你的夢境內容\n\n例如：解夢 我夢到在飛"
+
+MATCH_HELP_MESSAGE = """💑 【星座配對測試】
+
+請輸入兩個星座，例如：
+• 配對 牡羊座 天秤座
+• 獅子座配雙子座"""
+
+NUMBER_HELP_MESSAGE = """🔢 【數字占卜】
+
+請提供一個數字，例如：
+• 數字 7
+• 數字 88
+• 數字 168"""
+
+CARD_CHOICE_HINT = "請點選下方按鈕選擇牌 ⬇️"
+TAROT_NOT_STARTED_MESSAGE = "請先輸入「占卜」開始抽牌。"
+
+
+def quick_actions_message(text: str) -> TextMessage:
+    """
+    附上快速操作按鈕的文字訊息
+    """
+    quick_reply = QuickReply(items=[
+        QuickReplyItem(action=MessageAction(label="⭐ 今日運勢", text="今日運勢")),
+        QuickReplyItem(action=MessageAction(label="🎰 抽籤", text="抽籤")),
+        QuickReplyItem(action=MessageAction(label="🎴 塔羅", text="占卜")),
+        QuickReplyItem(action=MessageAction(label="📅 黃曆", text="黃曆")),
+    ])
+    return TextMessage(text=text, quick_reply=quick_reply)
+
+
+def daily_fortune_message(text: str) -> TextMessage:
+    """
+    每日幸運指數的訊息（快速操作不含今日運勢本身）
+    """
+    quick_reply = QuickReply(items=[
+        QuickReplyItem(action=MessageAction(label="🎰 抽籤", text="抽籤")),
+        QuickReplyItem(action=MessageAction(label="🎴 塔羅", text="占卜")),
+        QuickReplyItem(action=MessageAction(label="📅 黃曆", text="黃曆")),
+        QuickReplyItem(action=MessageAction(label="🌙 解夢", text="解夢 ")),
+    ])
+    return TextMessage(text=text, quick_reply=quick_reply)
+
+
+def card_choice_message(text: str) -> TextMessage:
+    """
+    附上三張牌選擇按鈕的訊息
+    """
     quick_reply = QuickReply(items=[
         QuickReplyItem(action=MessageAction(label="🃏 第一張", text="1")),
         QuickReplyItem(action=MessageAction(label="🃏 第二張", text="2")),
         QuickReplyItem(action=MessageAction(label="🃏 第三張", text="3")),
     ])
-    
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply_text, quick_reply=quick_reply)]
+    return TextMessage(text=text, quick_reply=quick_reply)
+
+
+def text_only_message(text: str, user_message: str) -> TextMessage:
+    """
+    純文字回答的訊息，附上「附圖回覆」按鈕
+    """
+    quick_reply = QuickReply(items=[
+        QuickReplyItem(action=MessageAction(label="⭐ 今日運勢", text="今日運勢")),
+        QuickReplyItem(action=MessageAction(label="🎴 塔羅占卜", text="占卜")),
+        QuickReplyItem(action=MessageAction(label="🖼️ 附圖回覆", text=f"{IMAGE_FOLLOW_UP_PREFIX}{user_message}")),
+    ])
+    return TextMessage(text=text, quick_reply=quick_reply)
+
+
+def user_messages(text: str, image_url: str = None, preview_url: str = None) -> list:
+    """
+    文字加上圖片（有的話，未提供預覽時以原圖當預覽）
+    """
+    messages = [TextMessage(text=text)]
+    if image_url:
+        messages.append(
+            ImageMessage(
+                original_content_url=image_url,
+                preview_image_url=preview_url or image_url
             )
         )
+    return messages
 
 
-def handle_card_selection(event, user_id: str, selection: str):
+def match_signs(message: str) -> tuple:
     """
-    處理使用者選牌
+    從訊息中提取兩個星座（同星座出現兩次視為同星座配對），不足兩個時回傳 None
+    """
+    found_signs = []
+    for sign in ZODIAC_SIGNS:
+        found_signs.extend([sign] * min(message.count(sign), 2))
+    if len(found_signs) < 2:
+        return None
+    return (found_signs[0], found_signs[1])
+
+
+def parse_card_choice(selection: str) -> int:
+    """
+    使用者選的牌（0-2），輸入不是 1-3 時回傳 None
     """
-    state = user_states.get(user_id)
-    if not state:
-        reply_with_quick_actions(event, "請先輸入「占卜」開始抽牌。")
-        return
-    
     try:
         choice = int(selection) - 1
-        if choice < 0 or choice > 2:
-            raise ValueError()
-    except:
-        # 如果輸入不是 1-3，給予提示
-        quick_reply = QuickReply(items=[
-            QuickReplyItem(action=MessageAction(label="🃏 第一張", text="1")),
-            QuickReplyItem(action=MessageAction(label="🃏 第二張", text="2")),
-            QuickReplyItem(action=MessageAction(label="🃏 第三張", text="3")),
-        ])
-        with ApiClient(configuration) as api_client:
-            messaging_api = MessagingApi(api_client)
-            messaging_api.reply_message(
-                ReplyMessageRequest(
+    except ValueError:
+        return None
+    return choice if 0 <= choice <= 2 else None
+
+
+def wants_prerender(image_prompt: str, is_vip: bool) -> bool:
+    """
+    純文字回答後是否先開始生成圖片（還沒有生成過的才需要）
+    """
+    return bool(image_prompt) and (IMAGE_PRERENDER == "all" or (IMAGE_PRERENDER == "vip" and is_vip)) \
+        and cached_image(image_prompt) is None
+
+
+# ===== Line Webhook 端點 =====
+@app.route("/callback", methods=["POST"])
+def callback():
+    signature = request.headers.get("X-Line-Signature", "")
+    body = request.get_data(as_text=True)
+    rid = os.urandom(6).hex()
+    request_id.set(rid)
+
+    # 只在請求中驗證簽章，實際處理交給背景工作佇列
+    try:
+        payload = handler.parser.parse(body, signature, as_payload=True)
+    except InvalidSignatureError:
+        app.logger.error("簽章驗證失敗")
+        abort(400)
+
+    event_log.info("webhook", "收到 Webhook", events=len(payload.events), bytes=len(body))
+
+    # 一次 Webhook 可能帶有多位使用者的事件，各自送進工作佇列同時處理，同一位使用者的事件依序處理
+    received = time.perf_counter()
+    rejected = 0
+    for event in payload.events:
+        if not job_queue.submit_keyed(event_order_key(event), handle_event, event, rid, received):
+            rejected += 1
+
+    # 已送出的事件已經或即將登記處理，LINE 重送整個 Webhook 時會略過它們
+    if rejected:
+        app.logger.warning(f"工作佇列已滿，{rejected} 個事件請 LINE 稍後重送")
+        abort(503)
+
+    return "OK"
+
+
+def event_order_key(event) -> str:
+    """
+    必須依序處理的事件共用的 key（同一位使用者，沒有使用者時為群組或聊天室），都沒有時回傳 None
+    """
+    source = getattr(event, "source", None)
+    for attr in ("user_id", "group_id", "room_id"):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return None
+
+
+def handle_event(event, rid: str = "", received: float = None):
+    """
+    處理單一事件（在背景工作執行緒中執行）
+    rid 為收到 Webhook 時產生的 request_id，讓之後的日誌都能對應回同一個請求；
+    received 為收到 Webhook 的時間，用來統計事件在佇列中等待的時間
+    """
+    request_id.set(rid)
+    if received is not None:
+        metrics.observe("stage_seconds", time.perf_counter() - received, stage="event_wait",
+                        mode=getattr(event, "type", ""))
+    webhook_event_id = getattr(event, "webhook_event_id", "") or ""
+    event_id.set(webhook_event_id)
+    if not claim_event(event, webhook_event_id):
+        return
+    dispatch_event(event)
+
+
+def claim_event(event, webhook_event_id: str) -> bool:
+    """
+    登記事件 ID，已處理過的重送事件回傳 False（在扣次數與呼叫任何外部服務之前）
+    """
+    context = getattr(event, "delivery_context", None)
+    redelivery = bool(getattr(context, "is_redelivery", False))
+    if redelivery:
+        metrics.inc("webhook_redeliveries_total")
+    if not webhook_event_id:
+        return True
+    try:
+        claimed = processed_events.claim(webhook_event_id)
+    except Exception as e:
+        # 紀錄無法使用時照常處理，寧可偶爾重複也不要漏回覆
+        app.logger.error(f"登記事件失敗: {e}")
+        return True
+    if not claimed:
+        metrics.inc("webhook_duplicates_total", redelivery=str(redelivery).lower())
+        event_log.info("duplicate", "略過重複事件", redelivery=redelivery)
+    return claimed
+
+
+def dispatch_event(event):
+    """
+    依事件類型找出以 @handler.add 註冊的處理函數並執行
+    """
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{MessageEvent.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        return
+    # 整個事件的耗時，mode 預設為事件類型，文字訊息判斷出回覆模式後改為該模式
+    window = open_reply_window(event)
+    with metrics.span("event", mode=getattr(event, "type", "")) as labels, event_context(event, labels, window):
+        if window is not None:
+            interim_scheduler.schedule(window, lambda: send_interim(window, "timer"))
+        try:
+            func(event)
+        finally:
+            if window is not None:
+                window.close()
+
+
+@contextlib.contextmanager
+def event_context(event, labels: dict, window: ReplyWindow):
+    """
+    設定目前事件的統計標籤、Reply Token 期限、上游優先順序與已扣次數，結束時還原（同步與 asyncio 版本共用）
+    """
+    user_id = getattr(getattr(event, "source", None), "user_id", None)
+    tokens = [
+        (event_labels, event_labels.set(labels)),
+        (reply_window, reply_window.set(window)),
+        (event_priority, event_priority.set(user_priority(user_id))),
+        (quota_charges, quota_charges.set([])),
+    ]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def tag_event(mode: str):
+    """
+    標記目前事件的回覆模式
+    """
+    labels = event_labels.get()
+    if labels is not None:
+        labels["mode"] = mode
+
+
+def reply_token_expired(event) -> bool:
+    """
+    判斷事件的 Reply Token 是否已過期
+    """
+    return time.time() * 1000 - event.timestamp > REPLY_TOKEN_TTL * 1000
+
+
+def open_reply_window(event) -> ReplyWindow:
+    """
+    依事件的 timestamp 建立 Reply Token 期限，沒有 Reply Token 的事件回傳 None
+    """
+    if not getattr(event, "reply_token", None) or not getattr(event, "timestamp", None):
+        return None
+    return ReplyWindow(event.reply_token, event.timestamp, REPLY_TOKEN_TTL, REPLY_INTERIM_AFTER, REPLY_INTERIM_MARGIN)
+
+
+def interim_due(mode: str) -> bool:
+    """
+    該模式的 LLM 呼叫用完時間預算後就來不及用 Reply Token 回覆，需要先回「解讀中」
+    """
+    window = reply_window.get()
+    return window is not None and not window.interim_sent and not window.fits(llm_gateway.budget(mode))
+
+
+def claim_reply_token(event) -> bool:
+    """
+    取得 Reply Token 送出正式回覆；已被「解讀中」用掉或已過期時回傳 False
+    """
+    window = reply_window.get()
+    if window is None:
+        return not reply_token_expired(event)
+    return window.claim()
+
+
+def push_path() -> str:
+    """
+    改用 Push 時的送達方式（reply_path_total 的 path）
+    """
+    window = reply_window.get()
+    return "interim_push" if window is not None and window.interim_sent else "push"
+
+
+def interim_request(window: ReplyWindow) -> ReplyMessageRequest:
+    return ReplyMessageRequest(reply_token=window.reply_token, messages=[TextMessage(text=INTERIM_MESSAGE)])
+
+
+def send_interim(window: ReplyWindow, reason: str):
+    """
+    用 Reply Token 先回「解讀中」，正式結果之後以 Push 送出
+    """
+    if not window.claim_interim():
+        return
+    metrics.inc("reply_interim_total", reason=reason)
+    try:
+        call_line("reply", messaging_api.reply_message, interim_request(window))
+    except Exception as e:
+        app.logger.error(f"回覆「解讀中」失敗: {e}")
+
+
+def check_reply_budget(mode: str):
+    """
+    呼叫 LLM 前檢查剩餘時間，來不及在 Reply Token 過期前回覆時先回「解讀中」
+    """
+    if interim_due(mode):
+        send_interim(reply_window.get(), "budget")
+
+
+def call_line(kind: str, func, request_body):
+    """
+    呼叫 Messaging API 並記錄耗時與失敗次數（所有送出都經過這裡）
+    """
+    with metrics.span(f"line_{kind}"):
+        try:
+            response = func(request_body, _request_timeout=LINE_TIMEOUT)
+        except Exception:
+            metrics.inc("line_send_errors_total", kind=kind)
+            raise
+    event_log.info("reply", "已送出訊息", kind=kind, messages=len(request_body.messages))
+    return response
+
+
+def send_reply(event, messages: list):
+    """
+    回覆訊息給使用者；Reply Token 已用來回「解讀中」或已過期時改用 Push 訊息
+    """
+    if claim_reply_token(event):
+        try:
+            call_line(
+                "reply",
+                messaging_api.reply_message,
+                ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text="請點選下方按鈕選擇牌 ⬇️", quick_reply=quick_reply)]
+                    messages=messages
                 )
             )
+            metrics.inc("reply_path_total", path="reply")
+            return
+        except ApiException as e:
+            # 400 代表 Reply Token 已失效，其他錯誤不重送
+            if e.status != 400:
+                app.logger.error(f"回覆訊息失敗: {e}")
+                metrics.inc("reply_path_total", path="failed")
+                return
+            path = "fallback_push"
+        except Exception as e:
+            app.logger.error(f"回覆訊息失敗: {e}")
+            metrics.inc("reply_path_total", path="failed")
+            return
+    else:
+        path = push_path()
+
+    user_id = getattr(event.source, "user_id", None)
+    if not user_id:
+        app.logger.error("Reply Token 已過期且無法取得使用者，放棄回覆")
+        metrics.inc("reply_path_total", path="failed")
         return
+
+    metrics.inc("reply_path_total", path=path)
+    push_messages(user_id, messages)
+
+
+def push_messages(user_id: str, messages: list):
+    """
+    以 Push 訊息傳送給使用者
+    """
+    try:
+        call_line(
+            "push",
+            messaging_api.push_message,
+            PushMessageRequest(to=user_id, messages=messages)
+        )
+    except Exception as e:
+        app.logger.error(f"推播訊息失敗: {e}")
+
+
+# ===== 歡迎訊息（加入好友時觸發）=====
+@handler.add(FollowEvent)
+def handle_follow(event: FollowEvent):
+    """
+    當使用者加入好友時，發送歡迎訊息
+    """
+    send_reply(event, [TextMessage(text=WELCOME_MESSAGE)])
+
+
+@handler.add(MessageEvent, message=TextMessageContent)
+def handle_text_message(event: MessageEvent):
+    """
+    處理文字訊息事件
+    """
+    user_id = event.source.user_id
+    user_message = event.message.text.strip()
+    mode, extra_data, remaining, is_vip, cached = route_text_message(user_id, user_message)
+    
+    # 執行功能
+    if mode == "tarot_select":
+        handle_card_selection(event, user_id, user_message)
+    elif mode == "help":
+        reply_with_quick_actions(event, HELP_MESSAGE)
+    elif mode == "limit":
+        reply_with_quick_actions(event, LIMIT_MESSAGE)
+    elif mode == "busy":
+        reply_with_quick_actions(event, BUSY_MESSAGE)
+    elif mode == "daily_fortune":
+        handle_daily_fortune(event, remaining, is_vip)
+    elif mode == "fortune_stick":
+        handle_fortune_stick(event, remaining, is_vip)
+    elif mode == "almanac":
+        handle_almanac(event, remaining, is_vip)
+    elif mode == "dream":
+        handle_dream(event, extra_data, remaining, is_vip)
+    elif mode == "zodiac":
+        handle_zodiac(event, extra_data, remaining, is_vip)
+    elif mode == "chinese_zodiac":
+        handle_chinese_zodiac(event, extra_data, remaining, is_vip)
+    elif mode == "match":
+        handle_match(event, extra_data, remaining, is_vip)
+    elif mode == "number":
+        handle_number(event, extra_data, remaining, is_vip)
+    elif mode == "tarot":
+        start_tarot_reading(event, user_id, user_message, remaining, is_vip)
+    elif mode == "full":
+        handle_full_mode(event, user_message, remaining, is_vip, cached)
+    else:
+        handle_text_only(event, user_message, remaining, is_vip)
+
+
+def route_text_message(user_id: str, user_message: str) -> tuple:
+    """
+    判斷文字訊息要執行的功能，付費功能在這裡檢查並扣除次數（同步與 asyncio 版本共用）
+    除了回覆模式之外，mode 也可能是 tarot_select（選牌中）、help、limit（次數已用完）、busy（上游額度已滿）
+    Returns: (mode, extra_data, 剩餘次數, 是否VIP, 附圖回覆沿用的純文字回答)
+    """
+    if LOG_MESSAGE_TEXT:
+        event_log.info("message", "收到訊息", user=user_id, chars=len(user_message), text=user_message)
+    else:
+        event_log.info("message", "收到訊息", user=user_id, chars=len(user_message))
+    
+    # 檢查是否在選牌階段
+    if tarot_sessions.get(user_id) is not None:
+        tag_event("tarot_select")
+        return ("tarot_select", None, 0, False, None)
+    
+    # 判斷回覆模式
+    mode, extra_data = get_reply_mode(user_message)
     
-    selected_card = state["cards"][choice]
-    question = state["question"]
+    # 免費功能（不計次數）
+    if mode == "help":
+        return ("help", extra_data, 0, False, None)
     
-    del user_states[user_id]
+    # 附圖回覆：沿用剛才的純文字回答，不再呼叫 AI 也不再扣次數（只沿用一次，再點一次照常扣次數）
+    if mode == "full" and user_message.startswith(IMAGE_FOLLOW_UP_PREFIX):
+        cached = recent_answers.pop(user_id, user_message[len(IMAGE_FOLLOW_UP_PREFIX):])
+        if cached is not None:
+            remaining, is_vip = get_remaining_usage(user_id)
+            return ("full", extra_data, remaining, is_vip, cached)
     
-    # AI 解讀
-    prompt = f"使用者的問題是：「{question}」\n抽到的塔羅牌是：「{selected_card}」\n請給予塔羅牌解讀。"
-    ai_result = ask_openai(prompt, TAROT_SYSTEM_PROMPT)
+    # 上游額度已排不進去時直接回覆忙碌中，不扣次數
+    priority = user_priority(user_id)
+    if mode in UPSTREAM_MODES and llm_admission.overloaded({"requests": 1}, priority):
+        metrics.inc("admission_total", upstream="openai", priority=PRIORITY_NAMES[priority], outcome="busy")
+        return ("busy", extra_data, 0, priority == PRIORITY_VIP, None)
     
-    if ai_result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
+    # 付費功能（檢查並扣除次數，VIP 不計次數）
+    with metrics.span("quota", mode=mode):
+        can_use, remaining, is_vip = check_usage_limit(user_id)
+    
+    if not can_use:
+        # 超過限制，顯示提示
+        return ("limit", extra_data, remaining, is_vip, None)
+    
+    return (mode, extra_data, remaining, is_vip, None)
+
+
+def handle_daily_fortune(event, remaining: int = 0, is_vip: bool = False):
+    """
+    處理每日幸運指數
+    """
+    now = taipei_now()
+    today = now.strftime("%m/%d")
+    
+    fortune = get_daily_fortune(now.date(), event.source.user_id)
+    
+    if fortune is None:
+        reply_error(event)
         return
     
-    text_reply = ai_result.get("reply", ERROR_MESSAGE)
-    image_prompt = ai_result.get("image_prompt", "")
+    reply_text = render_daily_fortune(fortune, today)
+    reply_text += get_remaining_text(remaining, is_vip)
+    send_reply(event, [daily_fortune_message(reply_text)])
+
+
+def handle_fortune_stick(event, remaining: int = 0, is_vip: bool = False):
+    """
+    抽籤詩功能
+    """
+    # 隨機抽一支籤
+    stick = random.choice(FORTUNE_STICKS)
     
-    full_reply = f"""🎴 你選擇了第 {choice + 1} 張牌
+    reply_text = render_fortune_stick(stick)
+    reply_text += get_remaining_text(remaining, is_vip)
+    reply_with_quick_actions(event, reply_text)
 
-✨ 【{selected_card}】✨
 
-{text_reply}
+def handle_almanac(event, remaining: int = 0, is_vip: bool = False):
+    """
+    今日黃曆
+    """
+    now = taipei_now()
+    today = now.strftime("%m月%d日")
+    
+    result = get_almanac(now.date())
+    
+    if result is None:
+        reply_error(event)
+        return
+    
+    reply_text = render_almanac(result, today)
+    reply_text += get_remaining_text(remaining, is_vip)
+    reply_with_quick_actions(event, reply_text)
 
-━━━━━━━━━━━━━━━━
-🔮 想再次占卜請輸入「占卜」"""
+
+def handle_dream(event, dream_content: str, remaining: int = 0, is_vip: bool = False):
+    """
+    解夢功能
+    """
+    if not dream_content:
+        reply_uncharged(event, DREAM_HELP_MESSAGE)
+        return
     
-    image_url = None
-    if image_prompt:
-        image_url = generate_image(image_prompt)
+    result = ask_ai_simple(dream_prompt(dream_content), DREAM_PROMPT, mode="dream")
+    
+    if result is None:
+        reply_error(event)
+        return
     
-    reply_user(event.reply_token, full_reply, image_url)
+    reply_text = render_dream(result)
+    reply_text += get_remaining_text(remaining, is_vip)
+    reply_with_quick_actions(event, reply_text)
 
 
-def handle_text_only(event, user_message: str, remaining: int = 0, is_vip: bool = False):
+def handle_zodiac(event, sign: str, remaining: int = 0, is_vip: bool = False):
     """
-    純文字模式（快速回覆）
+    星座運勢
     """
-    ai_result = ask_openai(user_message)
+    now = taipei_now()
+    today = now.strftime("%m/%d")
+    
+    result = get_zodiac_fortune(sign, now.date())
+    
+    if result is None:
+        reply_error(event)
+        return
+    
+    reply_text = render_zodiac(result, sign, today)
+    reply_text += get_remaining_text(remaining, is_vip)
+    reply_with_quick_actions(event, reply_text)
+
+
+def handle_chinese_zodiac(event, zodiac: str, remaining: int = 0, is_vip: bool = False):
+    """
+    生肖運勢
+    """
+    now = taipei_now()
+    today = now.strftime("%m/%d")
+    
+    result = get_chinese_zodiac_fortune(zodiac, now.date())
+    
+    if result is None:
+        reply_error(event)
+        return
+    
+    reply_text = render_chinese_zodiac(result, zodiac, today)
+    reply_text += get_remaining_text(remaining, is_vip)
+    reply_with_quick_actions(event, reply_text)
+
+
+def handle_match(event, message: str, remaining: int = 0, is_vip: bool = False):
+    """
+    配對測試
+    """
+    signs = match_signs(message)
+    if signs is None:
+        reply_uncharged(event, MATCH_HELP_MESSAGE)
+        return
+    
+    sign1, sign2 = signs
+    
+    result = match_store.get_or_compute(sign1, sign2, ask_match)
+    
+    if result is None:
+        reply_error(event)
+        return
+    
+    reply_text = render_match(result, sign1, sign2)
+    reply_text += get_remaining_text(remaining, is_vip)
+    reply_with_quick_actions(event, reply_text)
+
+
+def handle_number(event, number: str, remaining: int = 0, is_vip: bool = False):
+    """
+    數字占卜
+    """
+    if not number:
+        reply_uncharged(event, NUMBER_HELP_MESSAGE)
+        return
+    
+    result = ask_ai_simple(number_prompt(number), NUMBER_PROMPT, mode="number")
+    
+    if result is None:
+        reply_error(event)
+        return
+    
+    reply_text = render_number(result, number)
+    reply_text += get_remaining_text(remaining, is_vip)
+    reply_with_quick_actions(event, reply_text)
+
+
+def reply_error(event):
+    """
+    讀取失敗：退還這個事件扣的次數並回覆錯誤訊息
+    """
+    reply_uncharged(event, ERROR_MESSAGE)
+
+
+def reply_uncharged(event, text: str):
+    """
+    沒有給出解讀（錯誤、缺少內容時的說明）：退還這個事件扣的次數後回覆
+    """
+    refund_event_usage()
+    reply_with_quick_actions(event, text)
+
+
+def reply_with_quick_actions(event, text: str):
+    """
+    回覆訊息並附上快速操作按鈕
+    """
+    send_reply(event, [quick_actions_message(text)])
+
+
+def start_tarot_reading(event, user_id: str, question: str, remaining: int = 0, is_vip: bool = False):
+    """
+    開始塔羅牌占卜：抽三張牌讓使用者選
+    """
+    begin_tarot_reading(user_id, question, remaining, is_vip)
+    send_reply(event, [card_choice_message(render_tarot_draw(remaining, is_vip))])
+
+
+def begin_tarot_reading(user_id: str, question: str, remaining: int, is_vip: bool):
+    """
+    抽三張牌並記錄選牌狀態（同步與 asyncio 版本共用）
+    """
+    cards = draw_three_cards()
+    
+    # 清理問題
+    clean_question = question
+    for keyword in ["抽牌", "塔羅", "占卜", "抽籤", "抽卡"]:
+        clean_question = clean_question.replace(keyword, "").strip()
+    if not clean_question:
+        clean_question = "我的運勢"
+    
+    # 記下扣次數的日期，選牌時才失敗（可能已過午夜）仍退還到同一天
+    tarot_sessions.put(user_id, TarotSession(clean_question, cards, remaining, is_vip, charged_day(user_id)))
+    
+    # 使用者選牌時，先在背景解讀三張牌
+    if tarot_speculator.wants(is_vip):
+        tarot_speculator.start(
+            user_id,
+            cards,
+            [tarot_prompt(clean_question, TAROT_CARDS[card]) for card in cards],
+            ask_tarot
+        )
+
+
+def tarot_prompt(question: str, card: str) -> str:
+    """
+    塔羅牌解讀的提示詞
+    """
+    return f"使用者的問題是：「{question}」\n抽到的塔羅牌是：「{card}」\n請給予塔羅牌解讀。"
+
+
+def ask_tarot(prompt: str) -> dict:
+    """
+    呼叫 AI 解讀塔羅牌
+    """
+    return ask_openai(prompt, TAROT_SYSTEM_PROMPT, mode="tarot")
+
+
+def handle_card_selection(event, user_id: str, selection: str):
+    """
+    處理使用者選牌
+    """
+    choice = parse_card_choice(selection)
+    if choice is None:
+        # 如果輸入不是 1-3，給予提示
+        send_reply(event, [card_choice_message(CARD_CHOICE_HINT)])
+        return
     
+    # 取出並刪除狀態，避免重複選牌
+    state = tarot_sessions.pop(user_id)
+    if state is None:
+        reply_with_quick_actions(event, TAROT_NOT_STARTED_MESSAGE)
+        return
+    
+    card_index = state.cards[choice]
+    selected_card = TAROT_CARDS[card_index]
+    question = state.question
+    
+    # AI 解讀（有預先計算的結果就直接使用）
+    ai_result = tarot_speculator.take(user_id, state.cards, choice)
     if ai_result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
+        ai_result = ask_tarot(tarot_prompt(question, selected_card))
+    
+    if ai_result is None:
+        # 次數在抽牌時已扣除
+        refund_usage(user_id, state.charged_day)
+        reply_error(event)
         return
     
     text_reply = ai_result.get("reply", ERROR_MESSAGE)
+    image_prompt = ai_result.get("image_prompt", "")
     
-    if is_vip:
-        text_reply += "\n\n━━━━━━━━━━━━━━━━\n👑 VIP 無限使用中"
-    else:
-        text_reply += f"\n\n━━━━━━━━━━━━━━━━\n📊 今日剩餘免費次數：{remaining} 次"
+    full_reply = render_tarot_reading(choice, selected_card, text_reply)
     
-    # 加上快速操作
-    quick_reply = QuickReply(items=[
-        QuickReplyItem(action=MessageAction(label="⭐ 今日運勢", text="今日運勢")),
-        QuickReplyItem(action=MessageAction(label="🎴 塔羅占卜", text="占卜")),
-        QuickReplyItem(action=MessageAction(label="🖼️ 附圖回覆", text=f"要圖 {user_message}")),
-    ])
+    # 優先使用圖庫中的牌面或已生成過的圖片，文字一好就能連同圖片送出；都沒有時圖片完成後再推播
+    image_url, preview_url = card_library.pick(card_index) or (None, None)
+    if image_url is None and image_prompt:
+        image_url, preview_url = cached_image(image_prompt) or (None, None)
+        if image_url is None and request_image(user_id, image_prompt, mode="tarot", is_vip=state.is_vip):
+            full_reply += IMAGE_PENDING_NOTE
     
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=text_reply, quick_reply=quick_reply)]
-            )
-        )
+    reply_user(event, full_reply, image_url, preview_url)
 
 
-def handle_full_mode(event, user_message: str, remaining: int = 0, is_vip: bool = False):
+def handle_text_only(event, user_message: str, remaining: int = 0, is_vip: bool = False):
     """
-    完整圖文模式
+    純文字模式（快速回覆）
     """
     ai_result = ask_openai(user_message)
     
     if ai_result is None:
-        reply_with_quick_actions(event, ERROR_MESSAGE)
+        reply_error(event)
         return
     
     text_reply = ai_result.get("reply", ERROR_MESSAGE)
     
-    if is_vip:
-        text_reply += "\n\n━━━━━━━━━━━━━━━━\n👑 VIP 無限使用中"
+    # 保留回答，使用者點「附圖回覆」時直接沿用（可選擇先開始生成圖片，完成前不推播）
+    user_id = event.source.user_id
+    image_prompt = ai_result.get("image_prompt", "")
+    image_prediction = None
+    if wants_prerender(image_prompt, is_vip):
+        image_prediction = request_image(user_id, image_prompt, push=False, is_vip=is_vip)
+    recent_answers.put(user_id, user_message, RecentAnswer(text_reply, image_prompt, image_prediction))
+    
+    text_reply += get_remaining_text(remaining, is_vip)
+    send_reply(event, [text_only_message(text_reply, user_message)])
+
+
+def handle_full_mode(event, user_message: str, remaining: int = 0, is_vip: bool = False, cached: RecentAnswer = None):
+    """
+    完整圖文模式（cached 為剛才的純文字回答時，直接生成圖片）
+    文字立即回覆，圖片生成完成後再推播
+    """
+    image_prediction = None
+    if cached is not None:
+        text_reply = cached.reply
+        image_prompt = cached.image_prompt
+        image_prediction = cached.image_prediction
     else:
-        text_reply += f"\n\n━━━━━━━━━━━━━━━━\n📊 今日剩餘免費次數：{remaining} 次"
+        ai_result = ask_openai(user_message, mode="full")
+        
+        if ai_result is None:
+            reply_error(event)
+            return
+        
+        text_reply = ai_result.get("reply", ERROR_MESSAGE)
+        image_prompt = ai_result.get("image_prompt", "")
     
-    image_prompt = ai_result.get("image_prompt", "")
+    text_reply += get_remaining_text(remaining, is_vip)
     
-    image_url = None
+    # 已生成過（含預先生成且已完成）的圖片直接一起回覆，還在生成就改為完成後推播
+    image_url = preview_url = None
+    tracked = False
     if image_prompt:
-        image_url = generate_image(image_prompt)
+        image_url, preview_url = cached_image(image_prompt) or (None, None)
+    if image_url is None and image_prediction is not None:
+        tracked, image_url = image_tracker.claim(image_prediction)
+    if image_url is None and not tracked and image_prompt:
+        tracked = request_image(event.source.user_id, image_prompt, is_vip=is_vip) is not None
+    if tracked and image_url is None:
+        text_reply += IMAGE_PENDING_NOTE
     
-    reply_user(event.reply_token, text_reply, image_url)
+    reply_user(event, text_reply, image_url, preview_url)
 
 
-def reply_user(reply_token: str, text: str, image_url: str = None):
+def reply_user(event, text: str, image_url: str = None, preview_url: str = None):
     """
-    回傳訊息給 Line 使用者（支援圖片）
+    回傳訊息給 Line 使用者（支援圖片，未提供預覽時以原圖當預覽）
     """
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        
-        messages = [TextMessage(text=text)]
-        
-        if image_url:
-            messages.append(
-                ImageMessage(
-                    original_content_url=image_url,
-                    preview_image_url=image_url
-                )
-            )
-        
-        try:
-            messaging_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=messages
-                )
-            )
-        except Exception as e:
-            app.logger.error(f"回覆訊息失敗: {e}")
+    send_reply(event, user_messages(text, image_url, preview_url))
+
+
+# ===== 每日快取預熱 =====
+if DAILY_WARMUP:
+    daily_warmer = DailyWarmer(warm_daily_cache, delay=DAILY_WARMUP_DELAY)
+    daily_warmer.start()
+
+
+# ===== 圖片預測逾時清理 =====
+image_sweeper = PredictionSweeper(sweep_predictions, interval=IMAGE_SWEEP_INTERVAL)
+image_sweeper.start()
+
+
+# ===== Replicate 預測完成通知 =====
+@app.route("/replicate/webhook", methods=["POST"])
+def replicate_webhook():
+    user_id = request.args.get("user", "")
+    push = request.args.get("push") == "1"
+    key = request.args.get("key", "")
+    if not verify_webhook_token(IMAGE_WEBHOOK_SECRET, user_id, push, key, request.args.get("token")):
+        abort(403)
+
+    prediction = request.get_json(silent=True) or {}
+    if "id" not in prediction:
+        abort(400)
+
+    # 推播交給背景工作佇列，立即回應 Replicate
+    if prediction.get("status") in ("succeeded", "failed", "canceled"):
+        if not job_queue.submit(
+            finish_prediction, prediction["id"], prediction["status"], prediction.get("output"), user_id, push, key
+        ):
+            abort(503)
+
+    return "OK"
+
+
+# ===== 圖片快取檔案 =====
+@app.route("/images/<path:filename>", methods=["GET"])
+def cached_image_file(filename):
+    # 檔名是內容的雜湊，內容永遠不變，允許客戶端長期快取
+    return send_from_directory(IMAGE_STORE_DIR, filename, max_age=365 * 24 * 3600)
+
+
+# ===== 塔羅牌圖庫檔案 =====
+@app.route("/cards/<path:filename>", methods=["GET"])
+def card_image(filename):
+    # 檔名固定不變，允許客戶端長期快取
+    return send_from_directory(CARD_IMAGE_DIR, filename, max_age=365 * 24 * 3600)
+
+
+# ===== 執行統計端點 =====
+metrics.register_stats("job_queue", lambda: {"pending": job_queue.pending()}, "背景工作佇列")
+metrics.register_stats("llm_singleflight", llm_flight.stats, "相同提示詞合併")
+metrics.register_stats(
+    "llm_breaker", lambda: {"open": llm_gateway.breaker.state == "open"}, "OpenAI 斷路器"
+)
+metrics.register_stats(
+    "daily_cache", lambda: {"hits": daily_cache.hits, "misses": daily_cache.misses}, "每日共用快取"
+)
+metrics.register_stats(
+    "answer_cache", lambda: {"hits": recent_answers.hits, "misses": recent_answers.misses}, "最近回答快取"
+)
+metrics.register_stats("tarot_speculation", tarot_speculator.stats, "塔羅解讀預先計算")
+metrics.register_stats("image_predictions", image_tracker.stats, "非同步圖片生成")
+metrics.register_stats("image_store", image_store.stats, "圖片快取")
+metrics.register_stats("image_profiles", lambda: {"downgrades": image_profiles.downgrades}, "圖片設定檔降級")
+metrics.register_stats("processed_events", processed_events.stats, "已處理的 Webhook 事件")
+metrics.register_stats("content_pack", content_packs.stats, "每日內容包")
+metrics.register_stats("openai_admission", llm_admission.stats, "OpenAI 額度排隊")
+metrics.register_stats("replicate_admission", image_admission.stats, "Replicate 額度排隊")
+metrics.register_stats("reply_interim", lambda: {"scheduled": interim_scheduler.pending()}, "等待中的「解讀中」排程")
+metrics.register_stats("logging", lambda: {"dropped": log_handler.dropped}, "日誌佇列已滿而丟棄的筆數")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
 
 
 # ===== 健康檢查端點 =====
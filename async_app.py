@@ -0,0 +1,738 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio 版本的服務入口（aiohttp）
+
+與 app.py 共用設定、意圖判斷、次數限制、使用者狀態、已處理事件、回覆文字與各種快取，
+差別在於等待外部服務的方式：LINE 使用 AsyncMessagingApi、OpenAI 使用 AsyncOpenAI、
+Replicate 使用 predictions.async_create，等待中的請求不佔用執行緒，
+一個行程就能同時處理上千則等待 OpenAI 回答的訊息。
+
+    gunicorn async_app:web_app --worker-class aiohttp.GunicornWebWorker --workers 1
+    python async_app.py
+
+同一天所有使用者共用的內容（每日運勢、黃曆、星座、生肖、配對表）與 Replicate 完成通知
+仍呼叫 app.py 的同步函數，放在執行緒中執行；快取命中時只是一次執行緒切換。
+"""
+
+import asyncio
+import functools
+import os
+import random
+import time
+
+import httpx
+from aiohttp import web
+from werkzeug.security import safe_join
+
+# LINE Bot SDK v3
+from linebot.v3.messaging import (
+    AsyncApiClient,
+    AsyncMessagingApi,
+    Configuration,
+    ReplyMessageRequest,
+    PushMessageRequest,
+    TextMessage,
+    ApiException
+)
+from linebot.v3.webhooks import FollowEvent, MessageEvent, TextMessageContent
+from linebot.v3.exceptions import InvalidSignatureError
+
+# OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+# 同步版本的設定與商業邏輯
+import app as core
+
+# LLM 呼叫閘道
+from llm_gateway import AsyncLLMGateway
+
+# 相同請求合併
+from singleflight import AsyncSingleFlight, flight_key
+
+# 結構化日誌
+from structured_logging import event_id, request_id
+
+# 非同步圖片生成追蹤
+from image_predictions import verify_webhook_token
+
+logger = core.app.logger
+
+# ===== asyncio 服務設定 =====
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", 2000))  # 同時處理中的 Webhook 上限，超過回 503
+ASYNC_LLM_MAX_CONCURRENCY = int(os.getenv("ASYNC_LLM_MAX_CONCURRENCY", 256))  # 每個行程同時呼叫 OpenAI 上限
+ASYNC_LINE_POOL_SIZE = int(os.getenv("ASYNC_LINE_POOL_SIZE", 100))  # Messaging API 同時連線數
+
+# 使用者狀態、次數、已處理事件與上游額度都在記憶體時直接在事件迴圈中讀寫，SQLite / Redis 則移到執行緒，避免卡住迴圈
+INLINE_STORES = (
+    core.SESSION_BACKEND == core.QUOTA_BACKEND == core.EVENT_DEDUP_BACKEND == core.ADMISSION_BACKEND == "memory"
+)
+
+# ===== 初始化 OpenAI =====
+openai_client = AsyncOpenAI(
+    api_key=core.OPENAI_API_KEY,
+    base_url=core.OPENAI_BASE_URL,
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=ASYNC_LLM_MAX_CONCURRENCY,
+            max_keepalive_connections=ASYNC_LLM_MAX_CONCURRENCY
+        )
+    )
+)
+
+# 與同步閘道共用斷路器與准入控制，背景執行緒（預先解讀、每日內容）與事件迴圈看到同一個上游狀態、排同一個佇列
+llm_gateway = AsyncLLMGateway(
+    openai_client,
+    model=core.LLM_MODEL,
+    timeouts=core.LLM_MODE_TIMEOUTS,
+    default_timeout=core.LLM_TIMEOUT,
+    max_attempts=core.LLM_MAX_ATTEMPTS,
+    max_concurrency=ASYNC_LLM_MAX_CONCURRENCY,
+    breaker=core.llm_gateway.breaker,
+    observer=core.record_llm_call,
+    admission=core.llm_admission
+)
+
+# 同時間相同的提示詞只呼叫一次 OpenAI
+llm_flight = AsyncSingleFlight()
+
+# ===== 初始化 Line Bot（aiohttp 連線需在事件迴圈中建立，見 line_client）=====
+configuration = Configuration(host=core.LINE_API_BASE_URL, access_token=core.LINE_CHANNEL_ACCESS_TOKEN)
+configuration.connection_pool_maxsize = ASYNC_LINE_POOL_SIZE
+messaging_api = None
+
+# 處理中的事件（保留參照，避免工作被回收，關閉時等待完成）
+in_flight = set()
+
+# 每位使用者最後送出的事件，同一位使用者的下一個事件等它完成後才開始
+last_events = {}
+
+
+async def run_store(func, *args):
+    """
+    讀寫使用者狀態 / 次數 / 已處理事件
+    """
+    if INLINE_STORES:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+
+async def ask_ai(prompt: str, system_prompt: str = core.MASTER_SYSTEM_PROMPT, mode: str = "text_only") -> dict:
+    """
+    呼叫 OpenAI 生成回覆（相同提示詞同時只送出一次）
+    """
+    await check_reply_budget(mode)
+    with core.metrics.span("llm", mode=mode):
+        return await llm_flight.do(
+            flight_key(system_prompt, prompt),
+            lambda: llm_gateway.complete_json(system_prompt, prompt, mode=mode, priority=core.event_priority.get())
+        )
+
+
+async def request_image(user_id: str, prompt: str, push: bool = True, mode: str = "full", is_vip: bool = False) -> str:
+    """
+    建立圖片生成預測後立即返回，完成時由 /replicate/webhook 推播
+    Returns: prediction id，建立失敗時回傳 None
+    """
+    profile, key, params = core.image_request(user_id, prompt, push, mode, is_vip)
+
+    if not await core.image_admission.acquire_async({"requests": 1}, core.user_priority(user_id)):
+        return None
+
+    try:
+        with core.metrics.span("image_create", mode=mode, profile=profile.name):
+            prediction = await core.replicate_client.predictions.async_create(**params)
+    except Exception as e:
+        logger.error(f"Replicate 錯誤: {e}")
+        return None
+
+    core.image_tracker.add(prediction.id, user_id, push, key, profile.name)
+    return prediction.id
+
+
+# ===== Line Webhook 端點 =====
+async def callback(request: web.Request) -> web.Response:
+    signature = request.headers.get("X-Line-Signature", "")
+    body = await request.text()
+    rid = os.urandom(6).hex()
+    request_id.set(rid)
+
+    # 只在請求中驗證簽章，實際處理交給背景工作
+    try:
+        payload = core.handler.parser.parse(body, signature, as_payload=True)
+    except InvalidSignatureError:
+        logger.error("簽章驗證失敗")
+        raise web.HTTPBadRequest()
+
+    core.event_log.info("webhook", "收到 Webhook", events=len(payload.events), bytes=len(body))
+
+    if len(in_flight) + len(payload.events) > ASYNC_MAX_IN_FLIGHT:
+        logger.warning("處理中的事件已達上限，請 LINE 稍後重送")
+        raise web.HTTPServiceUnavailable()
+
+    # 每個事件各自一個工作同時處理，同一位使用者的事件依序處理
+    received = time.perf_counter()
+    for event in payload.events:
+        key = core.event_order_key(event)
+        task = asyncio.create_task(handle_event(event, rid, received, last_events.get(key)))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        if key is not None:
+            last_events[key] = task
+            task.add_done_callback(functools.partial(forget_last_event, key))
+    return web.Response(text="OK")
+
+
+def forget_last_event(key: str, task: asyncio.Task):
+    if last_events.get(key) is task:
+        del last_events[key]
+
+
+async def handle_event(event, rid: str, received: float, previous: asyncio.Task = None):
+    """
+    處理單一事件；previous 為同一位使用者前一個事件的工作
+    """
+    request_id.set(rid)
+    if previous is not None:
+        await asyncio.wait([previous])
+    core.metrics.observe("stage_seconds", time.perf_counter() - received, stage="event_wait",
+                         mode=getattr(event, "type", ""))
+    webhook_event_id = getattr(event, "webhook_event_id", "") or ""
+    event_id.set(webhook_event_id)
+    try:
+        if not await run_store(core.claim_event, event, webhook_event_id):
+            return
+        await dispatch_event(event)
+    except Exception:
+        logger.exception("處理事件失敗")
+
+
+async def dispatch_event(event):
+    """
+    依事件類型執行對應的處理函數
+    """
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        func = handle_text_message
+    elif isinstance(event, FollowEvent):
+        func = handle_follow
+    else:
+        return
+    # 整個事件的耗時，mode 預設為事件類型，文字訊息判斷出回覆模式後改為該模式
+    window = core.open_reply_window(event)
+    with core.metrics.span("event", mode=getattr(event, "type", "")) as labels, core.event_context(event, labels, window):
+        timer = asyncio.create_task(interim_timer(window)) if window is not None else None
+        try:
+            await func(event)
+        finally:
+            if window is not None:
+                window.close()
+                timer.cancel()
+
+
+async def interim_timer(window):
+    """
+    到了 window.interim_at 仍未回覆時先回「解讀中」
+    """
+    await asyncio.sleep(max(0.0, window.interim_at - time.time()))
+    await send_interim(window, "timer")
+
+
+async def send_interim(window, reason: str):
+    """
+    用 Reply Token 先回「解讀中」，正式結果之後以 Push 送出
+    """
+    if not window.claim_interim():
+        return
+    core.metrics.inc("reply_interim_total", reason=reason)
+    try:
+        await call_line("reply", messaging_api.reply_message, core.interim_request(window))
+    except Exception as e:
+        logger.error(f"回覆「解讀中」失敗: {e}")
+
+
+async def check_reply_budget(mode: str):
+    """
+    呼叫 LLM 前檢查剩餘時間，來不及在 Reply Token 過期前回覆時先回「解讀中」
+    """
+    if core.interim_due(mode):
+        await send_interim(core.reply_window.get(), "budget")
+
+
+async def call_line(kind: str, func, request_body):
+    """
+    呼叫 Messaging API 並記錄耗時與失敗次數（所有送出都經過這裡）
+    """
+    with core.metrics.span(f"line_{kind}"):
+        try:
+            response = await func(request_body, _request_timeout=core.LINE_TIMEOUT)
+        except Exception:
+            core.metrics.inc("line_send_errors_total", kind=kind)
+            raise
+    core.event_log.info("reply", "已送出訊息", kind=kind, messages=len(request_body.messages))
+    return response
+
+
+async def send_reply(event, messages: list):
+    """
+    回覆訊息給使用者；Reply Token 已用來回「解讀中」或已過期時改用 Push 訊息
+    """
+    if core.claim_reply_token(event):
+        try:
+            await call_line(
+                "reply",
+                messaging_api.reply_message,
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=messages
+                )
+            )
+            core.metrics.inc("reply_path_total", path="reply")
+            return
+        except ApiException as e:
+            # 400 代表 Reply Token 已失效，其他錯誤不重送
+            if e.status != 400:
+                logger.error(f"回覆訊息失敗: {e}")
+                core.metrics.inc("reply_path_total", path="failed")
+                return
+            path = "fallback_push"
+        except Exception as e:
+            logger.error(f"回覆訊息失敗: {e}")
+            core.metrics.inc("reply_path_total", path="failed")
+            return
+    else:
+        path = core.push_path()
+
+    user_id = getattr(event.source, "user_id", None)
+    if not user_id:
+        logger.error("Reply Token 已過期且無法取得使用者，放棄回覆")
+        core.metrics.inc("reply_path_total", path="failed")
+        return
+
+    core.metrics.inc("reply_path_total", path=path)
+    await push_messages(user_id, messages)
+
+
+async def push_messages(user_id: str, messages: list):
+    """
+    以 Push 訊息傳送給使用者
+    """
+    try:
+        await call_line(
+            "push",
+            messaging_api.push_message,
+            PushMessageRequest(to=user_id, messages=messages)
+        )
+    except Exception as e:
+        logger.error(f"推播訊息失敗: {e}")
+
+
+async def reply_error(event):
+    """
+    讀取失敗：退還這個事件扣的次數並回覆錯誤訊息
+    """
+    await reply_uncharged(event, core.ERROR_MESSAGE)
+
+
+async def reply_uncharged(event, text: str):
+    """
+    沒有給出解讀（錯誤、缺少內容時的說明）：退還這個事件扣的次數後回覆
+    """
+    await run_store(core.refund_event_usage)
+    await reply_with_quick_actions(event, text)
+
+
+async def reply_with_quick_actions(event, text: str):
+    """
+    回覆訊息並附上快速操作按鈕
+    """
+    await send_reply(event, [core.quick_actions_message(text)])
+
+
+# ===== 歡迎訊息（加入好友時觸發）=====
+async def handle_follow(event: FollowEvent):
+    """
+    當使用者加入好友時，發送歡迎訊息
+    """
+    await send_reply(event, [TextMessage(text=core.WELCOME_MESSAGE)])
+
+
+async def handle_text_message(event: MessageEvent):
+    """
+    處理文字訊息事件（功能判斷與扣次數和同步版本相同）
+    """
+    user_id = event.source.user_id
+    user_message = event.message.text.strip()
+    mode, extra_data, remaining, is_vip, cached = await run_store(core.route_text_message, user_id, user_message)
+
+    if mode == "tarot_select":
+        await handle_card_selection(event, user_id, user_message)
+    elif mode == "help":
+        await reply_with_quick_actions(event, core.HELP_MESSAGE)
+    elif mode == "limit":
+        await reply_with_quick_actions(event, core.LIMIT_MESSAGE)
+    elif mode == "busy":
+        await reply_with_quick_actions(event, core.BUSY_MESSAGE)
+    elif mode == "daily_fortune":
+        await handle_daily_fortune(event, remaining, is_vip)
+    elif mode == "fortune_stick":
+        await handle_fortune_stick(event, remaining, is_vip)
+    elif mode == "almanac":
+        await handle_almanac(event, remaining, is_vip)
+    elif mode == "dream":
+        await handle_dream(event, extra_data, remaining, is_vip)
+    elif mode == "zodiac":
+        await handle_zodiac(event, extra_data, remaining, is_vip)
+    elif mode == "chinese_zodiac":
+        await handle_chinese_zodiac(event, extra_data, remaining, is_vip)
+    elif mode == "match":
+        await handle_match(event, extra_data, remaining, is_vip)
+    elif mode == "number":
+        await handle_number(event, extra_data, remaining, is_vip)
+    elif mode == "tarot":
+        await start_tarot_reading(event, user_id, user_message, remaining, is_vip)
+    elif mode == "full":
+        await handle_full_mode(event, user_message, remaining, is_vip, cached)
+    else:
+        await handle_text_only(event, user_message, remaining, is_vip)
+
+
+async def handle_daily_fortune(event, remaining: int = 0, is_vip: bool = False):
+    """
+    處理每日幸運指數
+    """
+    now = core.taipei_now()
+    fortune = await asyncio.to_thread(core.get_daily_fortune, now.date(), event.source.user_id)
+    if fortune is None:
+        await reply_error(event)
+        return
+
+    reply_text = core.render_daily_fortune(fortune, now.strftime("%m/%d"))
+    reply_text += core.get_remaining_text(remaining, is_vip)
+    await send_reply(event, [core.daily_fortune_message(reply_text)])
+
+
+async def handle_fortune_stick(event, remaining: int = 0, is_vip: bool = False):
+    """
+    抽籤詩功能
+    """
+    stick = random.choice(core.FORTUNE_STICKS)
+    reply_text = core.render_fortune_stick(stick)
+    reply_text += core.get_remaining_text(remaining, is_vip)
+    await reply_with_quick_actions(event, reply_text)
+
+
+async def handle_almanac(event, remaining: int = 0, is_vip: bool = False):
+    """
+    今日黃曆
+    """
+    now = core.taipei_now()
+    result = await asyncio.to_thread(core.get_almanac, now.date())
+    if result is None:
+        await reply_error(event)
+        return
+
+    reply_text = core.render_almanac(result, now.strftime("%m月%d日"))
+    reply_text += core.get_remaining_text(remaining, is_vip)
+    await reply_with_quick_actions(event, reply_text)
+
+
+async def handle_dream(event, dream_content: str, remaining: int = 0, is_vip: bool = False):
+    """
+    解夢功能
+    """
+    if not dream_content:
+        await reply_uncharged(event, core.DREAM_HELP_MESSAGE)
+        return
+
+    result = await ask_ai(core.dream_prompt(dream_content), core.DREAM_PROMPT, mode="dream")
+    if result is None:
+        await reply_error(event)
+        return
+
+    reply_text = core.render_dream(result)
+    reply_text += core.get_remaining_text(remaining, is_vip)
+    await reply_with_quick_actions(event, reply_text)
+
+
+async def handle_zodiac(event, sign: str, remaining: int = 0, is_vip: bool = False):
+    """
+    星座運勢
+    """
+    now = core.taipei_now()
+    result = await asyncio.to_thread(core.get_zodiac_fortune, sign, now.date())
+    if result is None:
+        await reply_error(event)
+        return
+
+    reply_text = core.render_zodiac(result, sign, now.strftime("%m/%d"))
+    reply_text += core.get_remaining_text(remaining, is_vip)
+    await reply_with_quick_actions(event, reply_text)
+
+
+async def handle_chinese_zodiac(event, zodiac: str, remaining: int = 0, is_vip: bool = False):
+    """
+    生肖運勢
+    """
+    now = core.taipei_now()
+    result = await asyncio.to_thread(core.get_chinese_zodiac_fortune, zodiac, now.date())
+    if result is None:
+        await reply_error(event)
+        return
+
+    reply_text = core.render_chinese_zodiac(result, zodiac, now.strftime("%m/%d"))
+    reply_text += core.get_remaining_text(remaining, is_vip)
+    await reply_with_quick_actions(event, reply_text)
+
+
+async def handle_match(event, message: str, remaining: int = 0, is_vip: bool = False):
+    """
+    配對測試
+    """
+    signs = core.match_signs(message)
+    if signs is None:
+        await reply_uncharged(event, core.MATCH_HELP_MESSAGE)
+        return
+
+    sign1, sign2 = signs
+    result = await asyncio.to_thread(core.match_store.get_or_compute, sign1, sign2, core.ask_match)
+    if result is None:
+        await reply_error(event)
+        return
+
+    reply_text = core.render_match(result, sign1, sign2)
+    reply_text += core.get_remaining_text(remaining, is_vip)
+    await reply_with_quick_actions(event, reply_text)
+
+
+async def handle_number(event, number: str, remaining: int = 0, is_vip: bool = False):
+    """
+    數字占卜
+    """
+    if not number:
+        await reply_uncharged(event, core.NUMBER_HELP_MESSAGE)
+        return
+
+    result = await ask_ai(core.number_prompt(number), core.NUMBER_PROMPT, mode="number")
+    if result is None:
+        await reply_error(event)
+        return
+
+    reply_text = core.render_number(result, number)
+    reply_text += core.get_remaining_text(remaining, is_vip)
+    await reply_with_quick_actions(event, reply_text)
+
+
+async def start_tarot_reading(event, user_id: str, question: str, remaining: int = 0, is_vip: bool = False):
+    """
+    開始塔羅牌占卜：抽三張牌讓使用者選
+    """
+    await run_store(core.begin_tarot_reading, user_id, question, remaining, is_vip)
+    await send_reply(event, [core.card_choice_message(core.render_tarot_draw(remaining, is_vip))])
+
+
+async def handle_card_selection(event, user_id: str, selection: str):
+    """
+    處理使用者選牌
+    """
+    choice = core.parse_card_choice(selection)
+    if choice is None:
+        await send_reply(event, [core.card_choice_message(core.CARD_CHOICE_HINT)])
+        return
+
+    # 取出並刪除狀態，避免重複選牌
+    state = await run_store(core.tarot_sessions.pop, user_id)
+    if state is None:
+        await reply_with_quick_actions(event, core.TAROT_NOT_STARTED_MESSAGE)
+        return
+
+    card_index = state.cards[choice]
+    selected_card = core.TAROT_CARDS[card_index]
+
+    # AI 解讀（有預先計算的結果就直接使用；預先計算在背景執行緒中進行，取結果時可能要等它算完）
+    ai_result = await asyncio.to_thread(core.tarot_speculator.take, user_id, state.cards, choice)
+    if ai_result is None:
+        ai_result = await ask_ai(
+            core.tarot_prompt(state.question, selected_card), core.TAROT_SYSTEM_PROMPT, mode="tarot"
+        )
+
+    if ai_result is None:
+        # 次數在抽牌時已扣除
+        await run_store(core.refund_usage, user_id, state.charged_day)
+        await reply_error(event)
+        return
+
+    text_reply = ai_result.get("reply", core.ERROR_MESSAGE)
+    image_prompt = ai_result.get("image_prompt", "")
+
+    full_reply = core.render_tarot_reading(choice, selected_card, text_reply)
+
+    # 優先使用圖庫中的牌面或已生成過的圖片，都沒有時圖片完成後再推播
+    image_url, preview_url = core.card_library.pick(card_index) or (None, None)
+    if image_url is None and image_prompt:
+        image_url, preview_url = core.cached_image(image_prompt) or (None, None)
+        if image_url is None and await request_image(user_id, image_prompt, mode="tarot", is_vip=state.is_vip):
+            full_reply += core.IMAGE_PENDING_NOTE
+
+    await send_reply(event, core.user_messages(full_reply, image_url, preview_url))
+
+
+async def handle_text_only(event, user_message: str, remaining: int = 0, is_vip: bool = False):
+    """
+    純文字模式（快速回覆）
+    """
+    ai_result = await ask_ai(user_message)
+    if ai_result is None:
+        await reply_error(event)
+        return
+
+    text_reply = ai_result.get("reply", core.ERROR_MESSAGE)
+
+    # 保留回答，使用者點「附圖回覆」時直接沿用（可選擇先開始生成圖片，完成前不推播）
+    user_id = event.source.user_id
+    image_prompt = ai_result.get("image_prompt", "")
+    image_prediction = None
+    if core.wants_prerender(image_prompt, is_vip):
+        image_prediction = await request_image(user_id, image_prompt, push=False, is_vip=is_vip)
+    core.recent_answers.put(user_id, user_message, core.RecentAnswer(text_reply, image_prompt, image_prediction))
+
+    text_reply += core.get_remaining_text(remaining, is_vip)
+    await send_reply(event, [core.text_only_message(text_reply, user_message)])
+
+
+async def handle_full_mode(event, user_message: str, remaining: int = 0, is_vip: bool = False,
+                           cached: core.RecentAnswer = None):
+    """
+    完整圖文模式（cached 為剛才的純文字回答時，直接生成圖片）
+    文字立即回覆，圖片生成完成後再推播
+    """
+    image_prediction = None
+    if cached is not None:
+        text_reply = cached.reply
+        image_prompt = cached.image_prompt
+        image_prediction = cached.image_prediction
+    else:
+        ai_result = await ask_ai(user_message, mode="full")
+        if ai_result is None:
+            await reply_error(event)
+            return
+        text_reply = ai_result.get("reply", core.ERROR_MESSAGE)
+        image_prompt = ai_result.get("image_prompt", "")
+
+    text_reply += core.get_remaining_text(remaining, is_vip)
+
+    # 已生成過（含預先生成且已完成）的圖片直接一起回覆，還在生成就改為完成後推播
+    image_url = preview_url = None
+    tracked = False
+    if image_prompt:
+        image_url, preview_url = core.cached_image(image_prompt) or (None, None)
+    if image_url is None and image_prediction is not None:
+        tracked, image_url = core.image_tracker.claim(image_prediction)
+    if image_url is None and not tracked and image_prompt:
+        tracked = await request_image(event.source.user_id, image_prompt, is_vip=is_vip) is not None
+    if tracked and image_url is None:
+        text_reply += core.IMAGE_PENDING_NOTE
+
+    await send_reply(event, core.user_messages(text_reply, image_url, preview_url))
+
+
+# ===== Replicate 預測完成通知 =====
+async def replicate_webhook(request: web.Request) -> web.Response:
+    user_id = request.query.get("user", "")
+    push = request.query.get("push") == "1"
+    key = request.query.get("key", "")
+    if not verify_webhook_token(core.IMAGE_WEBHOOK_SECRET, user_id, push, key, request.query.get("token")):
+        raise web.HTTPForbidden()
+
+    try:
+        prediction = await request.json()
+    except ValueError:
+        prediction = {}
+    if not isinstance(prediction, dict) or "id" not in prediction:
+        raise web.HTTPBadRequest()
+
+    # 下載圖片與推播在執行緒中進行，立即回應 Replicate
+    if prediction.get("status") in ("succeeded", "failed", "canceled"):
+        task = asyncio.create_task(asyncio.to_thread(
+            core.finish_prediction, prediction["id"], prediction["status"], prediction.get("output"), user_id, push, key
+        ))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    return web.Response(text="OK")
+
+
+# ===== 圖片快取與塔羅牌圖庫檔案 =====
+def static_file(directory: str, filename: str) -> web.FileResponse:
+    # 檔名是內容的雜湊或固定不變，允許客戶端長期快取
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        raise web.HTTPNotFound()
+    return web.FileResponse(path, headers={"Cache-Control": f"public, max-age={365 * 24 * 3600}"})
+
+
+async def cached_image_file(request: web.Request) -> web.FileResponse:
+    return static_file(core.IMAGE_STORE_DIR, request.match_info["filename"])
+
+
+async def card_image(request: web.Request) -> web.FileResponse:
+    return static_file(core.CARD_IMAGE_DIR, request.match_info["filename"])
+
+
+# ===== 執行統計端點 =====
+core.metrics.register_stats("async_events", lambda: {"in_flight": len(in_flight)}, "asyncio 版本處理中的工作")
+core.metrics.register_stats("llm_singleflight_async", llm_flight.stats, "相同提示詞合併（asyncio 版本）")
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    if core.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {core.METRICS_TOKEN}":
+        raise web.HTTPUnauthorized()
+    return web.Response(
+        body=core.metrics.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+# ===== 健康檢查端點 =====
+async def health_check(request: web.Request) -> web.Response:
+    return web.Response(text="🔮 AI 命理大師運行中...")
+
+
+# ===== 生命週期 =====
+async def line_client(web_app: web.Application):
+    """
+    建立與關閉 Messaging API 的 aiohttp 連線（整個行程共用並保持連線）
+    """
+    global messaging_api
+    api_client = AsyncApiClient(configuration)
+    messaging_api = AsyncMessagingApi(api_client)
+    yield
+    await api_client.close()
+    await openai_client.close()
+
+
+async def drain(web_app: web.Application):
+    """
+    關閉時在 JOB_DRAIN_TIMEOUT 秒內把處理中的工作做完
+    """
+    if in_flight:
+        _, pending = await asyncio.wait(set(in_flight), timeout=core.JOB_DRAIN_TIMEOUT)
+        if pending:
+            logger.warning("關閉逾時，仍有 %d 筆工作未處理", len(pending))
+
+
+web_app = web.Application()
+web_app.cleanup_ctx.append(line_client)
+web_app.on_shutdown.append(drain)
+web_app.add_routes([
+    web.post("/callback", callback),
+    web.post("/replicate/webhook", replicate_webhook),
+    web.get("/images/{filename:.+}", cached_image_file),
+    web.get("/cards/{filename:.+}", card_image),
+    web.get("/metrics", metrics_endpoint),
+    web.get("/", health_check),
+])
+
+
+# ===== 啟動應用程式 =====
+if __name__ == "__main__":
+    web.run_app(web_app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+每則訊息都會經過的純函數微基準測試
+
+涵蓋意圖判斷、星星與剩餘次數文字、各模式的回覆文字、抽牌與 LLM 回覆的 JSON 解析，
+以真實的中文訊息與回答當輸入。結果與 bench/baselines.json 比較，
+任何一項比基準慢超過 --threshold 時以非零結束碼結束，可放進 CI。
+
+    python bench/bench_hotpaths.py                 # 與基準比較
+    python bench/bench_hotpaths.py --save          # 以本次結果更新基準
+    python bench/bench_hotpaths.py --only render   # 只跑名稱含 render 的項目
+
+基準與機器有關：換機器或 Python 版本時，先在修改前的版本執行 --save 再比較。
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import app  # noqa: E402
+from bench_router import CORPUS  # noqa: E402
+from llm_gateway import parse_json_reply  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+DAILY_FORTUNE = {
+    "overall_stars": 4, "love_stars": 3, "wealth_stars": 5, "work_stars": 2,
+    "lucky_number": 8, "lucky_color": "琥珀金", "lucky_direction": "東南方",
+    "advice": "今日貴人運旺，遇到困難不妨開口請教前輩，會有意想不到的收穫。",
+    "warning": "午後易有口舌是非，說話前多想三秒。",
+}
+ALMANAC = {
+    "suitable": ["祭祀", "祈福", "出行", "納財", "開市"],
+    "avoid": ["動土", "破土", "安葬"],
+    "lucky_god_direction": "正北", "clash": "沖猴（戊申）煞北",
+    "advice": "吉日宜守成，適合處理擱置已久的文書與帳務，不宜大興土木。",
+}
+DREAM = {
+    "dream_type": "預兆夢",
+    "interpretation": "夢見在天空飛翔象徵渴望擺脫束縛，墜入海中則代表情緒尚未找到出口，近期宜正視內心的壓力。",
+    "advice": "放慢腳步，把煩惱寫下來逐一拆解。", "lucky_action": "到水邊散步並深呼吸十次",
+}
+ZODIAC = {
+    "overall": 4, "love": 5, "career": 3, "wealth": 3, "lucky_number": 3, "lucky_color": "湖水藍",
+    "advice": "獅子座今天魅力十足，適合主動表達想法，但記得聆聽他人的聲音。",
+}
+CHINESE_ZODIAC = {
+    "overall": 3, "wealth": 4, "love": 2, "health": 4, "lucky_direction": "西北", "lucky_time": "辰時（7-9點）",
+    "advice": "屬龍的朋友今日財星入宮，正財穩健，偏財則需謹慎。",
+}
+MATCH = {
+    "match_score": 82, "love_score": 88, "friend_score": 76, "work_score": 71,
+    "analysis": "牡羊座的熱情與天秤座的優雅互補，一動一靜之間容易擦出火花，但節奏不同時需要多溝通。",
+    "advice": "牡羊座多一點耐心，天秤座多一點果斷。",
+}
+NUMBER = {
+    "number_meaning": "8 在東方文化象徵發達與圓滿，代表循環不息的財富能量。",
+    "energy": "土，穩重踏實", "fortune": "近期與此數字有緣，適合在投資與談判時作為參考。",
+    "advice": "可選擇尾數 8 的日期處理重要事務。", "lucky_day": "農曆初八、十八、二十八",
+}
+TAROT_REPLY = (
+    "🔮 汝所抽之牌為【命運之輪】，象徵轉機已至。過去的努力即將開花結果，"
+    "但切記順勢而為，不可強求。\n\n💡 把握未來兩週的機會，主動出擊。"
+)
+
+# LLM 回覆：有無 ```json 外框、前後空白、較長的中文內容
+LLM_REPLIES = [
+    json.dumps({"reply": TAROT_REPLY, "image_prompt": "A tarot card wheel of fortune, mystical neon"}, ensure_ascii=False),
+    "```json\n" + json.dumps({"reply": "🔮 近期財運穩中帶升，宜守不宜攻。", "image_prompt": "golden coins"}, ensure_ascii=False) + "\n```",
+    "```\n" + json.dumps(DAILY_FORTUNE, ensure_ascii=False, indent=2) + "\n```",
+    "  " + json.dumps(MATCH, ensure_ascii=False) + "\n",
+]
+
+
+def cases() -> dict:
+    """
+    {名稱: (函數, 參數列表)}，每項以「對參數列表各呼叫一次」為一輪
+    """
+    return {
+        "get_reply_mode": (app.get_reply_mode, [(message,) for message in CORPUS]),
+        "reply_router.classify": (app.reply_router.classify, [(message,) for message in CORPUS]),
+        "format_stars": (app.format_stars, [(count,) for count in range(6)]),
+        "get_remaining_text": (app.get_remaining_text, [(2, False), (0, False), (0, True)]),
+        "render_daily_fortune": (app.render_daily_fortune, [(DAILY_FORTUNE, "06/15"), ({}, "06/16")]),
+        "render_fortune_stick": (app.render_fortune_stick, [(stick,) for stick in app.FORTUNE_STICKS]),
+        "render_almanac": (app.render_almanac, [(ALMANAC, "06月15日"), ({}, "06月16日")]),
+        "render_dream": (app.render_dream, [(DREAM,), ({},)]),
+        "render_zodiac": (app.render_zodiac, [(ZODIAC, "獅子座", "06/15"), ({}, "雙魚座", "06/15")]),
+        "render_chinese_zodiac": (app.render_chinese_zodiac, [(CHINESE_ZODIAC, "龍", "06/15"), ({}, "虎", "06/15")]),
+        "render_match": (app.render_match, [(MATCH, "牡羊座", "天秤座"), ({"match_score": 35}, "獅子座", "獅子座")]),
+        "render_number": (app.render_number, [(NUMBER, "8"), ({}, "168")]),
+        "render_tarot_reading": (app.render_tarot_reading, [(1, "命運之輪", TAROT_REPLY)]),
+        "draw_three_cards": (app.draw_three_cards, [()]),
+        "parse_json_reply": (parse_json_reply, [(reply,) for reply in LLM_REPLIES]),
+    }
+
+
+def per_call_ns(func, calls: list, min_seconds: float) -> float:
+    def run():
+        for args in calls:
+            func(*args)
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_seconds / 0.2))
+    best = min(timer.repeat(repeat=7, number=number))
+    return best / (number * len(calls)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--save", action="store_true", help="以本次結果覆寫基準")
+    parser.add_argument("--baseline", default=BASELINES, help="基準檔案")
+    parser.add_argument("--threshold", type=float, default=0.3, help="比基準慢超過此比例視為退步")
+    parser.add_argument("--min-time", type=float, default=0.2, help="每次計時至少執行的秒數")
+    parser.add_argument("--only", default="", help="只跑名稱包含此字串的項目")
+    args = parser.parse_args()
+
+    random.seed(0)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+
+    results = {}
+    regressions = []
+    print(f"{'項目':24s} {'ns/次':>10s} {'基準':>10s} {'變化':>8s}")
+    for name, (func, calls) in cases().items():
+        if args.only not in name:
+            continue
+        ns = results[name] = per_call_ns(func, calls, args.min_time)
+        base = baseline.get(name)
+        if base:
+            change = ns / base - 1
+            flag = "  ⚠️ 退步" if change > args.threshold else ""
+            if flag:
+                regressions.append(name)
+            print(f"{name:24s} {ns:10,.0f} {base:10,.0f} {change:+8.1%}{flag}")
+        else:
+            print(f"{name:24s} {ns:10,.0f} {'-':>10s} {'-':>8s}")
+
+    if args.save:
+        saved = dict(baseline, **results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": {name: round(ns, 1) for name, ns in sorted(saved.items())},
+            }, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"\n已更新基準：{args.baseline}")
+    elif regressions:
+        print(f"\n{len(regressions)} 項比基準慢超過 {args.threshold:.0%}：{', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
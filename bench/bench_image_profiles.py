@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+圖片生成設定檔的耗時測試
+
+對每個設定檔同時送出多個預測並輪詢到完成，統計 p50 / p95，
+再用量測結果示範 p95 超過預算時的自動降級。預設對本機假 Replicate 伺服器測試
+（推論耗時與像素數、步數成正比）；加上 --base-url 與 REPLICATE_API_TOKEN 可對真正的服務測試。
+
+    python bench/bench_image_profiles.py [--requests 20] [--concurrency 5] [--delay 2]
+"""
+
+import argparse
+import math
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import replicate  # noqa: E402
+
+import app  # noqa: E402
+from fake_replicate import FakeReplicate  # noqa: E402
+from image_profiles import ProfileSelector, RenderStats  # noqa: E402
+
+PROMPT = "A mystical fortune teller, cyberpunk oriental style, glowing neon lights"
+
+
+def render_once(client, profile, poll: float) -> float:
+    started = time.perf_counter()
+    prediction = client.predictions.create(version=profile.version, input={"prompt": PROMPT, **profile.params})
+    while prediction.status not in ("succeeded", "failed", "canceled"):
+        time.sleep(poll)
+        prediction = client.predictions.get(prediction.id)
+    if prediction.status != "succeeded":
+        raise RuntimeError(f"預測失敗：{prediction.status}")
+    return time.perf_counter() - started
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="每個設定檔的預測數")
+    parser.add_argument("--concurrency", type=int, default=5, help="同時進行的預測數")
+    parser.add_argument("--delay", type=float, default=2.0, help="假伺服器 1024x1024、25 步的推論秒數")
+    parser.add_argument("--poll", type=float, default=0.05, help="輪詢間隔秒數")
+    parser.add_argument("--budget", type=float, default=None, help="降級示範的 p95 預算（預設取兩者中間）")
+    parser.add_argument("--base-url", default=None, help="Replicate API 位址（未指定時啟動假伺服器）")
+    args = parser.parse_args()
+
+    fake = None
+    base_url = args.base_url
+    if base_url is None:
+        fake = FakeReplicate(delay=args.delay)
+        base_url = fake.start()
+    client = replicate.Client(api_token=os.getenv("REPLICATE_API_TOKEN", "bench"), base_url=base_url)
+
+    stats = RenderStats()
+    results = {}
+    for name, profile in app.IMAGE_PROFILES.items():
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            durations = list(pool.map(lambda _: render_once(client, profile, args.poll), range(args.requests)))
+        elapsed = time.perf_counter() - started
+        for seconds in durations:
+            stats.record(name, seconds)
+        results[name] = durations
+        params = profile.params
+        print(
+            f"{name:8s} {params['width']}x{params['height']} {params['num_inference_steps']:2d} 步："
+            f"p50 {percentile(durations, 50):.2f}s  p95 {percentile(durations, 95):.2f}s  "
+            f"平均 {statistics.mean(durations):.2f}s  {args.requests / elapsed:.2f} 張/秒"
+        )
+
+    quality_p95 = percentile(results["quality"], 95)
+    fast_p95 = percentile(results["fast"], 95)
+    budget = args.budget if args.budget is not None else (quality_p95 + fast_p95) / 2
+    selector = ProfileSelector(
+        app.IMAGE_PROFILES, app.IMAGE_MODE_PROFILES, default="quality", vip_profile=app.IMAGE_PROFILE_VIP,
+        fallback="fast", budget=budget, stats=stats, min_samples=min(10, args.requests)
+    )
+    print(f"\np95 預算 {budget:.2f}s：")
+    for mode, is_vip in [("full", False), ("full", True), ("tarot", False)]:
+        configured = app.IMAGE_PROFILE_VIP if is_vip else app.IMAGE_MODE_PROFILES.get(mode, "quality")
+        chosen = selector.choose(mode, is_vip).name
+        note = "（降級）" if chosen != configured else ""
+        print(f"  {mode:6s} {'VIP' if is_vip else '一般'}：設定 {configured} → 使用 {chosen}{note}")
+
+    if fake is not None:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
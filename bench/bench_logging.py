@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+日誌在請求執行緒上的成本
+
+比較舊寫法（每個請求以 f-string 記錄整個 Webhook 內容，StreamHandler 同步寫入）
+與結構化日誌（只放入佇列、依事件類型抽樣、由背景執行緒格式化輸出），
+量測呼叫端每個請求花在日誌上的時間。輸出寫到 os.devnull，不含磁碟延遲。
+
+    python bench/bench_logging.py [--requests 20000] [--sample 0.1]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from structured_logging import (  # noqa: E402
+    ContextFilter,
+    EventLogger,
+    JsonFormatter,
+    NonBlockingQueueHandler,
+    request_id,
+)
+
+BODY = json.dumps({
+    "destination": "Uxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx",
+    "events": [{
+        "type": "message", "mode": "active", "timestamp": 1700000000000,
+        "source": {"type": "user", "userId": "U" + "0123456789abcdef" * 2},
+        "webhookEventId": "01HEXAMPLEEVENTID", "deliveryContext": {"isRedelivery": False},
+        "replyToken": "0f3779fba3b349968c5d07db31eab56f",
+        "message": {"type": "text", "id": "468789577898262530", "quoteToken": "q" * 40,
+                    "text": "我最近工作上遇到很多挫折，想問問今年下半年的事業運勢如何？"},
+    }],
+}, ensure_ascii=False)
+
+
+def per_request_us(logger, requests: int, structured: bool) -> float:
+    started = time.perf_counter()
+    for index in range(requests):
+        if structured:
+            request_id.set(str(index))
+            logger.info("webhook", "收到 Webhook", events=1, bytes=len(BODY))
+            logger.info("message", "收到訊息", user="U" + "0" * 32, chars=30)
+        else:
+            logger.info(f"收到請求: {BODY}")
+            logger.info(f"使用者 U{'0' * 32} 訊息: 我最近工作上遇到很多挫折")
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--sample", type=float, default=0.1, help="webhook / message 的抽樣比例")
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, "w", encoding="utf-8")
+
+    legacy = logging.getLogger("bench.legacy")
+    legacy.propagate = False
+    legacy.setLevel(logging.INFO)
+    stream = logging.StreamHandler(devnull)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    legacy.addHandler(stream)
+
+    results = {"舊寫法（同步寫出整個內容）": per_request_us(legacy, args.requests, structured=False)}
+
+    from logging.handlers import QueueListener
+    import queue
+
+    for label, rate in [("結構化（全部保留）", 1.0), (f"結構化（抽樣 {args.sample:g}）", args.sample)]:
+        log_queue = queue.Queue(maxsize=args.requests * 2)
+        handler = NonBlockingQueueHandler(log_queue)
+        handler.addFilter(ContextFilter())
+        output = logging.StreamHandler(devnull)
+        output.setFormatter(JsonFormatter())
+        listener = QueueListener(log_queue, output)
+        listener.start()
+
+        logger = logging.getLogger(f"bench.structured.{rate}")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        event_log = EventLogger(logger, {"webhook": rate, "message": rate})
+        results[label] = per_request_us(event_log, args.requests, structured=True)
+        listener.stop()
+
+    for label, us in results.items():
+        print(f"{label}：{us:.1f} µs/請求")
+
+
+if __name__ == "__main__":
+    main()
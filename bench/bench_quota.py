@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+每日次數儲存壓力測試：多個行程 × 多個執行緒同時對少數使用者檢查並扣除次數，
+量測每秒操作數並確認沒有任何使用者被多扣（超過上限）。
+
+    python bench/bench_quota.py                       # memory + sqlite
+    python bench/bench_quota.py --redis-url redis://localhost:6379/15
+    python bench/bench_quota.py --fake-redis          # 使用 fakeredis 當作本機替身
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from quota_store import MemoryQuotaStore, RedisQuotaStore, SQLiteQuotaStore  # noqa: E402
+
+LIMIT = 3
+
+
+def open_store(kind: str, target: str):
+    if kind == "memory":
+        return MemoryQuotaStore()
+    if kind == "sqlite":
+        return SQLiteQuotaStore(target)
+    if kind == "fake-redis":
+        import fakeredis
+        return RedisQuotaStore(client=fakeredis.FakeRedis(server=_FAKE_SERVER))
+    return RedisQuotaStore(target)
+
+
+_FAKE_SERVER = None
+
+
+def hammer(store, day: str, users: int, ops: int, allowed: list):
+    granted = 0
+    for i in range(ops):
+        ok, _ = store.try_consume(f"U{i % users}", day, LIMIT)
+        granted += ok
+    allowed.append(granted)
+
+
+def run_process(kind: str, target: str, day: str, threads: int, users: int, ops: int, queue):
+    store = open_store(kind, target)
+    allowed = []
+    workers = [
+        threading.Thread(target=hammer, args=(store, day, users, ops, allowed))
+        for _ in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    queue.put(sum(allowed))
+
+
+def bench(kind: str, target: str, processes: int, threads: int, users: int, ops: int) -> dict:
+    day = f"bench-{uuid.uuid4().hex[:8]}"
+    started = time.perf_counter()
+
+    if kind in ("memory", "fake-redis"):
+        # 行程內後端只能用執行緒模擬競爭
+        processes = 1
+        queue = multiprocessing.Queue()
+        run_process(kind, target, day, threads, users, ops, queue)
+        granted = queue.get()
+    else:
+        queue = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=run_process, args=(kind, target, day, threads, users, ops, queue))
+            for _ in range(processes)
+        ]
+        for proc in procs:
+            proc.start()
+        granted = sum(queue.get() for _ in procs)
+        for proc in procs:
+            proc.join()
+
+    elapsed = time.perf_counter() - started
+    total = processes * threads * ops
+    return {
+        "backend": kind,
+        "processes": processes,
+        "threads": threads,
+        "ops": total,
+        "ops_per_sec": total / elapsed,
+        "granted": granted,
+        "expected": users * LIMIT,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--ops", type=int, default=2000, help="每個執行緒的操作次數")
+    parser.add_argument("--redis-url")
+    parser.add_argument("--fake-redis", action="store_true")
+    args = parser.parse_args()
+
+    runs = [("memory", None)]
+    tmpdir = tempfile.mkdtemp()
+    runs.append(("sqlite", os.path.join(tmpdir, "quota.db")))
+    if args.fake_redis:
+        global _FAKE_SERVER
+        import fakeredis
+        _FAKE_SERVER = fakeredis.FakeServer()
+        runs.append(("fake-redis", None))
+    if args.redis_url:
+        runs.append(("redis", args.redis_url))
+
+    print(f"{'backend':<12}{'procs':>6}{'threads':>8}{'ops':>10}{'ops/sec':>12}  超扣檢查")
+    for kind, target in runs:
+        result = bench(kind, target, args.processes, args.threads, args.users, args.ops)
+        check = "OK" if result["granted"] == result["expected"] else f"FAIL ({result['granted']} != {result['expected']})"
+        print(
+            f"{result['backend']:<12}{result['processes']:>6}{result['threads']:>8}"
+            f"{result['ops']:>10}{result['ops_per_sec']:>12,.0f}  {check}"
+        )
+
+
+if __name__ == "__main__":
+    main()
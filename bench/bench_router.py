@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+意圖判斷的等價檢查與微基準測試
+
+先用真實訊息與隨機組合的訊息，確認編譯後的 get_reply_mode 與舊版逐一比對的實作
+結果完全相同，再比較兩者每則訊息的平均耗時。
+
+    python bench/bench_router.py [--fuzz 20000] [--rounds 200]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import app  # noqa: E402
+from app import CHINESE_ZODIAC, ZODIAC_SIGNS, get_reply_mode  # noqa: E402
+
+
+def legacy_get_reply_mode(message: str) -> tuple:
+    """
+    改寫前的版本（逐一 any(keyword in message) 比對），作為等價基準
+    """
+    if any(keyword in message for keyword in ["說明", "幫助", "help", "指令", "怎麼用"]):
+        return ("help", None)
+    if any(keyword in message for keyword in ["今日運勢", "今天運勢", "每日運勢", "今天運氣", "幸運指數"]):
+        return ("daily_fortune", None)
+    if any(keyword in message for keyword in ["抽籤", "求籤", "籤詩", "抽個籤"]):
+        return ("fortune_stick", None)
+    if any(keyword in message for keyword in ["黃曆", "黃歷", "宜忌", "今日宜"]):
+        return ("almanac", None)
+    if "解夢" in message:
+        dream_content = message.replace("解夢", "").strip()
+        return ("dream", dream_content if dream_content else None)
+    if any(keyword in message for keyword in ["配對", "速配", "合不合"]):
+        return ("match", message)
+    if "數字" in message:
+        numbers = re.findall(r'\d+', message)
+        return ("number", numbers[0] if numbers else None)
+    for sign in ZODIAC_SIGNS:
+        if sign in message:
+            return ("zodiac", sign)
+    for zodiac in CHINESE_ZODIAC:
+        if f"屬{zodiac}" in message or zodiac == message:
+            return ("chinese_zodiac", zodiac)
+    if any(keyword in message for keyword in ["抽牌", "塔羅", "占卜", "抽卡"]):
+        return ("tarot", message)
+    if any(keyword in message for keyword in ["要圖", "圖文", "完整", "附圖"]):
+        return ("full", message)
+    return ("text_only", message)
+
+
+# 常見的真實訊息
+CORPUS = [
+    "今日運勢", "抽籤", "占卜", "占卜 我的感情會順利嗎", "黃曆", "說明", "help",
+    "解夢 我夢到在天空飛，然後掉進海裡", "解夢", "配對 牡羊座 天秤座", "獅子座配雙子座",
+    "數字 8", "數字 168 代表什麼", "數字", "獅子座", "我是雙魚座的，今天適合告白嗎",
+    "屬龍", "屬虎的人今年運勢", "龍", "豬", "要圖 我最近財運如何？", "我最近財運如何？",
+    "感情方面有什麼建議？", "今年事業運勢怎麼樣？", "塔羅 工作", "抽卡", "1", "2", "3",
+    "今天運氣好嗎", "今日宜忌", "求籤問姻緣", "天蠍座跟處女座合不合", "我想看完整的圖文解析",
+    "幫我占卜一下明天的面試", "我屬馬，想問數字 7", "牡羊座 今日運勢", "解夢 夢到數字 4",
+]
+
+FRAGMENTS = [
+    "今日", "運勢", "抽", "籤", "塔羅", "占卜", "解夢", "夢", "配對", "數字", "屬", "座",
+    "help", "說明", "黃曆", "宜", "忌", "要圖", "完整", "圖文", "7", "88", " ", "我", "的",
+    "感情", "財運", "嗎", "？",
+] + ZODIAC_SIGNS + CHINESE_ZODIAC
+
+
+def fuzz_messages(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        message = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 6))).strip()
+        if message:
+            messages.append(message)
+    return messages
+
+
+def check_equivalence(messages: list) -> int:
+    mismatches = 0
+    for message in messages:
+        expected = legacy_get_reply_mode(message)
+        actual = get_reply_mode(message)
+        if expected != actual:
+            mismatches += 1
+            if mismatches <= 10:
+                print(f"不一致：{message!r} 舊版={expected} 新版={actual}")
+    return mismatches
+
+
+def per_message_ns(func, messages: list, rounds: int) -> float:
+    def run():
+        for message in messages:
+            func(message)
+    seconds = min(timeit.repeat(run, number=rounds, repeat=3))
+    return seconds / (rounds * len(messages)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fuzz", type=int, default=20000, help="隨機訊息數量")
+    parser.add_argument("--rounds", type=int, default=200, help="計時重複次數")
+    args = parser.parse_args()
+
+    messages = CORPUS + fuzz_messages(args.fuzz)
+    mismatches = check_equivalence(messages)
+    print(f"等價檢查：{len(messages)} 則訊息，{mismatches} 則不一致")
+    if mismatches:
+        sys.exit(1)
+
+    legacy = per_message_ns(legacy_get_reply_mode, CORPUS, args.rounds)
+    compiled = per_message_ns(get_reply_mode, CORPUS, args.rounds)
+    print(f"舊版逐一比對：{legacy:,.0f} ns/則")
+    print(f"編譯後單次掃描：{compiled:,.0f} ns/則（{legacy / compiled:.1f}x）")
+    print(f"意圖數：{len(app.REPLY_INTENTS)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+本機假 LINE Messaging API 伺服器（測試與壓力測試用）
+
+實作 reply / push 兩個送訊息的 API，記錄每次送達的時間與訊息內容，
+可設定回應延遲與失敗比例（回傳 500）。
+
+    python bench/fake_line.py [--port 8101] [--delay 0.05] [--fail-rate 0]
+    LINE_API_BASE_URL=http://127.0.0.1:8101 python app.py
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Delivery:
+    """
+    一次送達：kind 為 reply / push，key 為 Reply Token 或收件者 ID
+    """
+    __slots__ = ("kind", "key", "received", "messages")
+
+    def __init__(self, kind: str, key: str, messages: list):
+        self.kind = kind
+        self.key = key
+        self.received = time.perf_counter()
+        self.messages = messages
+
+    @property
+    def texts(self) -> list:
+        return [message.get("text", "") for message in self.messages if message.get("type") == "text"]
+
+    @property
+    def has_image(self) -> bool:
+        return any(message.get("type") == "image" for message in self.messages)
+
+
+class FakeLine:
+    """
+    可在程式中啟動的假伺服器：base_url = FakeLine(delay=0.05).start()
+    wait(key) 等待指定 Reply Token / 使用者收到訊息
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, delay: float = 0.05,
+                 jitter: float = 0.2, fail_rate: float = 0.0):
+        self.delay = delay
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self.failures = 0
+        self._deliveries = {}  # {Reply Token 或使用者 ID: [Delivery]}
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-line", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def wait(self, key: str, timeout: float, predicate=None) -> Delivery:
+        """
+        等待 key 收到第一筆符合 predicate 的訊息，逾時回傳 None
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for delivery in self._deliveries.get(key, ()):
+                    if predicate is None or predicate(delivery):
+                        return delivery
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def forget(self, *keys: str):
+        with self._cond:
+            for key in keys:
+                self._deliveries.pop(key, None)
+
+    def deliver(self, kind: str, body: dict) -> bool:
+        """
+        模擬一次 API 呼叫，回傳 False 表示模擬失敗
+        """
+        time.sleep(max(0.0, self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)))
+        failed = random.random() < self.fail_rate
+        key = body.get("replyToken") if kind == "reply" else body.get("to")
+        with self._cond:
+            self.requests += 1
+            if failed:
+                self.failures += 1
+                return False
+            self._deliveries.setdefault(key, []).append(Delivery(kind, key, body.get("messages", [])))
+            self._cond.notify_all()
+        return True
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, status: int, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                kind = {"/v2/bot/message/reply": "reply", "/v2/bot/message/push": "push"}.get(self.path)
+                if kind is None:
+                    self._json(404, {"message": "Not found"})
+                    return
+                if not fake.deliver(kind, body):
+                    self._json(500, {"message": "fake failure"})
+                    return
+                sent = [{"id": uuid.uuid4().hex[:18], "quoteToken": uuid.uuid4().hex} for _ in body.get("messages", [])]
+                self._json(200, {"sentMessages": sent})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--delay", type=float, default=0.05, help="每次 API 呼叫的回應秒數")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延遲隨機浮動比例")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="回傳 500 的機率")
+    args = parser.parse_args()
+
+    fake = FakeLine(args.host, args.port, args.delay, args.jitter, args.fail_rate)
+    print(f"假 LINE 伺服器：{fake.start()}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
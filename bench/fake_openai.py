@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+本機假 OpenAI 伺服器（測試與壓力測試用）
+
+實作 Chat Completions，回傳一個包含各模式所需欄位的 JSON 回答，
+延遲與 max_tokens 成正比，可設定失敗比例（回傳 500）。
+
+    python bench/fake_openai.py [--port 8102] [--delay 1.5] [--fail-rate 0]
+    OPENAI_BASE_URL=http://127.0.0.1:8102/v1 python app.py
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 涵蓋各模式會讀取的欄位，其餘欄位由 app.py 的預設值補上；image_prompt 每次加上不同編號，避免全部命中圖片快取
+ANSWER = {
+    "reply": "🔮 天象顯示近期運勢平穩，宜靜待時機，穩中求進。",
+    "image_prompt": "A mystical fortune teller, cyberpunk oriental style, glowing neon lights",
+    "overall": 4, "love": 3, "career": 4, "wealth": 3, "health": 4,
+    "lucky_number": 8, "lucky_color": "金色", "lucky_direction": "東方", "lucky_time": "午時",
+    "advice": "保持耐心，好事將近。",
+}
+
+
+class FakeOpenAI:
+    """
+    可在程式中啟動的假伺服器：base_url = FakeOpenAI(delay=1).start() + "/v1"
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, delay: float = 1.5,
+                 jitter: float = 0.2, fail_rate: float = 0.0):
+        self.delay = delay
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def completion_seconds(self, body: dict) -> float:
+        """
+        模擬生成耗時：--delay 為 max_tokens=500（閘道預設值）的耗時
+        """
+        seconds = self.delay * int(body.get("max_tokens") or 500) / 500
+        return max(0.0, seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def complete(self, body: dict) -> dict:
+        """
+        回傳 Chat Completion，None 表示模擬失敗
+        """
+        time.sleep(self.completion_seconds(body))
+        failed = random.random() < self.fail_rate
+        with self._lock:
+            self.requests += 1
+            if failed:
+                self.failures += 1
+                return None
+        answer = dict(ANSWER, image_prompt=f"{ANSWER['image_prompt']}, variation {uuid.uuid4().hex[:8]}")
+        content = json.dumps(answer, ensure_ascii=False)
+        prompt_tokens = sum(len(message.get("content") or "") for message in body.get("messages", []))
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(content),
+                "total_tokens": prompt_tokens + len(content),
+            },
+        }
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _json(self, status: int, data):
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/v1/chat/completions":
+                    self._json(404, {"error": {"message": "Not found"}})
+                    return
+                completion = fake.complete(body)
+                if completion is None:
+                    self._json(500, {"error": {"message": "fake failure", "type": "server_error"}})
+                    return
+                self._json(200, completion)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8102)
+    parser.add_argument("--delay", type=float, default=1.5, help="max_tokens=500 的生成秒數")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延遲隨機浮動比例")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="回傳 500 的機率")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(args.host, args.port, args.delay, args.jitter, args.fail_rate)
+    print(f"假 OpenAI 伺服器：{fake.start()}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+本機假 Replicate 伺服器（測試與壓力測試用）
+
+實作建立 / 查詢 / 取消預測（以及 replicate.run 需要的模型版本查詢），預測在延遲後完成並呼叫建立時帶的 Webhook，
+輸出的圖片網址指向本伺服器提供的小 PNG。延遲依圖片尺寸與步數等比例調整：
+--delay 為 1024x1024、25 步的耗時。
+
+    python bench/fake_replicate.py [--port 8100] [--delay 3] [--fail-rate 0]
+    REPLICATE_BASE_URL=http://127.0.0.1:8100 python app.py
+"""
+
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 1x1 PNG
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+_PREDICTION = re.compile(r"^/v1/predictions/([0-9a-f]+)(/cancel)?$")
+_VERSION = re.compile(r"^/v1/models/[^/]+/[^/]+/versions/([0-9a-f]+)$")
+_IMAGE = re.compile(r"^/images/([0-9a-f]+)\.png$")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeReplicate:
+    """
+    可在程式中啟動的假伺服器：base_url = FakeReplicate(delay=1).start()
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, delay: float = 3.0,
+                 jitter: float = 0.2, fail_rate: float = 0.0):
+        self.delay = delay
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.predictions = {}
+        self.webhooks_sent = 0
+        self._timers = {}
+        self._webhooks = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-replicate", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def inference_seconds(self, params: dict) -> float:
+        """
+        模擬推論耗時：與像素數、步數成正比
+        """
+        pixels = int(params.get("width", 1024)) * int(params.get("height", 1024))
+        steps = int(params.get("num_inference_steps", 25))
+        seconds = self.delay * pixels / (1024 * 1024) * steps / 25
+        return max(0.0, seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def create(self, body: dict) -> dict:
+        prediction_id = uuid.uuid4().hex
+        prediction = {
+            "id": prediction_id,
+            "model": "stability-ai/sdxl",
+            "version": body.get("version", ""),
+            "status": "starting",
+            "input": body.get("input", {}),
+            "output": None,
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": _now(),
+            "started_at": None,
+            "completed_at": None,
+            "urls": {
+                "get": f"{self.base_url}/v1/predictions/{prediction_id}",
+                "cancel": f"{self.base_url}/v1/predictions/{prediction_id}/cancel",
+            },
+        }
+        timer = threading.Timer(self.inference_seconds(prediction["input"]), self._finish, args=(prediction_id,))
+        timer.daemon = True
+        with self._lock:
+            self.predictions[prediction_id] = prediction
+            self._timers[prediction_id] = timer
+            self._webhooks[prediction_id] = body.get("webhook")
+        timer.start()
+        return dict(prediction)
+
+    def get(self, prediction_id: str) -> dict:
+        with self._lock:
+            prediction = self.predictions.get(prediction_id)
+            return dict(prediction) if prediction else None
+
+    def cancel(self, prediction_id: str) -> dict:
+        with self._lock:
+            timer = self._timers.pop(prediction_id, None)
+        if timer is not None:
+            timer.cancel()
+            self._notify(self._complete(prediction_id, "canceled", None))
+        return self.get(prediction_id)
+
+    def _finish(self, prediction_id: str):
+        with self._lock:
+            if self._timers.pop(prediction_id, None) is None:
+                return
+        if random.random() < self.fail_rate:
+            prediction = self._complete(prediction_id, "failed", None, error="fake failure")
+        else:
+            prediction = self._complete(prediction_id, "succeeded", [f"{self.base_url}/images/{prediction_id}.png"])
+        self._notify(prediction)
+
+    def _complete(self, prediction_id: str, status: str, output, error: str = None) -> dict:
+        with self._lock:
+            prediction = self.predictions[prediction_id]
+            prediction.update(status=status, output=output, error=error, completed_at=_now())
+            return dict(prediction)
+
+    def _notify(self, prediction: dict):
+        with self._lock:
+            url = self._webhooks.pop(prediction["id"], None)
+        if not url:
+            return
+        request = urllib.request.Request(
+            url, data=json.dumps(prediction).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+            with self._lock:
+                self.webhooks_sent += 1
+        except Exception as e:
+            print(f"Webhook 失敗 {url}: {e}")
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, status: int, data):
+                self._send(status, json.dumps(data).encode("utf-8"))
+
+            def _body(self) -> dict:
+                length = int(self.headers.get("Content-Length", 0))
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_POST(self):
+                if self.path == "/v1/predictions":
+                    self._json(201, fake.create(self._body()))
+                    return
+                match = _PREDICTION.match(self.path)
+                if match and match.group(2):
+                    self._body()
+                    prediction = fake.cancel(match.group(1))
+                    self._json(200 if prediction else 404, prediction or {"detail": "Not found."})
+                    return
+                self._json(404, {"detail": "Not found."})
+
+            def do_GET(self):
+                match = _PREDICTION.match(self.path)
+                if match and not match.group(2):
+                    prediction = fake.get(match.group(1))
+                    self._json(200 if prediction else 404, prediction or {"detail": "Not found."})
+                    return
+                match = _VERSION.match(self.path)
+                if match:
+                    self._json(200, {
+                        "id": match.group(1),
+                        "created_at": _now(),
+                        "cog_version": "0.9.0",
+                        "openapi_schema": {},
+                    })
+                    return
+                if _IMAGE.match(self.path):
+                    self._send(200, PNG, "image/png")
+                    return
+                self._json(404, {"detail": "Not found."})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--delay", type=float, default=3.0, help="1024x1024、25 步的推論秒數")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延遲隨機浮動比例")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="預測失敗的機率")
+    args = parser.parse_args()
+
+    fake = FakeReplicate(args.host, args.port, args.delay, args.jitter, args.fail_rate)
+    print(f"假 Replicate 伺服器：{fake.start()}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
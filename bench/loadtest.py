@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+端對端壓力測試
+
+以 gunicorn 啟動 app.py（--server async 時為 async_app.py），並將 LINE、OpenAI、Replicate 都指向本機假伺服器
+（bench/fake_line.py、fake_openai.py、fake_replicate.py，延遲與失敗比例可調），
+由多個模擬使用者持續送出帶正確 X-Line-Signature 的 Webhook（依 --mix 混合各種意圖），
+量測從送出 Webhook 到假 LINE 收到回覆的時間，依模式輸出吞吐量、p50 / p99 與錯誤率。
+「附圖回覆」另外以 full_image 統計圖片推播送達的時間。
+
+    python bench/loadtest.py [--workers 1] [--threads 1] [--concurrency 20] [--duration 30]
+    python bench/loadtest.py --openai-delay 2 --openai-fail-rate 0.05 --mix text_only=1,full=1
+    python bench/loadtest.py --server async --concurrency 200   # 與同步版本比較
+    python bench/loadtest.py --batch 5   # 每個 Webhook 帶 5 位使用者的事件
+    OPENAI_RPM=300 python bench/loadtest.py --concurrency 100   # 超過額度時回覆忙碌中的比例
+
+其他環境變數（例如 QUOTA_BACKEND、LLM_MAX_CONCURRENCY）會原樣傳給 gunicorn。
+假伺服器沒有速率上限，OPENAI_RPM / OPENAI_TPM / REPLICATE_RPM 未設定時不限制。
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_line import FakeLine  # noqa: E402
+from fake_openai import FakeOpenAI  # noqa: E402
+from fake_replicate import FakeReplicate  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CHANNEL_SECRET = "loadtest-secret"
+
+# 各模式的訊息範本，{n} 換成流水號，避免不同使用者的提問完全相同
+MESSAGES = {
+    "text_only": "我最近工作上遇到很多挫折，下半年事業運如何？（{n}）",
+    "full": "要圖 我最近財運如何？（{n}）",
+    "tarot": "塔羅 工作",
+    "daily_fortune": "今日運勢",
+    "almanac": "黃曆",
+    "fortune_stick": "抽籤",
+    "dream": "解夢 我夢到在天空飛，然後掉進海裡（{n}）",
+    "match": "配對 牡羊座 天秤座",
+    "number": "數字 8",
+    "zodiac": "獅子座",
+    "chinese_zodiac": "屬龍",
+    "help": "說明",
+}
+DEFAULT_MIX = "text_only=4,full=1,tarot=1,daily_fortune=1,zodiac=1,dream=1,match=1,number=1,almanac=1"
+
+# app.py 的 ERROR_MESSAGE / IMAGE_FAILED_MESSAGE
+ERROR_TEXTS = ("天機訊號干擾中", "圖片生成失敗")
+# app.py 的 BUSY_MESSAGE
+BUSY_TEXT = "應接不暇"
+# app.py 的 IMAGE_PENDING_NOTE
+PENDING_TEXT = "圖片生成中"
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        mode, _, weight = item.partition("=")
+        if mode not in MESSAGES:
+            raise SystemExit(f"未知的模式：{mode}（可用：{', '.join(MESSAGES)}）")
+        mix[mode] = float(weight or 1)
+    return mix
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def webhook_event(user_id: str, reply_token: str, text: str) -> dict:
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex[:26].upper(),
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": reply_token,
+        "message": {"type": "text", "id": str(random.randrange(10 ** 17, 10 ** 18)),
+                    "quoteToken": uuid.uuid4().hex, "text": text},
+    }
+
+
+def batch_body(events: list) -> bytes:
+    return json.dumps({"destination": "U" + "0" * 32, "events": events}, ensure_ascii=False).encode("utf-8")
+
+
+def webhook_body(user_id: str, reply_token: str, text: str) -> bytes:
+    return batch_body([webhook_event(user_id, reply_token, text)])
+
+
+def sign(body: bytes) -> str:
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+class Results:
+    def __init__(self):
+        self.latencies = {}  # {模式: [秒]}
+        self.errors = {}  # {模式: {原因: 次數}}
+        self.pending_images = []  # [(使用者 ID, 送出時間)]
+        self.last_reply = 0.0  # 最後一則回覆的時間，吞吐量不計入等待逾時的時間
+        self._lock = threading.Lock()
+
+    def ok(self, mode: str, seconds: float):
+        with self._lock:
+            self.latencies.setdefault(mode, []).append(seconds)
+            self.last_reply = max(self.last_reply, time.perf_counter())
+
+    def error(self, mode: str, reason: str):
+        with self._lock:
+            reasons = self.errors.setdefault(mode, {})
+            reasons[reason] = reasons.get(reason, 0) + 1
+
+
+class LoadTest:
+    def __init__(self, args, line: FakeLine, app_url: str):
+        self.args = args
+        self.line = line
+        self.app_url = app_url
+        self.results = Results()
+        self.mix = parse_mix(args.mix)
+        self._counter = itertools.count()
+
+    def client(self, stop_at: float):
+        modes, weights = list(self.mix), list(self.mix.values())
+        while time.perf_counter() < stop_at:
+            picked = random.choices(modes, weights, k=self.args.batch)
+            self.send([(mode, MESSAGES[mode].format(n=next(self._counter))) for mode in picked])
+
+    def send(self, messages: list):
+        """
+        以一個 Webhook 送出 [(模式, 訊息)]，每則來自不同使用者，並等待每則的回覆
+        """
+        sent = [("U" + uuid.uuid4().hex, uuid.uuid4().hex, mode, text) for mode, text in messages]
+        body = batch_body([webhook_event(user_id, token, text) for user_id, token, _, text in sent])
+        request = urllib.request.Request(
+            f"{self.app_url}/callback", data=body, method="POST",
+            headers={"Content-Type": "application/json", "X-Line-Signature": sign(body)}
+        )
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.args.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            for _, _, mode, _ in sent:
+                self.results.error(mode, f"webhook {e.code}")
+            return
+        except Exception:
+            for _, _, mode, _ in sent:
+                self.results.error(mode, "webhook 連線失敗")
+            return
+
+        deadline = started + self.args.timeout
+        for user_id, reply_token, mode, _ in sent:
+            delivery = self.line.wait(reply_token, max(0.0, deadline - time.perf_counter()))
+            self.line.forget(reply_token)
+            if delivery is None:
+                self.results.error(mode, "無回覆")
+                continue
+            if any(BUSY_TEXT in text for text in delivery.texts):
+                self.results.error(mode, "忙碌中")
+                continue
+            if any(error in text for text in delivery.texts for error in ERROR_TEXTS):
+                self.results.error(mode, "錯誤訊息")
+                continue
+            self.results.ok(mode, delivery.received - started)
+            if mode == "full" and any(PENDING_TEXT in text for text in delivery.texts):
+                self.results.pending_images.append((user_id, started))
+
+    def run(self) -> float:
+        stop_at = time.perf_counter() + self.args.duration
+        threads = [
+            threading.Thread(target=self.client, args=(stop_at,), daemon=True)
+            for _ in range(self.args.concurrency)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = max(self.results.last_reply, stop_at) - started
+
+        # 圖片在背景生成，壓測結束後再收齊
+        deadline = time.monotonic() + self.args.image_timeout
+        for user_id, sent in self.results.pending_images:
+            delivery = self.line.wait(
+                user_id, max(0.0, deadline - time.monotonic()),
+                lambda d: d.has_image or any(ERROR_TEXTS[1] in text for text in d.texts)
+            )
+            if delivery is None:
+                self.results.error("full_image", "無圖片")
+            elif not delivery.has_image:
+                self.results.error("full_image", "錯誤訊息")
+            else:
+                self.results.ok("full_image", delivery.received - sent)
+        return elapsed
+
+
+def start_app(args, env: dict, port: int, log_path: str) -> subprocess.Popen:
+    if args.server == "async":
+        entry = ["async_app:web_app", "--worker-class", "aiohttp.GunicornWebWorker"]
+    else:
+        entry = ["app:app", "--threads", str(args.threads)]
+    command = [
+        sys.executable, "-m", "gunicorn", *entry,
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(args.workers),
+        "--chdir", ROOT,
+    ]
+    log = open(log_path, "w", encoding="utf-8")
+    process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"gunicorn 啟動失敗，請看 {log_path}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                response.read()
+            return process
+        except Exception:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"gunicorn 30 秒內沒有回應，請看 {log_path}")
+
+
+def report(results: Results, elapsed: float, args):
+    modes = sorted(set(results.latencies) | set(results.errors), key=lambda m: (m == "full_image", m))
+    print(f"\n{'模式':16s} {'請求':>6s} {'req/s':>7s} {'p50':>7s} {'p99':>7s} {'錯誤率':>7s}  錯誤")
+    total_ok = total_errors = 0
+    for mode in modes:
+        latencies = results.latencies.get(mode, [])
+        errors = results.errors.get(mode, {})
+        count = len(latencies) + sum(errors.values())
+        p50 = f"{percentile(latencies, 50):.2f}s" if latencies else "-"
+        p99 = f"{percentile(latencies, 99):.2f}s" if latencies else "-"
+        detail = "、".join(f"{reason} {hits}" for reason, hits in errors.items())
+        print(
+            f"{mode:16s} {count:6d} {len(latencies) / elapsed:7.2f} {p50:>7s} {p99:>7s} "
+            f"{sum(errors.values()) / count:7.1%}  {detail}"
+        )
+        if not mode == "full_image":
+            total_ok += len(latencies)
+            total_errors += sum(errors.values())
+    total = total_ok + total_errors
+    if args.server == "async":
+        server = f"asyncio，gunicorn {args.workers} worker"
+    else:
+        server = f"同步，gunicorn {args.workers} worker × {args.threads} 執行緒"
+    if total:
+        print(
+            f"\n共 {total} 則訊息，{elapsed:.1f} 秒，成功 {total_ok / elapsed:.2f} 則/秒，"
+            f"錯誤率 {total_errors / total:.1%}（{server}，{args.concurrency} 個模擬使用者，"
+            f"每個 Webhook {args.batch} 個事件）"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=("sync", "async"), default="sync",
+                        help="sync 為 app.py（Flask），async 為 async_app.py（aiohttp）")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn worker 數")
+    parser.add_argument("--threads", type=int, default=1, help="每個 worker 的執行緒數（僅 sync）")
+    parser.add_argument("--concurrency", type=int, default=20, help="同時送出 Webhook 的模擬使用者數")
+    parser.add_argument("--batch", type=int, default=1, help="每個 Webhook 帶幾位使用者的事件")
+    parser.add_argument("--duration", type=float, default=30, help="壓測秒數")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="各模式的比重，例如 text_only=4,full=1")
+    parser.add_argument("--timeout", type=float, default=30, help="等待回覆的秒數，逾時算錯誤")
+    parser.add_argument("--image-timeout", type=float, default=60, help="壓測結束後等待圖片的秒數")
+    parser.add_argument("--line-delay", type=float, default=0.05, help="假 LINE API 回應秒數")
+    parser.add_argument("--line-fail-rate", type=float, default=0.0)
+    parser.add_argument("--openai-delay", type=float, default=1.0, help="假 OpenAI 每次回答秒數（max_tokens=500）")
+    parser.add_argument("--openai-fail-rate", type=float, default=0.0)
+    parser.add_argument("--replicate-delay", type=float, default=3.0, help="假 Replicate 1024x1024、25 步的秒數")
+    parser.add_argument("--replicate-fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    line = FakeLine(delay=args.line_delay, fail_rate=args.line_fail_rate)
+    openai_fake = FakeOpenAI(delay=args.openai_delay, fail_rate=args.openai_fail_rate)
+    replicate_fake = FakeReplicate(delay=args.replicate_delay, fail_rate=args.replicate_fail_rate)
+
+    port = free_port()
+    app_url = f"http://127.0.0.1:{port}"
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    env = dict(os.environ)
+    env.update({
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "loadtest",
+        "LINE_API_BASE_URL": line.start(),
+        "OPENAI_API_KEY": "loadtest",
+        "OPENAI_BASE_URL": openai_fake.start() + "/v1",
+        "REPLICATE_API_TOKEN": "loadtest",
+        "REPLICATE_BASE_URL": replicate_fake.start(),
+        "PUBLIC_BASE_URL": app_url,
+        "IMAGE_STORE_DIR": os.path.join(workdir, "images"),
+    })
+    env.setdefault("LOG_LEVEL", "WARNING")
+    for name in ("OPENAI_RPM", "OPENAI_TPM", "REPLICATE_RPM"):
+        env.setdefault(name, "0")
+    log_path = os.path.join(workdir, "gunicorn.log")
+
+    process = start_app(args, env, port, log_path)
+    print(f"app：{app_url}（日誌 {log_path}），壓測 {args.duration:g} 秒…")
+    try:
+        test = LoadTest(args, line, app_url)
+        elapsed = test.run()
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        for fake in (line, openai_fake, replicate_fake):
+            fake.stop()
+
+    report(test.results, elapsed, args)
+    print(
+        f"假伺服器：LINE {line.requests} 次（失敗 {line.failures}），"
+        f"OpenAI {openai_fake.requests} 次（失敗 {openai_fake.failures}），"
+        f"Replicate 預測 {len(replicate_fake.predictions)} 個"
+    )
+
+
+if __name__ == "__main__":
+    main()
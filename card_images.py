@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+塔羅牌圖庫
+22 張大阿爾克那是固定的，事先為每張牌生成數個版本存成檔案（並附小尺寸預覽圖），
+選牌後直接從圖庫取圖，不必每次等待 SDXL 生成。
+
+離線建立圖庫（已存在的版本會略過）：
+    python card_images.py build [--variants 3]
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import random
+import re
+import threading
+import urllib.request
+
+from image_store import make_preview, normalize_image
+
+logger = logging.getLogger(__name__)
+
+# 與 TAROT_CARDS 順序相同的英文牌名，用於繪圖提示詞
+CARD_NAMES_EN = [
+    "The Fool", "The Magician", "The High Priestess", "The Empress", "The Emperor",
+    "The Hierophant", "The Lovers", "The Chariot", "Strength", "The Hermit",
+    "Wheel of Fortune", "Justice", "The Hanged Man", "Death", "Temperance", "The Devil",
+    "The Tower", "The Star", "The Moon", "The Sun", "Judgement", "The World"
+]
+
+CARD_PROMPT = (
+    "A mystical {name} tarot card, ornate golden frame, cyberpunk oriental style, "
+    "glowing neon lights, ethereal atmosphere, highly detailed illustration"
+)
+
+# 檔名格式：{牌的索引}_{版本}.{副檔名}，例如 10_2.png（LINE 只接受 JPEG / PNG）
+_FILENAME = re.compile(r"^(\d+)_(\d+)\.(png|jpg|jpeg)$")
+
+
+def preview_filename(filename: str) -> str:
+    """
+    圖庫圖片的預覽圖檔名，例如 10_2.png → 10_2_preview.jpg
+    """
+    return f"{os.path.splitext(filename)[0]}_preview.jpg"
+
+
+class CardImageLibrary:
+    """
+    從目錄載入每張牌的所有版本，依設定輪流或隨機挑選
+    """
+
+    def __init__(self, directory: str, base_url: str, strategy: str = "rotate"):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/") if base_url else ""
+        self.strategy = strategy
+        self._variants = {}  # {牌的索引: [檔名, ...]}
+        self._previews = {}  # {檔名: 預覽圖檔名}
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> int:
+        """
+        掃描目錄，回傳圖片數量
+        """
+        variants = {}
+        previews = {}
+        if os.path.isdir(self.directory):
+            filenames = sorted(os.listdir(self.directory))
+            for filename in filenames:
+                match = _FILENAME.match(filename)
+                if match:
+                    variants.setdefault(int(match.group(1)), []).append(filename)
+                    if preview_filename(filename) in filenames:
+                        previews[filename] = preview_filename(filename)
+        self._variants = variants
+        self._previews = previews
+        self._cursors = {card: itertools.cycle(files) for card, files in variants.items()}
+        return sum(len(files) for files in variants.values())
+
+    def pick(self, card_index: int) -> tuple:
+        """
+        取得該牌的一張圖片
+        Returns: (原圖網址, 預覽網址)，沒有預覽圖時兩者相同；圖庫中沒有時回傳 None
+        """
+        if not self.base_url or card_index not in self._variants:
+            return None
+        if self.strategy == "random":
+            filename = random.choice(self._variants[card_index])
+        else:
+            with self._lock:
+                filename = next(self._cursors[card_index])
+        preview = self._previews.get(filename, filename)
+        return (f"{self.base_url}/cards/{filename}", f"{self.base_url}/cards/{preview}")
+
+    def missing(self, card_count: int, variants: int) -> list:
+        """
+        列出尚未生成的 (牌的索引, 版本)
+        """
+        existing = {
+            (int(m.group(1)), int(m.group(2)))
+            for files in self._variants.values()
+            for m in map(_FILENAME.match, files)
+        }
+        return [
+            (card, variant)
+            for card in range(card_count)
+            for variant in range(variants)
+            if (card, variant) not in existing
+        ]
+
+    def missing_previews(self) -> list:
+        """
+        列出沒有預覽圖的圖片檔名
+        """
+        return [filename for files in self._variants.values() for filename in files if filename not in self._previews]
+
+
+def build(library: CardImageLibrary, variants: int, generate, preview_size: int = 240) -> int:
+    """
+    為每張牌補齊 variants 個版本並產生預覽圖（既有圖片缺少的預覽圖也一併補上），回傳新生成數量
+    """
+    os.makedirs(library.directory, exist_ok=True)
+    created = 0
+    for card, variant in library.missing(len(CARD_NAMES_EN), variants):
+        prompt = CARD_PROMPT.format(name=CARD_NAMES_EN[card])
+        url = generate(prompt)
+        if not url:
+            logger.warning("生成失敗：%s 版本 %d", CARD_NAMES_EN[card], variant)
+            continue
+        with urllib.request.urlopen(url, timeout=60) as response:
+            # 副檔名依實際格式，WebP 等其他格式先轉成 JPEG，圖片檔的 Content-Type 才會正確
+            ext, data = normalize_image(response.read())
+        path = os.path.join(library.directory, f"{card:02d}_{variant}.{ext}")
+        with open(path, "wb") as f:
+            f.write(data)
+        created += 1
+        print(f"✅ {CARD_NAMES_EN[card]} 版本 {variant} → {path}")
+    library.load()
+
+    # 聊天室縮圖用小尺寸預覽圖，手機不必下載整張牌面
+    for filename in library.missing_previews():
+        with open(os.path.join(library.directory, filename), "rb") as f:
+            preview = make_preview(f.read(), preview_size)
+        if preview is None:
+            logger.warning("未安裝 Pillow，不產生預覽圖（預覽與原圖相同）")
+            break
+        with open(os.path.join(library.directory, preview_filename(filename)), "wb") as f:
+            f.write(preview)
+    library.load()
+    return created
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="建立塔羅牌圖庫")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--variants", type=int, default=3, help="每張牌的版本數")
+    args = parser.parse_args()
+
+    import app
+
+    card_library = CardImageLibrary(app.CARD_IMAGE_DIR, app.PUBLIC_BASE_URL)
+    card_library.load()
+    count = build(card_library, args.variants, app.generate_image, app.IMAGE_PREVIEW_SIZE)
+    print(f"新增 {count} 張，圖庫位置：{app.CARD_IMAGE_DIR}")
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+每日內容包
+黃曆、12 星座、12 生肖與一組每日運勢，事先離線生成並寫成每天一個檔案，
+所有 worker 以 mmap 唯讀對應同一個檔案（作業系統共用同一份分頁快取，不會每個 worker 各存一份），
+啟動後不必等 LLM 冷啟動；台北換日時自動改讀新一天的檔案。
+
+離線建立內容包（已存在的日期會略過）：
+    python content_pack.py build [--days 7] [--start 2026-01-01] [--variants 8] [--force]
+
+檔案格式（{目錄}/{YYYY-MM-DD}.pack）：
+    b"FPK1" + 索引長度（uint32 little-endian）+ 索引 JSON + 內容
+    索引為 {"day": 日期, "entries": {"模式\\t對象": [位移, 長度]}, "pools": {模式: 版本數}}，
+    內容為每筆一行的 JSON，位移從內容開頭起算
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+
+from daily_cache import taipei_today
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FPK1"
+_INDEX_LENGTH = struct.Struct("<I")
+
+
+def pack_path(directory: str, day: date) -> str:
+    return os.path.join(directory, f"{day.isoformat()}.pack")
+
+
+def _key(mode: str, entity) -> str:
+    return f"{mode}\t{entity or ''}"
+
+
+def write_pack(directory: str, day: date, entries: dict, pools: dict = None) -> str:
+    """
+    寫入一天的內容包，entries 為 {(模式, 對象): 內容}，pools 為 {模式: 版本數}（版本的對象為 "0"、"1"…）
+    先寫到暫存檔再以 os.replace 換上，讀取中的 worker 不會看到寫到一半的檔案
+    """
+    os.makedirs(directory, exist_ok=True)
+    body = bytearray()
+    index = {}
+    for (mode, entity), value in entries.items():
+        record = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        index[_key(mode, entity)] = [len(body), len(record)]
+        body += record + b"\n"
+    header = json.dumps(
+        {"day": day.isoformat(), "entries": index, "pools": pools or {}},
+        ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+    path = pack_path(directory, day)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".pack-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC + _INDEX_LENGTH.pack(len(header)) + header + body)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp 建立的檔案只有擁有者可讀，改成與一般檔案相同的權限供各 worker 讀取
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+class ContentPack:
+    """
+    一天的內容包：索引在載入時解析，內容留在 mmap 中，取用時才解碼該筆
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.mtime = stat.st_mtime
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"不是內容包：{path}")
+        (length,) = _INDEX_LENGTH.unpack_from(self._map, len(MAGIC))
+        start = len(MAGIC) + _INDEX_LENGTH.size
+        index = json.loads(self._map[start:start + length])
+        self.day = date.fromisoformat(index["day"])
+        self.pools = index.get("pools", {})
+        self._entries = index["entries"]
+        self._body = start + length
+
+    def get(self, mode: str, entity=None):
+        location = self._entries.get(_key(mode, entity))
+        if location is None:
+            return None
+        offset, length = location
+        start = self._body + offset
+        return json.loads(self._map[start:start + length])
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ContentPacks:
+    """
+    依日期取用內容包，同一時間只對應一天的檔案
+    換日或檔案被重建時換上新的 ContentPack（替換參照即可，舊的 mmap 沒有人使用後自動關閉）；
+    該日沒有檔案時每 check_interval 秒重新檢查一次，建好之後不必重啟
+    """
+
+    def __init__(self, directory: str, check_interval: float = 60.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._pack = None
+        self._day = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def _current(self, day: date) -> ContentPack:
+        now = time.monotonic()
+        if day == self._day and now - self._checked < self.check_interval:
+            return self._pack
+        with self._lock:
+            if day == self._day and now - self._checked < self.check_interval:
+                return self._pack
+            pack = self._pack if day == self._day else None
+            path = pack_path(self.directory, day)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                pack = None
+            else:
+                if pack is None or pack.mtime != mtime:
+                    try:
+                        pack = ContentPack(path)
+                        self.loads += 1
+                        logger.info("載入內容包 %s：%d 筆", path, len(pack))
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.warning("內容包無法讀取（%s）: %s", path, e)
+                        pack = None
+            self._pack = pack
+            self._day = day
+            self._checked = now
+            return pack
+
+    def get(self, mode: str, entity=None, day: date = None):
+        """
+        取得內容包中的一筆，沒有時回傳 None
+        """
+        pack = self._current(day or taipei_today())
+        value = pack.get(mode, entity) if pack is not None else None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def pick(self, mode: str, key: str, day: date = None):
+        """
+        從該模式的多個版本中依 key 固定挑一個（同一個 key 當天拿到同一個版本），沒有時回傳 None
+        """
+        day = day or taipei_today()
+        pack = self._current(day)
+        count = pack.pools.get(mode, 0) if pack is not None else 0
+        if not count:
+            self.misses += 1
+            return None
+        return self.get(mode, str(zlib.crc32(key.encode("utf-8")) % count), day)
+
+    def stats(self) -> dict:
+        pack = self._pack
+        return {
+            "entries": len(pack) if pack is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="建立每日內容包")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--start", type=date.fromisoformat, default=None, help="第一天（預設為台北今天）")
+    parser.add_argument("--days", type=int, default=1, help="連續建立幾天")
+    parser.add_argument("--variants", type=int, default=8, help="每日運勢的版本數")
+    parser.add_argument("--force", action="store_true", help="已存在的日期也重新生成")
+    args = parser.parse_args()
+
+    import app
+
+    # 重新生成時不沿用既有內容包中的項目
+    app.daily_cache.packs = None
+    start = args.start or taipei_today()
+    for offset in range(args.days):
+        day = start + timedelta(days=offset)
+        path = pack_path(app.CONTENT_PACK_DIR, day)
+        if os.path.exists(path) and not args.force:
+            print(f"⏭️ {day} 已存在：{path}")
+            continue
+        entries, pools = app.generate_daily_content(day, args.variants)
+        write_pack(app.CONTENT_PACK_DIR, day, entries, pools)
+        print(f"✅ {day}：{len(entries)} 筆 → {path}")
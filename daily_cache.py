@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+每日共用快取
+黃曆、星座、生肖、每日運勢對同一天的所有使用者都相同，
+以 (模式, 對象, 台北日期) 為鍵快取，台北時間午夜自動換日；
+有事先建好的內容包（content_pack.py）時優先從內容包取用
+"""
+
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# 台灣不實施夏令時間，固定 UTC+8 即可，不需依賴 tzdata
+TAIPEI_TZ = timezone(timedelta(hours=8), "Asia/Taipei")
+
+
+def taipei_now() -> datetime:
+    """
+    取得台北目前時間
+    """
+    return datetime.now(TAIPEI_TZ)
+
+
+def taipei_today() -> date:
+    """
+    取得台北今日日期
+    """
+    return taipei_now().date()
+
+
+def seconds_until_midnight(now: datetime = None) -> float:
+    """
+    距離台北下一個午夜的秒數
+    """
+    now = now or taipei_now()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), TAIPEI_TZ)
+    return (tomorrow - now).total_seconds()
+
+
+class DailyCache:
+    """
+    以 (mode, entity, day) 為鍵的快取，只保留最新一天的資料
+    packs 為 ContentPacks，內容包中有的項目直接從 mmap 讀取，不另外存一份
+    """
+
+    def __init__(self, packs=None):
+        self.packs = packs
+        self._entries = {}
+        self._day = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, mode: str, entity: str = None, day: date = None):
+        day = day or taipei_today()
+        if self.packs is not None:
+            value = self.packs.get(mode, entity, day)
+            if value is not None:
+                self.hits += 1
+                return value
+        with self._lock:
+            value = self._entries.get((mode, entity, day))
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, mode: str, entity: str, value, day: date = None):
+        day = day or taipei_today()
+        with self._lock:
+            if self._day is None or day > self._day:
+                # 換日：丟掉前一天的所有資料
+                self._entries = {k: v for k, v in self._entries.items() if k[2] >= day}
+                self._day = day
+            elif day < self._day:
+                return
+            self._entries[(mode, entity, day)] = value
+
+    def get_or_compute(self, mode: str, entity: str, compute, day: date = None):
+        """
+        命中直接回傳，否則呼叫 compute() 並快取（None 代表失敗，不快取）
+        """
+        day = day or taipei_today()
+        value = self.get(mode, entity, day)
+        if value is not None:
+            return value
+        value = compute()
+        if value is not None:
+            self.put(mode, entity, value, day)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DailyWarmer:
+    """
+    每天台北午夜過後預先填滿快取的背景執行緒
+    """
+
+    def __init__(self, warm, delay: float = 60.0, warm_on_start: bool = True):
+        self._warm = warm
+        self._delay = delay
+        self._warm_on_start = warm_on_start
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="daily-warmer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        if self._warm_on_start:
+            self._run_once()
+        while not self._stop.wait(seconds_until_midnight() + self._delay):
+            self._run_once()
+
+    def _run_once(self):
+        started = time.monotonic()
+        try:
+            filled = self._warm(taipei_today())
+            logger.info("每日快取預熱完成：%s 筆，耗時 %.1f 秒", filled, time.monotonic() - started)
+        except Exception:
+            logger.exception("每日快取預熱失敗")
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+已處理的 Webhook 事件
+LINE 在逾時或收到非 2xx 時會重送同一個事件（webhookEventId 相同、isRedelivery 為 true），
+處理前先登記事件 ID，登記失敗代表已經處理過，直接略過，不再扣次數或呼叫 OpenAI / Replicate。
+每筆紀錄保留 ttl 秒。
+
+- memory: 單一行程內（預設），數量超過上限時淘汰最舊的
+- sqlite: 同一台機器的多個 worker 共用
+- redis:  多台機器共用（需安裝 redis 套件）
+"""
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryIdempotencyStore:
+    """
+    行程內紀錄 {事件 ID: 到期時間}，依登記順序排列（存活時間相同，最舊的也最先到期）
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def claim(self, event_id: str) -> bool:
+        """
+        登記事件，第一次登記回傳 True，已登記過（且未到期）回傳 False
+        """
+        now = time.time()
+        with self._lock:
+            # 順便清掉最前面已到期的紀錄
+            while self._entries:
+                oldest, expires = next(iter(self._entries.items()))
+                if expires > now:
+                    break
+                del self._entries[oldest]
+            if event_id in self._entries:
+                return False
+            self._entries[event_id] = now + self.ttl
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+            return True
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "evicted": self.evicted}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteIdempotencyStore:
+    """
+    SQLite（WAL）紀錄，同一台機器的多個 worker 共用
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int = 100000, sweep_interval: float = 60.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = time.monotonic() + sweep_interval
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_events ("
+            " event_id TEXT PRIMARY KEY, expires REAL NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS webhook_events_expires ON webhook_events (expires)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def claim(self, event_id: str) -> bool:
+        """
+        單一 UPSERT 完成：不存在或已到期時寫入並回傳資料列，否則 WHERE 不成立
+        """
+        now = time.time()
+        row = self._conn().execute(
+            "INSERT INTO webhook_events (event_id, expires) VALUES (?, ?)"
+            " ON CONFLICT (event_id) DO UPDATE SET expires = excluded.expires WHERE expires <= ?"
+            " RETURNING event_id",
+            (event_id, now + self.ttl, now),
+        ).fetchone()
+        self._maybe_sweep()
+        return row is not None
+
+    def sweep(self) -> int:
+        conn = self._conn()
+        removed = conn.execute("DELETE FROM webhook_events WHERE expires <= ?", (time.time(),)).rowcount
+        removed += conn.execute(
+            "DELETE FROM webhook_events WHERE event_id IN ("
+            " SELECT event_id FROM webhook_events ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        return removed
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep()
+
+    def stats(self) -> dict:
+        return {"entries": len(self)}
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+
+
+class RedisIdempotencyStore:
+    """
+    Redis 紀錄，鍵為 webhook_event:{事件 ID}，SET NX 一次完成，由 Redis 負責到期刪除
+    """
+
+    def __init__(self, url: str = None, ttl: float = 86400, client=None, prefix: str = "webhook_event"):
+        if client is None:
+            import redis  # 選用套件，只有使用 redis 時才需要
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def claim(self, event_id: str) -> bool:
+        return bool(self.client.set(f"{self.prefix}:{event_id}", b"1", nx=True, ex=max(1, int(self.ttl))))
+
+    def stats(self) -> dict:
+        return {}
+
+
+def make_idempotency_store(backend: str, ttl: float, max_entries: int,
+                           sqlite_path: str = None, redis_url: str = None):
+    """
+    依設定建立已處理事件的紀錄
+    """
+    if backend == "sqlite":
+        return SQLiteIdempotencyStore(sqlite_path, ttl, max_entries)
+    if backend == "redis":
+        return RedisIdempotencyStore(redis_url, ttl)
+    if backend == "memory":
+        return MemoryIdempotencyStore(ttl, max_entries)
+    raise ValueError(f"未知的 EVENT_DEDUP_BACKEND: {backend}")
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+非同步圖片生成的預測追蹤
+建立 Replicate 預測時帶上 Webhook，文字先回覆，圖片在預測完成的 Webhook 到達時再推播；
+逾時未完成的預測由背景清理執行緒取消並通知使用者。
+追蹤資料只存在目前行程，完成通知可能由其他 worker 收到，宣告逾時前先向 Replicate 查詢實際狀態。
+"""
+
+import hashlib
+import hmac
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_token(secret: str, user_id: str, push: bool, image_key: str = "") -> str:
+    """
+    Webhook 網址中的簽章，避免他人偽造完成通知推播給使用者
+    """
+    message = f"{user_id}:{int(push)}:{image_key}".encode("utf-8")
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def verify_webhook_token(secret: str, user_id: str, push: bool, image_key: str, token: str) -> bool:
+    return hmac.compare_digest(webhook_token(secret, user_id, push, image_key), token or "")
+
+
+def prediction_image_url(output) -> str:
+    """
+    從預測結果取出第一張圖片網址，沒有時回傳 None
+    """
+    if isinstance(output, list):
+        output = output[0] if output else None
+    return str(output) if output else None
+
+
+def _parse_time(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    # Replicate 的時間為 ISO 8601（結尾 Z，小數秒可能超過 6 位）
+    value = re.sub(r"(\.\d{6})\d+", r"\1", str(value)).replace("Z", "+00:00")
+    return datetime.fromisoformat(value)
+
+
+def prediction_seconds(created_at, completed_at) -> float:
+    """
+    依 Replicate 回傳的建立與完成時間算出生成耗時，缺少或無法解析時回傳 None
+    """
+    if not created_at or not completed_at:
+        return None
+    try:
+        return (_parse_time(completed_at) - _parse_time(created_at)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+class PendingImage:
+    """
+    - push: 完成時是否推播給使用者（預先生成的圖片在使用者要求前為 False）
+    - webhook_push: 建立時 Webhook 網址帶的 push，由其他 worker 收到通知時依此決定是否推播
+    - image_url: 完成但尚未推播時暫存的圖片網址
+    - image_key: 圖片快取的鍵
+    - profile: 生成設定檔名稱，started 為建立時間，用於統計生成耗時
+    """
+
+    __slots__ = ("prediction_id", "user_id", "push", "webhook_push", "image_key", "profile", "started", "done",
+                 "image_url", "deadline")
+
+    def __init__(self, prediction_id: str, user_id: str, push: bool, image_key: str, profile: str,
+                 deadline: float):
+        self.prediction_id = prediction_id
+        self.user_id = user_id
+        self.push = push
+        self.webhook_push = push
+        self.image_key = image_key
+        self.profile = profile
+        self.started = time.monotonic()
+        self.done = False
+        self.image_url = None
+        self.deadline = deadline
+
+
+class PredictionTracker:
+    """
+    - timeout: 預測超過這個秒數仍未完成即視為逾時
+    - max_pending: 追蹤數量上限，超過時淘汰最舊的
+    """
+
+    def __init__(self, timeout: float = 120.0, max_pending: int = 1000):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._pending = OrderedDict()  # {prediction_id: PendingImage}
+        self._expired = OrderedDict()  # 最近逾時的 prediction_id，晚到的完成通知直接忽略
+        self._lock = threading.Lock()
+        self.started = 0
+        self.delivered = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def add(self, prediction_id: str, user_id: str, push: bool = True, image_key: str = None,
+            profile: str = None):
+        record = PendingImage(prediction_id, user_id, push, image_key, profile, time.monotonic() + self.timeout)
+        with self._lock:
+            self._pending[prediction_id] = record
+            self.started += 1
+            while len(self._pending) > self.max_pending:
+                _, oldest = self._pending.popitem(last=False)
+                self._remember_expired(oldest.prediction_id)
+
+    def complete(self, prediction_id: str, image_url: str) -> PendingImage:
+        """
+        預測完成（image_url 為 None 代表失敗），回傳紀錄，不在追蹤中時回傳 None。
+        record.push 為 True 時由呼叫端推播；預先生成且尚未被要求的圖片先暫存
+        """
+        with self._lock:
+            record = self._pending.get(prediction_id)
+            if record is None:
+                return None
+            record.done = True
+            record.image_url = image_url
+            if image_url is None:
+                self.failed += 1
+            if not record.push and image_url is not None:
+                record.deadline = time.monotonic() + self.timeout
+                return record
+            del self._pending[prediction_id]
+            if image_url is not None:
+                self.delivered += 1
+            return record
+
+    def claim(self, prediction_id: str) -> tuple:
+        """
+        使用者要求預先生成的圖片
+        Returns: (是否仍在追蹤, 已完成的圖片網址)；尚未完成時改為完成後推播
+        """
+        with self._lock:
+            record = self._pending.get(prediction_id)
+            if record is None:
+                return (False, None)
+            if record.done:
+                del self._pending[prediction_id]
+                self.delivered += 1
+                return (True, record.image_url)
+            record.push = True
+            return (True, None)
+
+    def is_expired(self, prediction_id: str) -> bool:
+        with self._lock:
+            return prediction_id in self._expired
+
+    def expire(self) -> list:
+        """
+        取出所有逾時的紀錄
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [record for record in self._pending.values() if record.deadline <= now]
+            for record in expired:
+                del self._pending[record.prediction_id]
+                self._remember_expired(record.prediction_id)
+                if not record.done:
+                    self.timed_out += 1
+        return expired
+
+    def pending(self) -> list:
+        with self._lock:
+            return [record for record in self._pending.values() if not record.done]
+
+    def _remember_expired(self, prediction_id: str):
+        self._expired[prediction_id] = True
+        while len(self._expired) > self.max_pending:
+            self._expired.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "started": self.started,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+            }
+
+
+class PredictionSweeper:
+    """
+    每隔 interval 秒執行一次 sweep() 的背景執行緒
+    """
+
+    def __init__(self, sweep, interval: float = 10.0):
+        self._sweep = sweep
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="prediction-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self._sweep()
+            except Exception:
+                logger.exception("預測清理失敗")
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+圖片生成設定檔
+依模式與是否 VIP 選擇生成設定（解析度、步數，或改用較快的模型），
+最近的生成耗時 p95 超過預算時自動降級為較快的設定。
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+
+
+class ImageProfile(NamedTuple):
+    """
+    一組生成設定：version 為 Replicate 模型版本，params 為提示詞以外的輸入
+    """
+    name: str
+    version: str
+    params: dict
+
+
+class RenderStats:
+    """
+    各設定檔最近 window 秒內的生成耗時
+    """
+
+    def __init__(self, window: float = 600.0, max_samples: int = 500):
+        self.window = window
+        self.max_samples = max_samples
+        self._samples = {}  # {設定檔名稱: deque[(時間, 秒數)]}
+        self._lock = threading.Lock()
+
+    def record(self, profile: str, seconds: float):
+        with self._lock:
+            samples = self._samples.setdefault(profile, deque(maxlen=self.max_samples))
+            samples.append((time.monotonic(), seconds))
+
+    def percentile(self, profile: str, pct: float, min_samples: int = 1) -> float:
+        """
+        回傳耗時百分位數，樣本不足時回傳 None
+        """
+        cutoff = time.monotonic() - self.window
+        with self._lock:
+            samples = self._samples.get(profile)
+            if samples is None:
+                return None
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+            values = sorted(seconds for _, seconds in samples)
+        if len(values) < max(1, min_samples):
+            return None
+        return values[min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+class ProfileSelector:
+    """
+    - profiles: {名稱: ImageProfile}
+    - mode_profiles: {模式: 設定檔名稱}，一般使用者使用
+    - vip_profile: VIP 使用的設定檔
+    - fallback: 降級時使用的設定檔
+    - budget: p95 生成秒數預算，超過時降級（0 表示不降級）
+    - min_samples: 計算 p95 所需的最少樣本數
+    """
+
+    def __init__(self, profiles: dict, mode_profiles: dict, default: str, vip_profile: str,
+                 fallback: str, budget: float, stats: RenderStats, min_samples: int = 10):
+        for name in [default, vip_profile, fallback, *mode_profiles.values()]:
+            if name not in profiles:
+                raise ValueError(f"未定義的圖片設定檔: {name}")
+        self.profiles = profiles
+        self.mode_profiles = mode_profiles
+        self.default = default
+        self.vip_profile = vip_profile
+        self.fallback = fallback
+        self.budget = budget
+        self.stats = stats
+        self.min_samples = min_samples
+        self.downgrades = 0
+
+    def choose(self, mode: str, is_vip: bool = False) -> ImageProfile:
+        name = self.vip_profile if is_vip else self.mode_profiles.get(mode, self.default)
+        if name != self.fallback and self.over_budget(name):
+            self.downgrades += 1
+            name = self.fallback
+        return self.profiles[name]
+
+    def over_budget(self, name: str) -> bool:
+        if self.budget <= 0:
+            return False
+        p95 = self.stats.percentile(name, 95, self.min_samples)
+        return p95 is not None and p95 > self.budget
+
+    def report(self) -> dict:
+        """
+        各設定檔的 p50 / p95 與降級次數
+        """
+        return {
+            "downgrades": self.downgrades,
+            "profiles": {
+                name: {
+                    "p50": self.stats.percentile(name, 50),
+                    "p95": self.stats.percentile(name, 95),
+                    "over_budget": self.over_budget(name),
+                }
+                for name in self.profiles
+            },
+        }
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+以內容定址的圖片快取
+以 (模型, 正規化後的提示詞, 參數) 的雜湊為鍵，生成結果只下載一次，
+另外產生小尺寸預覽圖，兩者都由本服務提供並允許客戶端長期快取。
+磁碟用量超過上限時淘汰最久沒用到的圖片；每個 worker 各自淘汰，取用前確認檔案仍在。
+
+預覽圖需要 Pillow（選用套件），未安裝時預覽與原圖相同。
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# 檔名格式：{鍵}.{副檔名}（原圖）與 {鍵}_preview.jpg（預覽）
+_FILENAME = re.compile(r"^([0-9a-f]{32})(_preview)?\.(png|jpg)$")
+
+# 被存取後超過這個秒數才更新檔案時間，避免每次都寫入磁碟中繼資料
+_TOUCH_INTERVAL = 60.0
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    合併空白並轉成小寫（SDXL 的 CLIP 斷詞本來就不分大小寫）
+    """
+    return " ".join(prompt.split()).lower()
+
+
+def image_key(model: str, prompt: str, params: dict) -> str:
+    material = json.dumps(
+        {"model": model, "prompt": normalize_prompt(prompt), "params": params},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()[:32]
+
+
+def _image_format(data: bytes) -> str:
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    return None
+
+
+def normalize_image(data: bytes) -> tuple:
+    """
+    LINE 只接受 JPEG / PNG，其他格式（例如 WebP）需要 Pillow 轉成 JPEG
+    Returns: (副檔名, 圖片內容)
+    """
+    fmt = _image_format(data)
+    if fmt is not None:
+        return (fmt, data)
+    from PIL import Image  # 選用套件
+    with Image.open(io.BytesIO(data)) as image:
+        output = io.BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=90)
+    return ("jpg", output.getvalue())
+
+
+def make_preview(data: bytes, size: int) -> bytes:
+    """
+    產生最長邊 size 像素的 JPEG 預覽圖，未安裝 Pillow 時回傳 None
+    """
+    try:
+        from PIL import Image  # 選用套件，未安裝時不產生預覽圖
+    except ImportError:
+        return None
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=80, optimize=True)
+    return output.getvalue()
+
+
+class _Entry:
+    __slots__ = ("original", "preview", "size", "touched")
+
+    def __init__(self, original: str, preview: str, size: int, touched: float):
+        self.original = original
+        self.preview = preview
+        self.size = size
+        self.touched = touched
+
+
+class ImageStore:
+    """
+    - directory: 存放圖片的目錄
+    - base_url: 服務對外網址，圖片網址為 {base_url}/images/{檔名}
+    - max_bytes: 磁碟用量上限
+    - preview_size: 預覽圖最長邊像素
+    """
+
+    def __init__(self, directory: str, base_url: str, max_bytes: int = 500 * 1024 * 1024,
+                 preview_size: int = 240):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/") if base_url else ""
+        self.max_bytes = max_bytes
+        self.preview_size = preview_size
+        self._entries = OrderedDict()  # {鍵: _Entry}，最久沒用到的在前面
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.evicted = 0
+
+    def load(self) -> int:
+        """
+        掃描目錄（依檔案時間還原使用順序），回傳圖片數量
+        """
+        found = {}
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                match = _FILENAME.match(filename)
+                if not match:
+                    continue
+                stat = os.stat(os.path.join(self.directory, filename))
+                files = found.setdefault(match.group(1), {"size": 0, "mtime": 0.0})
+                files["preview" if match.group(2) else "original"] = filename
+                files["size"] += stat.st_size
+                files["mtime"] = max(files["mtime"], stat.st_mtime)
+
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            for key, files in sorted(found.items(), key=lambda item: item[1]["mtime"]):
+                if "original" not in files:
+                    continue
+                self._add(key, _Entry(files["original"], files.get("preview"), files["size"], files["mtime"]))
+            self._evict()
+            return len(self._entries)
+
+    def urls(self, key: str) -> tuple:
+        """
+        Returns: (原圖網址, 預覽網址)，沒有時回傳 None
+        """
+        if not self.base_url:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not os.path.exists(os.path.join(self.directory, entry.original)):
+                # 已被其他 worker 淘汰（各 worker 各自計算用量，但共用同一個目錄），不回傳會 404 的網址
+                del self._entries[key]
+                self._bytes -= entry.size
+                entry = None
+            if entry is None:
+                entry = self._adopt(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            self._touch(entry)
+            return (self._url(entry.original), self._url(entry.preview or entry.original))
+
+    def fetch(self, key: str, url: str, timeout: float = 30.0) -> tuple:
+        """
+        下載生成結果存入快取，回傳 (原圖網址, 預覽網址)；失敗時回傳 None
+        """
+        if not self.base_url:
+            return None
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                data = response.read()
+            self.put(key, data)
+        except Exception as e:
+            logger.error("圖片下載失敗 %s: %s", url, e)
+            return None
+        return self.urls(key)
+
+    def put(self, key: str, data: bytes):
+        """
+        存入一張圖片並產生預覽圖
+        """
+        original, data = normalize_image(data)
+        preview = make_preview(data, self.preview_size)
+
+        os.makedirs(self.directory, exist_ok=True)
+        original_name = f"{key}.{original}"
+        self._write(original_name, data)
+        size = len(data)
+        preview_name = None
+        if preview is not None:
+            preview_name = f"{key}_preview.jpg"
+            self._write(preview_name, preview)
+            size += len(preview)
+
+        with self._lock:
+            self.downloads += 1
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._add(key, _Entry(original_name, preview_name, size, time.time()))
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "downloads": self.downloads,
+                "evicted": self.evicted,
+            }
+
+    def _url(self, filename: str) -> str:
+        return f"{self.base_url}/images/{filename}"
+
+    def _add(self, key: str, entry: _Entry):
+        self._entries[key] = entry
+        self._bytes += entry.size
+
+    def _adopt(self, key: str) -> _Entry:
+        """
+        由其他行程寫入、尚未在索引中的圖片
+        """
+        for ext in ("png", "jpg"):
+            path = os.path.join(self.directory, f"{key}.{ext}")
+            if os.path.exists(path):
+                preview = f"{key}_preview.jpg"
+                size = os.path.getsize(path)
+                if os.path.exists(os.path.join(self.directory, preview)):
+                    size += os.path.getsize(os.path.join(self.directory, preview))
+                else:
+                    preview = None
+                entry = _Entry(f"{key}.{ext}", preview, size, time.time())
+                self._add(key, entry)
+                self._evict()
+                return entry
+        return None
+
+    def _touch(self, entry: _Entry):
+        # 更新檔案時間，重新啟動後仍能依使用順序淘汰
+        now = time.time()
+        if now - entry.touched < _TOUCH_INTERVAL:
+            return
+        entry.touched = now
+        try:
+            os.utime(os.path.join(self.directory, entry.original))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evicted += 1
+            for filename in (entry.original, entry.preview):
+                if filename:
+                    try:
+                        os.remove(os.path.join(self.directory, filename))
+                    except FileNotFoundError:
+                        pass
+
+    def _write(self, filename: str, data: bytes):
+        path = os.path.join(self.directory, filename)
+        tmp_path = f"{path}.tmp{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+訊息意圖判斷
+把 (模式, 關鍵字, 優先順序, 取值函數) 的意圖表編譯成一個正規表示式，
+一次掃描訊息就找出所有命中的關鍵字，再依優先順序決定回覆模式。
+"""
+
+import re
+from typing import Callable, NamedTuple
+
+
+class Intent(NamedTuple):
+    """
+    一種回覆模式
+
+    - keywords: 訊息包含任一關鍵字即命中；同一意圖命中多個時以排在前面的為準
+    - priority: 數字越小越優先
+    - extractor: extractor(message, keyword) 回傳 extra_data，未設定時為 None
+    - exact: 訊息「完全等於」其中之一時也算命中
+    """
+    mode: str
+    keywords: tuple
+    priority: int
+    extractor: Callable = None
+    exact: tuple = ()
+
+
+def _trie_pattern(keywords) -> str:
+    """
+    將關鍵字組成字首樹形式的正規表示式，同一位置只需比對一次共同字首
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def emit(node) -> str:
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # 可在此結束的節點：貪婪比對較長的關鍵字，比不到時退回較短的
+        return f"(?:{body})?" if "" in node else body
+
+    return emit(trie)
+
+
+class IntentRouter:
+    """
+    編譯後的意圖表，classify() 只掃描訊息一次
+    """
+
+    def __init__(self, intents: list, default_mode: str = "text_only"):
+        self.default_mode = default_mode
+        self.intents = sorted(intents, key=lambda intent: intent.priority)
+
+        # 所有 (意圖, 關鍵字) 依 (優先順序, 意圖內排序) 排好，索引越小越優先
+        keyword_entries = []
+        exact_entries = []
+        for intent in self.intents:
+            for rank, keyword in enumerate(intent.keywords):
+                keyword_entries.append((intent.priority, rank, intent, keyword))
+            for rank, keyword in enumerate(intent.exact):
+                exact_entries.append((intent.priority, rank, intent, keyword))
+        self._entries = sorted(keyword_entries + exact_entries, key=lambda entry: entry[:2])
+        order = {id(entry): index for index, entry in enumerate(self._entries)}
+
+        # 每個關鍵字對應的最優先索引；同一位置只會比對到最長的關鍵字，
+        # 因此一併算入它包含的較短關鍵字
+        keywords = {entry[3] for entry in keyword_entries}
+        self._rank = {
+            keyword: min(order[id(entry)] for entry in keyword_entries if entry[3] in keyword)
+            for keyword in keywords
+        }
+        self._exact = {}
+        for entry in exact_entries:
+            self._exact.setdefault(entry[3], order[id(entry)])
+
+        if keywords:
+            first_chars = re.escape("".join(sorted({keyword[0] for keyword in keywords})))
+            self._pattern = re.compile(f"(?=[{first_chars}])(?=({_trie_pattern(keywords)}))")
+        else:
+            self._pattern = None
+
+    def classify(self, message: str) -> tuple:
+        """
+        Returns: (mode, extra_data)
+        """
+        best = self._exact.get(message)
+        if self._pattern is not None:
+            found = self._pattern.findall(message)
+            if found:
+                rank = min(map(self._rank.__getitem__, found))
+                if best is None or rank < best:
+                    best = rank
+
+        if best is None:
+            return (self.default_mode, message)
+
+        _, _, intent, keyword = self._entries[best]
+        if intent.extractor is None:
+            return (intent.mode, None)
+        return (intent.mode, intent.extractor(message, keyword))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+背景工作佇列
+讓 /callback 立即回應 200，耗時的 handle_* 流程交由固定數量的工作執行緒處理
+submit_keyed() 送出的工作依 key 排序：同一個 key 一次只執行一個，依送出順序執行
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# 通知工作執行緒結束的哨兵物件
+_STOP = object()
+
+
+class JobQueue:
+    """
+    有上限的行程內工作佇列
+
+    - workers: 工作執行緒數量（同時處理的工作上限）
+    - max_pending: 等待中的工作上限，超過時 submit() 直接回傳 False（背壓）
+    """
+
+    def __init__(self, workers: int = 8, max_pending: int = 200, name: str = "job"):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.name = name
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._keyed = {}  # {執行中的 key: 排在後面的工作}
+        self._waiting = 0  # 排在同 key 後面的工作數
+
+    def _ensure_started(self):
+        """
+        延遲啟動工作執行緒（gunicorn fork 之後才建立執行緒）
+        """
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"{self.name}-worker-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs) -> bool:
+        """
+        送出工作，佇列已滿或已關閉時回傳 False
+        """
+        if self._closed:
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            return False
+        return True
+
+    def submit_keyed(self, key, func, *args, **kwargs) -> bool:
+        """
+        送出依 key 排序的工作：同 key 有工作在執行或排隊時排在它後面，不佔用工作執行緒；
+        不同 key 之間照常同時執行。佇列已滿或已關閉時回傳 False
+        """
+        if key is None:
+            return self.submit(func, *args, **kwargs)
+        if self._closed:
+            return False
+        self._ensure_started()
+        with self._lock:
+            if self._queue.qsize() + self._waiting >= self.max_pending:
+                return False
+            waiting = self._keyed.get(key)
+            if waiting is not None:
+                waiting.append((func, args, kwargs))
+                self._waiting += 1
+                return True
+            try:
+                self._queue.put_nowait((self._run_keyed, (key, func, args, kwargs), {}))
+            except queue.Full:
+                return False
+            self._keyed[key] = deque()
+        return True
+
+    def pending(self) -> int:
+        """
+        目前等待中的工作數量（含排在同 key 後面的）
+        """
+        return self._queue.qsize() + self._waiting
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._call(*item)
+            finally:
+                self._queue.task_done()
+
+    def _run_keyed(self, key, func, args, kwargs):
+        """
+        依序執行同一個 key 的工作，直到後面沒有排隊的為止
+        """
+        while True:
+            self._call(func, args, kwargs)
+            with self._lock:
+                waiting = self._keyed[key]
+                if not waiting:
+                    del self._keyed[key]
+                    return
+                func, args, kwargs = waiting.popleft()
+                self._waiting -= 1
+
+    @staticmethod
+    def _call(func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("背景工作執行失敗: %s", getattr(func, "__name__", func))
+
+    def shutdown(self, timeout: float = 25.0):
+        """
+        停止接收新工作，並在 timeout 秒內把已排入的工作處理完
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+        if not threads:
+            return
+
+        deadline = time.monotonic() + timeout
+        for _ in threads:
+            # 哨兵排在既有工作之後，確保佇列先被清空
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    self._queue.put(_STOP, timeout=min(remaining, 0.5))
+                    break
+                except queue.Full:
+                    continue
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+        left = self._queue.qsize()
+        if left:
+            logger.warning("工作佇列關閉逾時，仍有 %d 筆工作未處理", left)
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+LLM 呼叫閘道
+所有 OpenAI 呼叫統一經過這裡：依模式設定時間預算、依 RPM / TPM 排隊取得額度（admission.py）、
+只對可重試的錯誤做抖動重試、全行程共用同時呼叫上限、上游異常時以斷路器快速失敗，並統一解析 JSON 回覆
+AsyncLLMGateway 為 asyncio 服務入口（async_app.py）使用的版本
+"""
+
+import asyncio
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+import openai
+
+from admission import PRIORITY_FREE
+
+logger = logging.getLogger(__name__)
+
+# 去除 ```json ... ``` 外框
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+# 值得重試的錯誤：逾時、連線失敗、429、5xx
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+def parse_json_reply(text: str) -> dict:
+    """
+    去除程式碼外框後解析 JSON
+    """
+    return json.loads(_CODE_FENCE.sub("", text.strip()))
+
+
+class CircuitBreaker:
+    """
+    連續失敗 failure_threshold 次後打開，reset_timeout 秒後放行一次試探請求
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class LLMGateway:
+    """
+    OpenAI Chat Completions 閘道，失敗時回傳 None
+
+    observer(mode, outcome, usage) 在每次呼叫結束時被呼叫，outcome 為
+    ok / busy / shed / breaker_open / timeout / error / bad_json，usage 為回應的 token 用量（可能為 None）
+    shed 代表 admission 的 RPM / TPM 額度來不及在時間預算內取得
+    """
+
+    def __init__(
+        self,
+        client,
+        model: str = "gpt-4o-mini",
+        timeouts: dict = None,
+        default_timeout: float = 20.0,
+        max_attempts: int = 3,
+        max_concurrency: int = 16,
+        breaker: CircuitBreaker = None,
+        observer=None,
+        admission=None,
+    ):
+        self.client = client
+        self.model = model
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.breaker = breaker or CircuitBreaker()
+        self.observer = observer
+        self.admission = admission
+        self.max_concurrency = max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def budget(self, mode: str) -> float:
+        """
+        該模式的總時間預算（秒），包含排隊與重試
+        """
+        return self.timeouts.get(mode, self.default_timeout)
+
+    def complete_json(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        mode: str = "default",
+        temperature: float = 0.8,
+        max_tokens: int = 500,
+        priority: int = PRIORITY_FREE,
+    ) -> dict:
+        """
+        呼叫模型並解析 JSON 回覆，逾時、斷路、額度不足或解析失敗都回傳 None
+        """
+        deadline = time.monotonic() + self.budget(mode)
+
+        if self.admission is not None and not self.admission.acquire(
+            self.cost(system_prompt, user_prompt, max_tokens), priority, deadline - time.monotonic()
+        ):
+            self._observe(mode, "shed")
+            return None
+
+        if not self._semaphore.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            logger.warning("OpenAI 同時呼叫已滿，等待逾時（%s）", mode)
+            self._observe(mode, "busy")
+            return None
+
+        try:
+            if not self.breaker.allow():
+                logger.warning("OpenAI 斷路器開啟中，略過呼叫（%s）", mode)
+                self._observe(mode, "breaker_open")
+                return None
+            response, outcome = self._create_with_retry(
+                deadline,
+                mode,
+                **self._params(system_prompt, user_prompt, temperature, max_tokens)
+            )
+        finally:
+            self._semaphore.release()
+
+        return self._parse(mode, response, outcome)
+
+    @staticmethod
+    def cost(system_prompt: str, user_prompt: str, max_tokens: int) -> dict:
+        """
+        一次呼叫佔用的額度；token 以字數粗估（中文約一字一個 token）加上回覆上限
+        """
+        return {"requests": 1, "tokens": len(system_prompt) + len(user_prompt) + max_tokens}
+
+    def _params(self, system_prompt: str, user_prompt: str, temperature: float, max_tokens: int) -> dict:
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+
+    def _parse(self, mode: str, response, outcome: str) -> dict:
+        """
+        解析回覆並記錄結果，response 為 None 時以 outcome 記錄
+        """
+        if response is None:
+            self._observe(mode, outcome)
+            return None
+
+        usage = getattr(response, "usage", None)
+        try:
+            result = parse_json_reply(response.choices[0].message.content)
+        except (ValueError, TypeError, AttributeError, IndexError) as e:
+            logger.warning("OpenAI 回覆無法解析為 JSON（%s）: %s", mode, e)
+            self._observe(mode, "bad_json", usage)
+            return None
+        self._observe(mode, "ok", usage)
+        return result
+
+    def _observe(self, mode: str, outcome: str, usage=None):
+        if self.observer is None:
+            return
+        try:
+            self.observer(mode, outcome, usage)
+        except Exception:
+            logger.exception("LLM 統計失敗")
+
+    def _create_with_retry(self, deadline: float, mode: str, **params):
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return self._out_of_budget(mode)
+
+            try:
+                response = self.client.chat.completions.create(timeout=remaining, **params)
+            except RETRYABLE_ERRORS as e:
+                backoff = self._backoff(mode, attempt, deadline, e)
+                if backoff is None:
+                    return (None, "timeout" if isinstance(e, openai.APITimeoutError) else "error")
+                time.sleep(backoff)
+                continue
+            except Exception as e:
+                return self._rejected(mode, e)
+
+            self.breaker.record_success()
+            return (response, "ok")
+
+    def _out_of_budget(self, mode: str) -> tuple:
+        logger.warning("OpenAI 時間預算用盡（%s）", mode)
+        self.breaker.record_failure()
+        return (None, "timeout")
+
+    def _backoff(self, mode: str, attempt: int, deadline: float, error: Exception) -> float:
+        """
+        下次重試前等待的秒數（指數退避 + 完全抖動，且不超過剩餘預算），不再重試時回傳 None
+        """
+        backoff = random.uniform(0, min(4.0, 0.5 * 2 ** (attempt - 1)))
+        if attempt >= self.max_attempts or time.monotonic() + backoff >= deadline:
+            logger.error("OpenAI 錯誤（%s，第 %d 次）: %s", mode, attempt, error)
+            self.breaker.record_failure()
+            return None
+        logger.warning("OpenAI 暫時性錯誤（%s，第 %d 次），%.2f 秒後重試: %s", mode, attempt, backoff, error)
+        return backoff
+
+    def _rejected(self, mode: str, error: Exception) -> tuple:
+        # 4xx 等不可重試錯誤代表上游仍有回應，不算故障
+        logger.error("OpenAI 錯誤（%s）: %s", mode, error)
+        self.breaker.record_success()
+        return (None, "error")
+
+
+class AsyncLLMGateway(LLMGateway):
+    """
+    asyncio 版本的閘道：client 為 AsyncOpenAI，等待上游時不佔用執行緒
+    時間預算、重試、斷路器（可與同步閘道共用同一個）與 JSON 解析都與 LLMGateway 相同
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def complete_json(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        mode: str = "default",
+        temperature: float = 0.8,
+        max_tokens: int = 500,
+        priority: int = PRIORITY_FREE,
+    ) -> dict:
+        """
+        呼叫模型並解析 JSON 回覆，逾時、斷路、額度不足或解析失敗都回傳 None
+        """
+        deadline = time.monotonic() + self.budget(mode)
+
+        if self.admission is not None and not await self.admission.acquire_async(
+            self.cost(system_prompt, user_prompt, max_tokens), priority, deadline - time.monotonic()
+        ):
+            self._observe(mode, "shed")
+            return None
+
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.warning("OpenAI 同時呼叫已滿，等待逾時（%s）", mode)
+            self._observe(mode, "busy")
+            return None
+
+        try:
+            if not self.breaker.allow():
+                logger.warning("OpenAI 斷路器開啟中，略過呼叫（%s）", mode)
+                self._observe(mode, "breaker_open")
+                return None
+            response, outcome = await self._create_with_retry(
+                deadline,
+                mode,
+                **self._params(system_prompt, user_prompt, temperature, max_tokens)
+            )
+        finally:
+            self._semaphore.release()
+
+        return self._parse(mode, response, outcome)
+
+    async def _create_with_retry(self, deadline: float, mode: str, **params):
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return self._out_of_budget(mode)
+
+            try:
+                response = await self.client.chat.completions.create(timeout=remaining, **params)
+            except RETRYABLE_ERRORS as e:
+                backoff = self._backoff(mode, attempt, deadline, e)
+                if backoff is None:
+                    return (None, "timeout" if isinstance(e, openai.APITimeoutError) else "error")
+                await asyncio.sleep(backoff)
+                continue
+            except Exception as e:
+                return self._rejected(mode, e)
+
+            self.breaker.record_success()
+            return (response, "ok")
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+星座配對結果表
+12 星座只有 78 種不分順序的組合，A×B 與 B×A 共用同一筆結果。
+啟動時從預先生成的檔案載入，缺少的組合在第一次查詢時才呼叫 AI 補上。
+
+預先生成全部組合：
+    python match_store.py [輸出路徑]
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations_with_replacement
+
+logger = logging.getLogger(__name__)
+
+
+class MatchStore:
+    """
+    星座配對結果快取，每筆結果保留 ttl 秒
+    """
+
+    def __init__(self, signs: list, ttl: float):
+        self._order = {sign: i for i, sign in enumerate(signs)}
+        self.ttl = ttl
+        self._entries = {}  # {(sign1, sign2): (created, result)}
+        self._lock = threading.Lock()
+
+    def pair_key(self, sign1: str, sign2: str) -> tuple:
+        """
+        依星座順序排列，讓 A×B 與 B×A 對應同一個鍵
+        """
+        if self._order[sign1] <= self._order[sign2]:
+            return (sign1, sign2)
+        return (sign2, sign1)
+
+    def get(self, sign1: str, sign2: str):
+        key = self.pair_key(sign1, sign2)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, result = entry
+        if time.time() - created > self.ttl:
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+        return result
+
+    def put(self, sign1: str, sign2: str, result: dict, created: float = None):
+        key = self.pair_key(sign1, sign2)
+        with self._lock:
+            self._entries[key] = (created or time.time(), result)
+
+    def get_or_compute(self, sign1: str, sign2: str, compute):
+        """
+        命中直接回傳，否則以排序後的星座呼叫 compute(a, b) 並保存
+        """
+        result = self.get(sign1, sign2)
+        if result is not None:
+            return result
+        a, b = self.pair_key(sign1, sign2)
+        result = compute(a, b)
+        if result is not None:
+            self.put(a, b, result)
+        return result
+
+    def load(self, path: str) -> int:
+        """
+        從 JSON 檔載入結果，略過已過期的組合，回傳載入筆數
+        """
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logger.warning("配對表載入失敗: %s", e)
+            return 0
+
+        now = time.time()
+        loaded = 0
+        for item in data.get("pairs", []):
+            sign1, sign2 = item.get("signs", (None, None))
+            created = item.get("created", now)
+            if sign1 not in self._order or sign2 not in self._order:
+                continue
+            if now - created > self.ttl:
+                continue
+            self.put(sign1, sign2, item["result"], created)
+            loaded += 1
+        return loaded
+
+    def save(self, path: str):
+        """
+        寫出 JSON 檔（先寫暫存檔再替換，避免其他行程讀到一半）
+        """
+        with self._lock:
+            items = sorted(self._entries.items(), key=lambda kv: (self._order[kv[0][0]], self._order[kv[0][1]]))
+        data = {
+            "pairs": [
+                {"signs": list(key), "created": created, "result": result}
+                for key, (created, result) in items
+            ]
+        }
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def build(store: MatchStore, signs: list, compute, workers: int = 8) -> int:
+    """
+    補齊所有尚未保存的星座組合，回傳新生成筆數
+    """
+    missing = [pair for pair in combinations_with_replacement(signs, 2) if store.get(*pair) is None]
+
+    def fill(pair):
+        return store.get_or_compute(pair[0], pair[1], compute) is not None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(fill, missing))
+
+
+if __name__ == "__main__":
+    import app
+
+    path = sys.argv[1] if len(sys.argv) > 1 else app.MATCH_TABLE_PATH
+    store = MatchStore(app.ZODIAC_SIGNS, app.MATCH_CACHE_TTL)
+    store.load(path)
+    created = build(store, app.ZODIAC_SIGNS, app.ask_match)
+    store.save(path)
+    print(f"新增 {created} 筆，共 {len(store)} 筆配對結果 → {path}")
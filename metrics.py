@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+執行耗時與計數統計，以 Prometheus 文字格式輸出
+- span(): 量測一段程式的耗時，記入 stage_seconds{stage, mode}
+- 每組標籤同時保留累計的直方圖與最近 window 筆樣本，輸出 p50 / p95 / p99
+- register_stats(): 將其他模組既有的 stats() 一併輸出為 gauge
+統計只存在目前行程。
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: tuple) -> str:
+    parts = [f'{key}="{_escape(value)}"' for key, value in labels]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _quantile(values: list, q: float) -> float:
+    return values[min(len(values) - 1, math.ceil(q * len(values)) - 1)]
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Series:
+    __slots__ = ("buckets", "count", "sum", "recent")
+
+    def __init__(self, bucket_count: int, window: int):
+        self.buckets = [0] * bucket_count
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+
+class Metrics:
+    """
+    - prefix: 所有指標名稱的前綴
+    - buckets: 直方圖上界（秒）
+    - window: 計算百分位數的最近樣本數
+    """
+
+    def __init__(self, prefix: str = "", buckets: tuple = DEFAULT_BUCKETS, window: int = 1024):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._help = {}
+        self._counters = {}  # {名稱: {標籤: 數值}}
+        self._histograms = {}  # {名稱: {標籤: _Series}}
+        self._stats = []  # [(名稱前綴, 說明, stats 函數)]
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {}).get(key)
+            if series is None:
+                series = self._histograms[name][key] = _Series(len(self.buckets), self.window)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series.buckets[index] += 1
+                    break
+            series.count += 1
+            series.sum += value
+            series.recent.append(value)
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """
+        量測區塊耗時；區塊內可修改 yield 出的標籤，例如事後才知道的 mode
+        """
+        labels.setdefault("mode", "")
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+    def register_stats(self, name: str, stats, help_text: str = ""):
+        """
+        輸出時呼叫 stats()，其中的數值（含 bool）各輸出為一個 gauge
+        """
+        self._stats.append((name, help_text, stats))
+
+    def quantiles(self, name: str, **labels) -> dict:
+        """
+        最近樣本的 p50 / p95 / p99，沒有樣本時回傳空 dict
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.get(name, {}).get(key)
+            values = sorted(series.recent) if series else []
+        return {q: _quantile(values, q) for q in QUANTILES} if values else {}
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {
+                name: {key: (list(s.buckets), s.count, s.sum, sorted(s.recent)) for key, s in series.items()}
+                for name, series in self._histograms.items()
+            }
+
+        for name, series in sorted(counters.items()):
+            full = self.prefix + name
+            self._header(lines, full, name, "counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{full}{_labels(key)} {_number(value)}")
+
+        for name, series in sorted(histograms.items()):
+            full = self.prefix + name
+            self._header(lines, full, name, "histogram")
+            for key, (buckets, count, total, _) in sorted(series.items()):
+                cumulative = 0
+                for bound, hits in zip(self.buckets, buckets):
+                    cumulative += hits
+                    lines.append(f"{full}_bucket{_labels(key + (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{full}_bucket{_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{full}_sum{_labels(key)} {_number(total)}")
+                lines.append(f"{full}_count{_labels(key)} {count}")
+
+            # 最近樣本的百分位數
+            recent = f"{full}_recent"
+            lines.append(f"# HELP {recent} {self._help.get(name, name)}（最近 {self.window} 筆的百分位數）")
+            lines.append(f"# TYPE {recent} summary")
+            for key, (_, count, total, values) in sorted(series.items()):
+                for q in QUANTILES:
+                    if values:
+                        lines.append(f"{recent}{_labels(key + (('quantile', q),))} {_number(_quantile(values, q))}")
+                lines.append(f"{recent}_sum{_labels(key)} {_number(total)}")
+                lines.append(f"{recent}_count{_labels(key)} {count}")
+
+        for name, help_text, stats in self._stats:
+            try:
+                values = stats()
+            except Exception:
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                full = f"{self.prefix}{name}_{key}"
+                lines.append(f"# HELP {full} {help_text or name} {key}")
+                lines.append(f"# TYPE {full} gauge")
+                lines.append(f"{full} {_number(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: list, full: str, name: str, kind: str):
+        lines.append(f"# HELP {full} {self._help.get(name, name)}")
+        lines.append(f"# TYPE {full} {kind}")
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+每日使用次數儲存
+檢查與扣除在同一個原子操作內完成，多個 gunicorn worker / 多台機器共用同一份計數。
+
+- memory: 單一行程內（預設，僅適合單 worker）
+- sqlite: 同一台機器的多個 worker 共用（WAL 模式）
+- redis:  多台機器共用（任何支援 Redis 協定與 Lua 的服務，需安裝 redis 套件）
+
+計數以日期分桶，過期的日期會自動清除。讀取沒有成功時以 refund 退還該次。
+"""
+
+import sqlite3
+import threading
+
+# Redis 鍵保留兩天，足以涵蓋時區與跨日邊界
+KEY_TTL_SECONDS = 2 * 24 * 3600
+
+
+class MemoryQuotaStore:
+    """
+    行程內計數 {(day, user_id): count}
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._day = None
+        self._lock = threading.Lock()
+
+    def _rollover(self, day: str):
+        if day != self._day:
+            self._counts = {k: v for k, v in self._counts.items() if k[0] >= day}
+            self._day = day
+
+    def try_consume(self, user_id: str, day: str, limit: int) -> tuple:
+        """
+        尚有額度時扣一次，回傳 (是否成功, 扣除後剩餘次數)
+        """
+        with self._lock:
+            self._rollover(day)
+            used = self._counts.get((day, user_id), 0)
+            if used >= limit:
+                return (False, 0)
+            self._counts[(day, user_id)] = used + 1
+            return (True, limit - used - 1)
+
+    def refund(self, user_id: str, day: str):
+        """
+        退還一次（不會低於 0）
+        """
+        with self._lock:
+            used = self._counts.get((day, user_id), 0)
+            if used > 0:
+                self._counts[(day, user_id)] = used - 1
+
+    def used(self, user_id: str, day: str) -> int:
+        return self._counts.get((day, user_id), 0)
+
+
+class SQLiteQuotaStore:
+    """
+    SQLite（WAL）計數，同一台機器的多個行程共用同一個檔案
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._purged_day = None
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota ("
+            " day TEXT NOT NULL, user_id TEXT NOT NULL, count INTEGER NOT NULL,"
+            " PRIMARY KEY (day, user_id)) WITHOUT ROWID"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _purge(self, day: str):
+        if day == self._purged_day:
+            return
+        self._purged_day = day
+        self._conn().execute("DELETE FROM quota WHERE day < ?", (day,))
+
+    def try_consume(self, user_id: str, day: str, limit: int) -> tuple:
+        """
+        單一 UPSERT 完成檢查與扣除：已達上限時 WHERE 不成立，不會回傳資料列
+        """
+        if limit <= 0:
+            return (False, 0)
+        self._purge(day)
+        row = self._conn().execute(
+            "INSERT INTO quota (day, user_id, count) VALUES (?, ?, 1)"
+            " ON CONFLICT (day, user_id) DO UPDATE SET count = count + 1 WHERE count < ?"
+            " RETURNING count",
+            (day, user_id, limit),
+        ).fetchone()
+        if row is None:
+            return (False, 0)
+        return (True, limit - row[0])
+
+    def refund(self, user_id: str, day: str):
+        self._conn().execute(
+            "UPDATE quota SET count = count - 1 WHERE day = ? AND user_id = ? AND count > 0", (day, user_id)
+        )
+
+    def used(self, user_id: str, day: str) -> int:
+        row = self._conn().execute(
+            "SELECT count FROM quota WHERE day = ? AND user_id = ?", (day, user_id)
+        ).fetchone()
+        return row[0] if row else 0
+
+
+# 檢查與扣除在 Redis 端以 Lua 原子執行，一次往返
+_CONSUME_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used >= tonumber(ARGV[1]) then
+  return {0, used}
+end
+used = redis.call('INCR', KEYS[1])
+if used == 1 then
+  redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return {1, used}
+"""
+
+# 退還一次，鍵已到期或為 0 時不動作
+_REFUND_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used > 0 then
+  redis.call('DECR', KEYS[1])
+end
+return used
+"""
+
+
+class RedisQuotaStore:
+    """
+    Redis 計數，鍵為 quota:{day}:{user_id}，到期自動刪除
+    """
+
+    def __init__(self, url: str = None, client=None, prefix: str = "quota"):
+        if client is None:
+            import redis  # 選用套件，只有使用 redis 時才需要
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._consume = client.register_script(_CONSUME_SCRIPT)
+        self._refund = client.register_script(_REFUND_SCRIPT)
+
+    def _key(self, user_id: str, day: str) -> str:
+        return f"{self.prefix}:{day}:{user_id}"
+
+    def try_consume(self, user_id: str, day: str, limit: int) -> tuple:
+        allowed, used = self._consume(keys=[self._key(user_id, day)], args=[limit, KEY_TTL_SECONDS])
+        if not allowed:
+            return (False, 0)
+        return (True, limit - int(used))
+
+    def refund(self, user_id: str, day: str):
+        self._refund(keys=[self._key(user_id, day)])
+
+    def used(self, user_id: str, day: str) -> int:
+        value = self.client.get(self._key(user_id, day))
+        return int(value) if value else 0
+
+
+def make_quota_store(backend: str, sqlite_path: str = None, redis_url: str = None):
+    """
+    依設定建立使用次數儲存
+    """
+    if backend == "sqlite":
+        return SQLiteQuotaStore(sqlite_path)
+    if backend == "redis":
+        return RedisQuotaStore(redis_url)
+    if backend == "memory":
+        return MemoryQuotaStore()
+    raise ValueError(f"未知的 QUOTA_BACKEND: {backend}")
+
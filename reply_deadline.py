@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Reply Token 期限
+每個事件依 LINE 事件的 timestamp 算出 Reply Token 的期限；生成太久、來不及在期限前回覆時，
+先用 Reply Token 回「解讀中」，正式結果再以 Push 訊息送出，使用者不會因為逾時而收不到已扣次數的結果。
+
+- ReplyWindow: 一個事件的期限，Reply Token 只能被「正式回覆」或「解讀中」其中一個用掉
+- InterimScheduler: 單一背景執行緒，到了送「解讀中」的時間仍未回覆時執行回呼
+"""
+
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyWindow:
+    """
+    一個事件的回覆期限（時間皆為 epoch 秒）
+
+    - expires: Reply Token 視為有效的最後時間
+    - interim_at: 仍未回覆時送出「解讀中」的時間；interim_after 為 0 時只在快過期（expires - margin）時送出
+    """
+
+    def __init__(self, reply_token: str, timestamp_ms: int, ttl: float, interim_after: float = 0.0,
+                 margin: float = 3.0):
+        self.reply_token = reply_token
+        started = timestamp_ms / 1000
+        self.expires = started + ttl
+        self.last_safe = self.expires - margin
+        if interim_after > 0:
+            self.interim_at = min(started + interim_after, self.last_safe)
+        else:
+            self.interim_at = self.last_safe
+        self.interim_sent = False
+        self.closed = False
+        self._used = False
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        """
+        距離 Reply Token 過期的秒數
+        """
+        return self.expires - time.time()
+
+    def fits(self, seconds: float) -> bool:
+        """
+        接下來 seconds 秒的階段結束後，是否仍來得及用 Reply Token 回覆
+        """
+        return time.time() + seconds <= self.last_safe
+
+    def claim(self) -> bool:
+        """
+        取得 Reply Token 送出正式回覆；已被用掉或已過期時回傳 False（改用 Push）
+        """
+        with self._lock:
+            if self._used or time.time() >= self.expires:
+                return False
+            self._used = True
+            return True
+
+    def claim_interim(self) -> bool:
+        """
+        取得 Reply Token 送出「解讀中」；已回覆、已結束或已過期時回傳 False
+        """
+        with self._lock:
+            if self._used or self.closed or time.time() >= self.expires:
+                return False
+            self._used = True
+            self.interim_sent = True
+            return True
+
+    def close(self):
+        """
+        事件處理完畢，之後不再送「解讀中」
+        """
+        with self._lock:
+            self.closed = True
+
+
+class InterimScheduler:
+    """
+    在 window.interim_at 執行 callback（事件已結束或已回覆時略過）
+    回呼在排程時的 contextvars 中執行，日誌仍帶有 request_id / event_id
+    """
+
+    def __init__(self, name: str = "reply-interim"):
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, window: ReplyWindow, callback):
+        with self._cond:
+            if self._thread is None:
+                # 延遲啟動（gunicorn fork 之後才建立執行緒）
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (window.interim_at, next(self._counter), window, callback,
+                                        contextvars.copy_context()))
+            self._cond.notify()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # 已結束的事件直接丟掉，不必等到時間
+                while self._heap and self._heap[0][2].closed:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due = self._heap[0][0] - time.time()
+                if due > 0:
+                    self._cond.wait(min(due, 1.0))
+                    continue
+                _, _, window, callback, context = heapq.heappop(self._heap)
+            if window.closed:
+                continue
+            try:
+                context.run(callback)
+            except Exception:
+                logger.exception("送出「解讀中」失敗")
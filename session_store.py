@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+塔羅選牌階段的使用者狀態
+每筆狀態都有存活時間，讀取時順便淘汰過期資料，並定期整批清除；
+數量超過上限時先淘汰最舊的。
+
+- memory: 單一行程內（預設）
+- sqlite: 同一台機器的多個 worker 共用
+- redis:  多台機器共用（需安裝 redis 套件，容量上限交給 Redis 的 maxmemory 設定）
+"""
+
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+# 到期時間、三張牌的編號、剩餘次數、是否 VIP，後面接 UTF-8 問題文字
+_HEADER = struct.Struct("<dBBBhB")
+
+# 有扣次數時在問題文字後面接 b"\0" 與扣次數的日期（date.toordinal）；問題文字不含 NUL，沒有結尾的舊資料照常讀取
+_CHARGED = struct.Struct("<I")
+
+
+class TarotSession:
+    """
+    選牌中的狀態，cards 為 TAROT_CARDS 的索引
+    charged_day 為抽牌時扣次數的台北日期（YYYY-MM-DD），解讀失敗時退還到那一天；沒有扣次數時為 None
+    """
+
+    __slots__ = ("question", "cards", "remaining", "is_vip", "charged_day", "expires")
+
+    def __init__(self, question: str, cards: tuple, remaining: int, is_vip: bool, charged_day: str = None,
+                 expires: float = 0.0):
+        self.question = question
+        self.cards = tuple(cards)
+        self.remaining = remaining
+        self.is_vip = is_vip
+        self.charged_day = charged_day
+        self.expires = expires
+
+    def pack(self) -> bytes:
+        data = _HEADER.pack(self.expires, *self.cards, self.remaining, self.is_vip) + self.question.encode("utf-8")
+        if self.charged_day:
+            data += b"\0" + _CHARGED.pack(date.fromisoformat(self.charged_day).toordinal())
+        return data
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "TarotSession":
+        expires, c1, c2, c3, remaining, is_vip = _HEADER.unpack_from(data)
+        text = bytes(data[_HEADER.size:])
+        charged_day = None
+        trailer = len(text) - _CHARGED.size - 1
+        if trailer >= 0 and text[trailer] == 0:
+            (charged,) = _CHARGED.unpack_from(text, trailer + 1)
+            charged_day = date.fromordinal(charged).isoformat()
+            text = text[:trailer]
+        return cls(text.decode("utf-8"), (c1, c2, c3), remaining, bool(is_vip), charged_day, expires)
+
+
+class MemorySessionStore:
+    """
+    行程內狀態，依寫入順序排列（存活時間相同，最舊的也最先到期）
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000, sweep_interval: float = 60.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.expired = 0
+        self.evicted = 0
+
+    def put(self, user_id: str, session: TarotSession):
+        session.expires = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = session
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        self._maybe_sweep()
+
+    def get(self, user_id: str) -> TarotSession:
+        session = self._entries.get(user_id)
+        if session is None:
+            return None
+        if session.expires <= time.time():
+            with self._lock:
+                if self._entries.get(user_id) is session:
+                    del self._entries[user_id]
+                    self.expired += 1
+            return None
+        return session
+
+    def pop(self, user_id: str) -> TarotSession:
+        """
+        取出並刪除（同一個狀態只會被取出一次）
+        """
+        with self._lock:
+            session = self._entries.pop(user_id, None)
+        if session is None or session.expires <= time.time():
+            return None
+        return session
+
+    def sweep(self) -> int:
+        """
+        從最舊的開始清除過期狀態，回傳清除筆數
+        """
+        now = time.time()
+        removed = 0
+        with self._lock:
+            while self._entries:
+                user_id, session = next(iter(self._entries.items()))
+                if session.expires > now:
+                    break
+                del self._entries[user_id]
+                removed += 1
+            self.expired += removed
+        return removed
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteSessionStore:
+    """
+    SQLite（WAL）狀態，同一台機器的多個 worker 共用
+    （數量上限在定期清除時套用）
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int = 10000, sweep_interval: float = 60.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = time.monotonic() + sweep_interval
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tarot_sessions ("
+            " user_id TEXT PRIMARY KEY, expires REAL NOT NULL, data BLOB NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS tarot_sessions_expires ON tarot_sessions (expires)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, user_id: str, session: TarotSession):
+        session.expires = time.time() + self.ttl
+        self._conn().execute(
+            "INSERT OR REPLACE INTO tarot_sessions (user_id, expires, data) VALUES (?, ?, ?)",
+            (user_id, session.expires, session.pack()),
+        )
+        self._maybe_sweep()
+
+    def get(self, user_id: str) -> TarotSession:
+        row = self._conn().execute(
+            "SELECT data FROM tarot_sessions WHERE user_id = ? AND expires > ?", (user_id, time.time())
+        ).fetchone()
+        return TarotSession.unpack(row[0]) if row else None
+
+    def pop(self, user_id: str) -> TarotSession:
+        row = self._conn().execute(
+            "DELETE FROM tarot_sessions WHERE user_id = ? RETURNING expires, data", (user_id,)
+        ).fetchone()
+        if row is None or row[0] <= time.time():
+            return None
+        return TarotSession.unpack(row[1])
+
+    def sweep(self) -> int:
+        conn = self._conn()
+        removed = conn.execute("DELETE FROM tarot_sessions WHERE expires <= ?", (time.time(),)).rowcount
+        # 超過上限時刪除最早到期的
+        removed += conn.execute(
+            "DELETE FROM tarot_sessions WHERE user_id IN ("
+            " SELECT user_id FROM tarot_sessions ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        return removed
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep()
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM tarot_sessions").fetchone()[0]
+
+
+class RedisSessionStore:
+    """
+    Redis 狀態，鍵為 tarot:{user_id}，由 Redis 負責到期刪除
+    """
+
+    def __init__(self, url: str = None, ttl: float = 600, client=None, prefix: str = "tarot"):
+        if client is None:
+            import redis  # 選用套件，只有使用 redis 時才需要
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, user_id: str) -> str:
+        return f"{self.prefix}:{user_id}"
+
+    def put(self, user_id: str, session: TarotSession):
+        session.expires = time.time() + self.ttl
+        self.client.set(self._key(user_id), session.pack(), ex=max(1, int(self.ttl)))
+
+    def get(self, user_id: str) -> TarotSession:
+        data = self.client.get(self._key(user_id))
+        return TarotSession.unpack(data) if data else None
+
+    def pop(self, user_id: str) -> TarotSession:
+        data = self.client.getdel(self._key(user_id))
+        return TarotSession.unpack(data) if data else None
+
+    def sweep(self) -> int:
+        return 0
+
+
+def make_session_store(backend: str, ttl: float, max_entries: int, sqlite_path: str = None, redis_url: str = None):
+    """
+    依設定建立塔羅狀態儲存
+    """
+    if backend == "sqlite":
+        return SQLiteSessionStore(sqlite_path, ttl, max_entries)
+    if backend == "redis":
+        return RedisSessionStore(redis_url, ttl)
+    if backend == "memory":
+        return MemorySessionStore(ttl, max_entries)
+    raise ValueError(f"未知的 SESSION_BACKEND: {backend}")
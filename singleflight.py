@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+相同請求合併（single-flight）
+同一時間內相同的 LLM 請求只送出一次，其餘呼叫者等待並共用結果
+AsyncSingleFlight 為 asyncio 版本，等待者不佔用執行緒
+"""
+
+import asyncio
+import re
+import threading
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def flight_key(*parts: str) -> tuple:
+    """
+    將提示詞正規化（去除頭尾空白、合併連續空白）後作為合併鍵
+    """
+    return tuple(_WHITESPACE.sub(" ", part or "").strip() for part in parts)
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _FlightStats:
+    """
+    合併統計
+
+    - requests: 總呼叫次數
+    - executions: 實際執行次數（送到上游的次數）
+    - collapsed: 等待他人結果而未送出的次數
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.executions = 0
+        self.collapsed = 0
+
+    def in_flight(self) -> int:
+        """
+        目前執行中的 key 數量
+        """
+        return len(self._calls)
+
+    def stats(self) -> dict:
+        """
+        合併統計：hit_ratio 為共用他人結果的比例，collapse_ratio 為每次上游呼叫服務的請求數
+        """
+        with self._lock:
+            requests, executions, collapsed = self.requests, self.executions, self.collapsed
+        return {
+            "requests": requests,
+            "executions": executions,
+            "collapsed": collapsed,
+            "hit_ratio": collapsed / requests if requests else 0.0,
+            "collapse_ratio": requests / executions if executions else 0.0,
+        }
+
+
+class SingleFlight(_FlightStats):
+    """
+    以 key 合併進行中的呼叫
+    """
+
+    def do(self, key, func):
+        """
+        執行 func()；若相同 key 已在執行中，等待並回傳同一份結果
+        """
+        with self._lock:
+            self.requests += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.collapsed += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executions += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight(_FlightStats):
+    """
+    以 key 合併進行中的協程（只在同一個事件迴圈中使用）
+    """
+
+    async def do(self, key, func):
+        """
+        await func()；若相同 key 已在執行中，等待並回傳同一份結果
+        """
+        self.requests += 1
+        future = self._calls.get(key)
+        if future is not None:
+            self.collapsed += 1
+            # shield：其中一個等待者被取消時不影響其他人
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        self.executions += 1
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 沒有其他等待者時避免「例外未被讀取」的警告
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
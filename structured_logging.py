@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+結構化日誌
+- 請求執行緒只把紀錄放進佇列（不格式化、不寫檔），由背景執行緒輸出；佇列滿時直接丟棄
+- EventLogger 依事件類型先抽樣再建立紀錄，且不查詢呼叫位置，未抽中的事件幾乎沒有成本
+- 輸出前遮蔽使用者 ID、Email、電話號碼，並截斷過長的內容
+- request_id / event_id 由 contextvars 帶入，從收到 Webhook 到回覆都能對應
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import random
+import re
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+request_id = contextvars.ContextVar("request_id", default="")
+event_id = contextvars.ContextVar("event_id", default="")
+
+_USER_ID = re.compile(r"\b([UCR])[0-9a-f]{28}([0-9a-f]{4})\b")
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+# 台灣手機（0912-345-678、+886 912 345 678）與市話（02-2345-6789、(02)2345-6789），前後不能接數字，不會誤判日期與時間戳記
+_PHONE = re.compile(
+    r"(?<![\d+-])(?:"
+    r"(?:\+886[ -]?|0)9\d{2}[ -]?\d{3}[ -]?\d{3}"
+    r"|(?:\+886[ -]?|\(?0)[2-8]\d?\)?[ -]?\d{3,4}[ -]?\d{4}"
+    r")(?![\d-])"
+)
+
+# LogRecord 內建屬性，其餘的 extra 欄位都會輸出
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """
+    "message=0.1,webhook=0.05" -> {"message": 0.1, "webhook": 0.05}
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        rates[name.strip()] = float(value)
+    return rates
+
+
+def redact(text: str, limit: int = 0) -> str:
+    """
+    遮蔽個人資料，limit > 0 時截斷到 limit 個字
+    """
+    text = _USER_ID.sub(r"\1…\2", text)
+    text = _EMAIL.sub("<email>", text)
+    text = _PHONE.sub("<phone>", text)
+    if limit and len(text) > limit:
+        text = f"{text[:limit]}…(+{len(text) - limit})"
+    return text
+
+
+class EventLogger:
+    """
+    熱路徑用的 INFO 事件紀錄：依 event_type 的抽樣比例（未列出的類型全部保留）
+    決定是否記錄，抽中才建立 LogRecord；警告與錯誤請直接用 logging
+    """
+
+    def __init__(self, logger: logging.Logger, rates: dict = None):
+        self.logger = logger
+        self.rates = rates or {}
+
+    def info(self, event_type: str, msg: str, **fields):
+        rate = self.rates.get(event_type, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        fields["event_type"] = event_type
+        record = self.logger.makeRecord(self.logger.name, logging.INFO, "", 0, msg, (), None, extra=fields)
+        self.logger.handle(record)
+
+
+class ContextFilter(logging.Filter):
+    """
+    在放進佇列前記下目前的 request_id / event_id（背景執行緒看不到請求的 contextvars）
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        record.event_id = event_id.get()
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    只放入佇列：不在請求執行緒格式化訊息，佇列滿時丟棄並計數
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    一行一筆 JSON，訊息與 extra 欄位都經過遮蔽與截斷
+    """
+
+    def __init__(self, limit: int = 200):
+        super().__init__()
+        self.limit = limit
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage(), self.limit),
+        }
+        if record.request_id:
+            entry["request_id"] = record.request_id
+        if record.event_id:
+            entry["event_id"] = record.event_id
+        for key, value in vars(record).items():
+            if key in _RESERVED or key in ("request_id", "event_id"):
+                continue
+            entry[key] = redact(value, self.limit) if isinstance(value, str) else value
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    人看的單行格式，同樣遮蔽與截斷
+    """
+
+    def __init__(self, limit: int = 200):
+        super().__init__()
+        self.limit = limit
+
+    def format(self, record: logging.LogRecord) -> str:
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        context = f" [{record.request_id}/{record.event_id}]" if record.request_id else ""
+        extra = " ".join(
+            f"{key}={redact(value, self.limit) if isinstance(value, str) else value}"
+            for key, value in vars(record).items()
+            if key not in _RESERVED and key not in ("request_id", "event_id")
+        )
+        line = f"{stamp} {record.levelname} {record.name}{context}: {redact(record.getMessage(), self.limit)}"
+        if extra:
+            line += f" {extra}"
+        if record.exc_info:
+            line += "\n" + redact(self.formatException(record.exc_info))
+        return line
+
+
+def setup_logging(level: str = "INFO", fmt: str = "json", limit: int = 200,
+                  queue_size: int = 10000) -> NonBlockingQueueHandler:
+    """
+    將 root logger 改為經由佇列輸出到 stderr，回傳佇列 handler（可讀取 dropped）
+    """
+    # 不輸出的欄位不必在每筆紀錄收集（process 保留，gunicorn 的日誌格式會用到）
+    logging.logMultiprocessing = False
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter(limit) if fmt == "json" else TextFormatter(limit))
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    return queue_handler
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+塔羅解讀預先計算
+抽完三張牌、使用者還在選的時候，就在背景先把三張牌的解讀都算好，
+選牌後幾乎可以立即回覆。結果只存在目前行程，選牌落在其他 worker 時照常即時呼叫。
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Speculation:
+    __slots__ = ("cards", "futures", "created")
+
+    def __init__(self, cards: tuple, futures: list):
+        self.cards = cards
+        self.futures = futures
+        self.created = time.monotonic()
+
+
+class TarotSpeculator:
+    """
+    - policy: off 不預先計算 / vip 只替 VIP / all 所有人
+    - max_active: 同時進行中的預先計算（以一次抽牌為單位）上限
+    - ttl: 使用者超過這個秒數沒選牌就視為放棄
+    """
+
+    def __init__(self, policy: str = "off", max_active: int = 20, ttl: float = 600.0):
+        self.policy = policy
+        self.max_active = max(1, max_active)
+        self.ttl = ttl
+        self._pending = {}  # {user_id: _Speculation}
+        self._active = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self.started = 0
+        self.skipped = 0
+        self.used = 0
+        self.wasted = 0
+        self.missed = 0
+
+    def wants(self, is_vip: bool) -> bool:
+        return self.policy == "all" or (self.policy == "vip" and is_vip)
+
+    def start(self, user_id: str, cards: tuple, prompts: list, compute) -> bool:
+        """
+        為三張牌各送出一個背景解讀，超過上限時略過並回傳 False
+        """
+        with self._lock:
+            self._expire()
+            self._discard(user_id)
+            if self._active >= self.max_active:
+                self.skipped += 1
+                return False
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_active * len(prompts), thread_name_prefix="tarot-spec"
+                )
+            self._active += 1
+            self.started += 1
+            futures = [self._executor.submit(compute, prompt) for prompt in prompts]
+            self._pending[user_id] = _Speculation(tuple(cards), futures)
+
+        remaining = [len(futures)]
+
+        def finished(_):
+            with self._lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self._active -= 1
+
+        for future in futures:
+            future.add_done_callback(finished)
+        return True
+
+    def take(self, user_id: str, cards: tuple, choice: int):
+        """
+        取出選中那張牌的解讀（必要時等它算完），沒有預先計算時回傳 None
+        """
+        with self._lock:
+            speculation = self._pending.pop(user_id, None)
+            if speculation is None or speculation.cards != tuple(cards):
+                if speculation is not None:
+                    self.wasted += len(speculation.futures)
+                self.missed += 1
+                return None
+            self.used += 1
+            self.wasted += len(speculation.futures) - 1
+        return speculation.futures[choice].result()
+
+    def _discard(self, user_id: str):
+        speculation = self._pending.pop(user_id, None)
+        if speculation is not None:
+            self.wasted += len(speculation.futures)
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        for user_id in [uid for uid, spec in self._pending.items() if spec.created < deadline]:
+            self._discard(user_id)
+
+    def stats(self) -> dict:
+        """
+        used / wasted 以「一張牌的解讀」計算，missed 為選牌時沒有可用結果的次數
+        """
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "active": self._active,
+                "started": self.started,
+                "skipped": self.skipped,
+                "used": self.used,
+                "wasted": self.wasted,
+                "missed": self.missed,
+            }